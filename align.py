@@ -1,9 +1,16 @@
+import time
 import argparse
 import asyncio
 from pathlib import Path
 import math
 import shutil
-from device_set import DeviceSet
+import threading
+from resource_pool import ResourcePool
+from emb_cache import EmbeddingCache
+from stage_cache import link_or_copy
+from job_dag import Job, JobDAG, JobFailed
+from job_trace import JobTrace
+from corpus_stats import CorpusStatsIndex, read_vec_count
 
 parser = argparse.ArgumentParser()
 
@@ -12,10 +19,21 @@ parser.add_argument("--bible_dir", type=Path, required=True)
 parser.add_argument("--align_dir", type=Path, required=True)
 parser.add_argument("--emb_dir", type=Path, required=True)
 parser.add_argument("--overwrite_align", action="store_true")
+parser.add_argument("--state_file", type=Path, default=None, help="Record of completed jobs used to resume, defaults to <align_dir>/.align_state.json")
 parser.add_argument("--create_emb", action="store_true")
+parser.add_argument("--trace_dir", type=Path, default=None, help="Where the Chrome trace and summary table of each run are written, defaults to <align_dir>/traces")
+parser.add_argument("--trace_interval", type=float, default=0.5, help="Seconds between /proc samples of the memory of running subprocesses")
+parser.add_argument("--corpus_stats_file", type=Path, default=None, help="Index of token, type and line counts of the Bibles, defaults to <bible_dir>/.corpus_stats.json")
+parser.add_argument("--min_count", type=int, default=None, help="fastText -minCount of every language, by default the largest of 5 to 2 that keeps --min_vocab words")
+parser.add_argument("--min_vocab", type=int, default=5000, help="Vocabulary size the derived -minCount aims for")
+parser.add_argument("--emb_cache_dir", type=Path, default=None, help="Cache of fasttext embeddings shared by all algorithms, defaults to <bible_dir>/.emb_cache")
 parser.add_argument("--num_gpus", type=int, required=True)
+parser.add_argument("--num_cores", type=int, default=None, help="CPU cores shared by all languages, defaults to all cores")
+parser.add_argument("--max_threads", type=int, default=6, help="Most threads given to one fasttext run")
+parser.add_argument("--gpu_mem_mb", type=int, default=None, help="Memory of each GPU, lets GPU jobs share a GPU. By default every GPU job gets a GPU to itself")
+parser.add_argument("--job_gpu_mem_mb", type=int, default=0, help="GPU memory declared by each GPU job when --gpu_mem_mb is set")
 
-parser.add_argument("--algorithm", choices=["fb", "nlm", "vecmap"], required=True)
+parser.add_argument("--algorithm", choices=["fb", "nlm", "vecmap", "procrustes"], required=True)
 
 parser.add_argument("--vecmap_dir", type=Path)
 parser.add_argument("--nlm_dir", type=Path)
@@ -25,199 +43,299 @@ parser.add_argument("--sid_bible_dir", type=Path)
 parser.add_argument("--eng_emb_file")
 
 parser.add_argument("--nlm_preproc_dir", type=Path)
+
+parser.add_argument("--seed_dict_dir", type=Path, help="Seed dictionaries <lang>_eng.txt for procrustes, identical words are used when missing")
+parser.add_argument("--procrustes_iters", type=int, default=5, help="Refinement iterations of procrustes")
+parser.add_argument("--procrustes_k", type=int, default=10, help="CSLS neighbourhood size of procrustes dictionary induction")
+parser.add_argument("--procrustes_max_rank", type=int, default=15000, help="Most frequent words used to induce the procrustes dictionary, 0 for all")
 parser.add_argument("--nlm_preprocess", action="store_true")
 parser.add_argument("--nlm_modified", action="store_true")
 
-def file_linecount(file_name):
-    with open(file_name, "r") as f:
-        for i, _ in enumerate(f):
-            pass
-    return i
-
-async def align_emb_vecmap(lang, device_set, opt):
+def corpus_stats(opt, lang):
+    return opt.corpus_stats.get(opt.bible_dir/f"{lang}.txt")
+
+def bible_size(opt, lang):
+    # Cost estimate of the jobs of a language, the tokens of its Bible
+    stats = corpus_stats(opt, lang)
+    return stats.tokens if stats is not None else 0
+
+def min_count(opt, lang):
+    # fastText -minCount of a language, from its word frequencies. Without
+    # a Bible to count, _sm (small) Bibles get 2 and the others 5.
+    if opt.min_count is not None:
+        return opt.min_count
+    stats = corpus_stats(opt, lang)
+    if stats is None:
+        return 2 if lang.endswith("_sm") else 5
+    return stats.min_count(opt.min_vocab)
+
+def check_returncode(returncode, what, log_file):
+    if returncode != 0:
+        raise JobFailed(f"{what} exited with code {returncode}, see {log_file}")
+
+async def run_subprocess(name, kind, cmd, resource_pool, trace, **lease_args):
+    # Runs the shell command cmd(lease) on resources leased from the pool,
+    # recorded in the trace. Returns the exit code.
+    requested = trace.now()
+    async with resource_pool.lease(**lease_args) as lease:
+        return await trace.run(name, kind, cmd(lease), lease, requested, env=lease.env())
+
+async def train_skipgram(input_id, resource_pool, emb_cache, trace, opt, preproc_dir, log_file, lr, min_count, output_id=None):
+    # Embeddings of opt.bible_dir/<input_id>.txt from the cache, trained
+    # there first when missing, linked to preproc_dir/<output_id>.vec
+    output_id = output_id or input_id
+    params = {"epoch": 25, "lr": lr, "dim": 100, "minCount": min_count}
+
+    async def train(output):
+        return await run_subprocess(
+            f"embed:{output_id}", "fasttext",
+            lambda lease: (
+                f"{opt.fasttext_dir}/fasttext skipgram "
+                f"-input {opt.bible_dir/input_id}.txt "
+                f"-output {output} "
+                f"-epoch {params['epoch']} "
+                f"-lr {params['lr']} "
+                f"-thread {lease.threads} "
+                f"-dim {params['dim']} "
+                f"-minCount {params['minCount']} "
+                f">> {log_file} 2>&1 "
+            ),
+            resource_pool, trace, max_threads=opt.max_threads)
+
+    emb_file = await emb_cache.get(opt.bible_dir/f"{input_id}.txt", params, train, force=opt.create_emb)
+    link_or_copy(emb_file, preproc_dir/f"{output_id}.vec")
+
+def embed_job(input_id, resource_pool, emb_cache, trace, opt, log_file, lr, min_count, output_id=None):
+    preproc_dir = opt.emb_dir
+    output_id = output_id or input_id
+
+    async def run():
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        await train_skipgram(input_id, resource_pool, emb_cache, trace, opt, preproc_dir, log_file, lr, min_count, output_id)
+        print(f"Preprocessed {output_id}")
+
+    return Job(f"embed:{output_id}", run, cost=bible_size(opt, input_id),
+               outputs=[preproc_dir/f"{output_id}.vec"], force=opt.create_emb)
+
+def eng_embed_job(resource_pool, emb_cache, trace, opt, small=False):
+    # One job for the English embeddings that languages are aligned to,
+    # shared by all of them. vecmap aligns _sm languages to English trained
+    # on the small setting instead, which is kept apart as eng_sm.vec.
+    if small:
+        return embed_job("eng", resource_pool, emb_cache, trace, opt, opt.align_dir/"logs_preproc_eng_sm.txt", 0.05, 2,
+                         output_id="eng_sm")
+    return embed_job("eng", resource_pool, emb_cache, trace, opt, opt.align_dir/"logs_preproc_eng.txt", 0.1, min_count(opt, "eng"))
+
+def add_vecmap_jobs(dag, lang, resource_pool, emb_cache, trace, opt):
     lang_align_dir = (opt.align_dir/lang)
     aligned_emb_file = lang_align_dir/f"{lang}.vec"
-    if aligned_emb_file.exists() and not opt.overwrite_align:
-        print(f"Skip aligning {lang} as already done")
-        return
-    
     preproc_dir = opt.emb_dir
 
-    lang_align_dir.mkdir(parents=True, exist_ok=True)
-    preproc_dir.mkdir(parents=True, exist_ok=True)
-
+    freq = min_count(opt, lang)
     if lang.endswith("_sm"):
-        freq = 2
         # lang_id = lang + "_eng"
         # eng_id = "eng_" + lang
         lang_id = lang
-        eng_id = "eng"
+        eng_id = "eng_sm"
     else:
-        freq = 5
         lang_id = lang
         eng_id = "eng"
 
     preproc_log_file = lang_align_dir/"logs_preproc.txt"
     align_log_file = lang_align_dir/"logs_align.txt"
 
-    device_id = await device_set.acquire_device()
-
-    if opt.create_emb or not (preproc_dir/f"{lang_id}.vec").is_file():
-        p = await asyncio.create_subprocess_shell(
-            f"{opt.fasttext_dir}/fasttext skipgram "
-            f"-input {opt.bible_dir/lang_id}.txt "
-            f"-output {preproc_dir/lang_id} "
-            f"-epoch 25 "
-            f"-lr 0.1 "
-            f"-thread 6 "
-            f"-dim 100 "
-            f"-minCount {freq} "
-            f">> {preproc_log_file} 2>&1 "
-        )
-        await p.wait()
-        if p.returncode != 0:
-            print(f"Error preprocessing {lang}")
-
-        (preproc_dir/f"{lang_id}.bin").unlink()
-
-        if lang.endswith("_sm") and (opt.create_emb or not (preproc_dir/f"{eng_id}.vec").is_file()):
-            p = await asyncio.create_subprocess_shell(
-                f"{opt.fasttext_dir}/fasttext skipgram "
-                f"-input {opt.bible_dir/eng_id}.txt "
-                f"-output {preproc_dir/eng_id} "
-                f"-epoch 25 "
-                f"-lr 0.05 "
-                f"-thread 6 "
-                f"-dim 100 "
-                f"-minCount 2 "
-                f">> {preproc_log_file} 2>&1 "
+    deps = [dag.add(embed_job(lang_id, resource_pool, emb_cache, trace, opt, preproc_log_file, 0.1, freq)).name]
+    if opt.eng_emb_file is None:
+        deps.append(dag.add(eng_embed_job(resource_pool, emb_cache, trace, opt, small=eng_id == "eng_sm")).name)
+
+    async def align():
+        lang_align_dir.mkdir(parents=True, exist_ok=True)
+        eng_emb_file = opt.eng_emb_file if opt.eng_emb_file is not None else f"{preproc_dir/eng_id}.vec"
+        sid_bible_cmd_str = ""
+        if opt.sid_bible_dir:
+            sid_bible_cmd_str = (
+                f"--src_txt_file {opt.sid_bible_dir/lang}.txt "
+                f"--tgt_txt_file {opt.sid_bible_dir}/eng.txt "
             )
-            await p.wait()
-        print(f"Preprocessed {lang}")
-    else:
-        print(f"Skip preprocessing {lang} as already done")
-
-    eng_emb_file = opt.eng_emb_file if opt.eng_emb_file is not None else f"{preproc_dir/eng_id}.vec"
-    sid_bible_cmd_str = ""
-    if opt.sid_bible_dir:
-        sid_bible_cmd_str = (
-            f"--src_txt_file {opt.sid_bible_dir/lang}.txt "
-            f"--tgt_txt_file {opt.sid_bible_dir}/eng.txt "
-        )
-    p = await asyncio.create_subprocess_shell(
-        f"python -u {opt.vecmap_dir}/map_embeddings.py "
-        f"--unsupervised "
-        f"{preproc_dir/lang_id}.vec {eng_emb_file} "
-        f"{lang_align_dir/lang}.vec {lang_align_dir}/eng.vec "
-        f"{sid_bible_cmd_str}"
-        f"--device {device_id} "
-        f"--cuda -v "
-        f">> {align_log_file} 2>&1 "
-    )
-    await p.wait()
-    if p.returncode != 0:
-        print(f"Error aligning {lang}")
-
-    await device_set.release_device(device_id)
-    print(f"Aligned {lang}")
-
-async def align_emb_fb(lang, device_set, opt):
+        returncode = await run_subprocess(
+            f"align:{lang}", "map_embeddings",
+            lambda lease: (
+                f"python -u {opt.vecmap_dir}/map_embeddings.py "
+                f"--unsupervised "
+                f"{preproc_dir/lang_id}.vec {eng_emb_file} "
+                f"{lang_align_dir/lang}.vec {lang_align_dir}/eng.vec "
+                f"{sid_bible_cmd_str}"
+                f"--device {lease.device_id} "
+                f"--cuda -v "
+                f">> {align_log_file} 2>&1 "
+            ),
+            resource_pool, trace, gpu=True, gpu_mem_mb=opt.job_gpu_mem_mb)
+        check_returncode(returncode, f"Aligning {lang}", align_log_file)
+        print(f"Aligned {lang}")
+
+    dag.add(Job(f"align:{lang}", align, deps=deps, cost=bible_size(opt, lang),
+                outputs=[aligned_emb_file], force=opt.overwrite_align))
+
+def add_fb_jobs(dag, lang, resource_pool, emb_cache, trace, opt):
     lang_align_dir = (opt.align_dir/lang)
     aligned_emb_file = lang_align_dir/f"{lang}.vec"
-    if aligned_emb_file.exists() and not opt.overwrite_align:
-        print(f"Skip aligning {lang} as already done")
-        return
-
     preproc_dir = opt.emb_dir
 
-    lang_align_dir.mkdir(parents=True, exist_ok=True)
-    preproc_dir.mkdir(parents=True, exist_ok=True)
-
-    freq = 2 if lang.endswith("_sm") else 5
+    freq = min_count(opt, lang)
 
     preproc_log_file = lang_align_dir/"logs_preproc.txt"
     align_log_file = lang_align_dir/"logs_align.txt"
-    lang_code = lang.split("_")[0]
-
-    device_id = await device_set.acquire_device()
-
-    if opt.create_emb or not (preproc_dir/f"{lang}.vec").is_file():
-        p = await asyncio.create_subprocess_shell(
-            f"{opt.fasttext_dir}/fasttext skipgram "
-            f"-input {opt.bible_dir/lang}.txt "
-            f"-output {preproc_dir/lang} "
-            f"-epoch 25 "
-            f"-lr 0.1 "
-            f"-thread 6 "
-            f"-dim 100 "
-            f"-minCount {freq} "
-            f">> {preproc_log_file} 2>&1 "
-        )
-        await p.wait()
-        print(f"Preprocessed {lang}")
-    else:
-        print(f"Skip preprocessing {lang} as already done")
-
-    non_en_lc = file_linecount(f"{preproc_dir/lang}.vec")
-    en_lc = file_linecount(preproc_dir/"eng.vec")
-    vocab_size = min(en_lc, non_en_lc)
-    n_epoch = 5
-    batch_size = math.floor(vocab_size / (2 ** (n_epoch - 1)))
-    learning_rate = batch_size/2
-
-    p = await asyncio.create_subprocess_shell(
-        f"python -u {opt.fasttext_dir}/alignment/unsup_align.py "
-        f"--model_src {preproc_dir/lang}.vec "
-        f"--model_tgt {preproc_dir}/eng.vec "
-        f"--output_src {lang_align_dir/lang}.vec "
-        f"--output_tgt {lang_align_dir}/eng.vec "
-        f"--nepoch {n_epoch} "
-        f"--bsz {batch_size} "
-        f"--lr {learning_rate} "
-        f"--nmax {vocab_size} "
-        f"--device {device_id} "
-        f">> {align_log_file} 2>&1 "
-    )
-    await p.wait()
-    await device_set.release_device(device_id)
-    print(f"Aligned {lang}")
-
-async def align_emb_nlm(lang, device_set, opt):
+
+    deps = [dag.add(embed_job(lang, resource_pool, emb_cache, trace, opt, preproc_log_file, 0.1, freq)).name,
+            dag.add(eng_embed_job(resource_pool, emb_cache, trace, opt)).name]
+
+    async def align():
+        lang_align_dir.mkdir(parents=True, exist_ok=True)
+        # The .vec headers hold the vocabulary sizes, the files are not read
+        vocab_size = min(read_vec_count(f"{preproc_dir/lang}.vec"), read_vec_count(preproc_dir/"eng.vec"))
+        n_epoch = 5
+        batch_size = math.floor(vocab_size / (2 ** (n_epoch - 1)))
+        learning_rate = batch_size/2
+
+        returncode = await run_subprocess(
+            f"align:{lang}", "unsup_align",
+            lambda lease: (
+                f"python -u {opt.fasttext_dir}/alignment/unsup_align.py "
+                f"--model_src {preproc_dir/lang}.vec "
+                f"--model_tgt {preproc_dir}/eng.vec "
+                f"--output_src {lang_align_dir/lang}.vec "
+                f"--output_tgt {lang_align_dir}/eng.vec "
+                f"--nepoch {n_epoch} "
+                f"--bsz {batch_size} "
+                f"--lr {learning_rate} "
+                f"--nmax {vocab_size} "
+                f"--device {lease.device_id} "
+                f">> {align_log_file} 2>&1 "
+            ),
+            resource_pool, trace, gpu=True, gpu_mem_mb=opt.job_gpu_mem_mb)
+        check_returncode(returncode, f"Aligning {lang}", align_log_file)
+        print(f"Aligned {lang}")
+
+    dag.add(Job(f"align:{lang}", align, deps=deps, cost=bible_size(opt, lang),
+                outputs=[aligned_emb_file], force=opt.overwrite_align))
+
+# load_vectors writes the vector cache of a file under a per-process name,
+# the procrustes threads take turns
+_load_lock = threading.Lock()
+
+def copy_replacing(src, dst):
+    # Replaces dst, which may be a link left by an earlier run, with a copy
+    dst = Path(dst)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    shutil.copy2(src, dst)
+
+def align_procrustes(lang, opt, log_file):
+    # Refines in this process, in a worker thread: the fastText embeddings
+    # come from their vector caches, and the aligned source embeddings are
+    # written with their vector cache so that eval.py does not parse them.
+    # eng.vec and its cache, when there is a valid one, are copied in unchanged.
+    from eval_utils import load_vectors, save_vectors, vec_cache_paths, read_vec_cache_header
+    from procrustes import identical_pairs, dictionary_pairs, refine
+    lang_align_dir = opt.align_dir/lang
+    src_emb_file = opt.emb_dir/f"{lang}.vec"
+    eng_emb_file = opt.emb_dir/"eng.vec"
+    with open(log_file, "a") as log:
+        with _load_lock:
+            words_src, x_src = load_vectors(str(src_emb_file), maxload=0, verbose=False)
+            words_tgt, x_tgt = load_vectors(str(eng_emb_file), maxload=0, verbose=False)
+        seed_dict = opt.seed_dict_dir/f"{lang.split('_')[0]}_eng.txt" if opt.seed_dict_dir else None
+        if seed_dict is not None and seed_dict.exists():
+            src, tgt = dictionary_pairs(str(seed_dict), words_src, words_tgt)
+        else:
+            src, tgt = identical_pairs(words_src, words_tgt, opt.procrustes_max_rank)
+        w = refine(x_src, x_tgt, src, tgt, n_iter=opt.procrustes_iters, k=opt.procrustes_k,
+                   max_rank=opt.procrustes_max_rank, log_file=log)
+        # Copies, not links: the external aligners of the other algorithms
+        # write align_dir/<lang>/eng.vec in place, which would overwrite
+        # the cached English embeddings through a link. copy2 keeps the
+        # mtime that the vector cache header records. Without a cache (e.g.
+        # one that could not be written) the copy has none either, and
+        # eval.py parses it.
+        has_cache = read_vec_cache_header(eng_emb_file) is not None
+        for src_file, dst_file in zip(vec_cache_paths(eng_emb_file), vec_cache_paths(lang_align_dir/"eng.vec")):
+            if has_cache:
+                copy_replacing(src_file, dst_file)
+            else:
+                Path(dst_file).unlink(missing_ok=True)
+        copy_replacing(eng_emb_file, lang_align_dir/"eng.vec")
+        save_vectors(str(lang_align_dir/f"{lang}.vec"), words_src, x_src.dot(w), verbose=False)
+
+def add_procrustes_jobs(dag, lang, resource_pool, emb_cache, trace, opt):
     lang_align_dir = (opt.align_dir/lang)
     aligned_emb_file = lang_align_dir/f"{lang}.vec"
-    if aligned_emb_file.exists():
-        return
 
-    preproc_dir = opt.nlm_preproc_dir
+    freq = min_count(opt, lang)
+
+    preproc_log_file = lang_align_dir/"logs_preproc.txt"
+    align_log_file = lang_align_dir/"logs_align.txt"
+
+    deps = [dag.add(embed_job(lang, resource_pool, emb_cache, trace, opt, preproc_log_file, 0.1, freq)).name,
+            dag.add(eng_embed_job(resource_pool, emb_cache, trace, opt)).name]
 
-    lang_align_dir.mkdir(parents=True, exist_ok=True)
-    preproc_dir.mkdir(parents=True, exist_ok=True)
+    async def align():
+        lang_align_dir.mkdir(parents=True, exist_ok=True)
+        async with resource_pool.lease(max_threads=opt.max_threads):
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, align_procrustes, lang, opt, align_log_file)
+            except (ValueError, OSError) as e:
+                raise JobFailed(f"Aligning {lang}: {e}")
+        print(f"Aligned {lang}")
 
-    freq = 2 if lang.endswith("_sm") else 5
+    dag.add(Job(f"align:{lang}", align, deps=deps, cost=bible_size(opt, lang),
+                outputs=[aligned_emb_file], force=opt.overwrite_align))
+
+def add_nlm_jobs(dag, lang, resource_pool, emb_cache, trace, opt):
+    lang_align_dir = (opt.align_dir/lang)
+    aligned_emb_file = lang_align_dir/f"{lang}.vec"
+    preproc_dir = opt.nlm_preproc_dir
+
+    freq = min_count(opt, lang)
 
     preproc_log_file = lang_align_dir/"logs_preproc.txt"
     align_log_file = lang_align_dir/"logs_align.txt"
+    cost = bible_size(opt, lang) + bible_size(opt, "eng")
 
+    train_deps = []
     if opt.nlm_preprocess:
         if opt.nlm_modified:
             preproc_dir_cmd_str = f"-save_dir {preproc_dir}/ "
         else:
             preproc_dir_cmd_str = ""
-        p = await asyncio.create_subprocess_shell(
-            f"python {opt.nlm_dir/'preprocess.py'} "
-            f"-train {opt.bible_dir/lang}.txt {opt.bible_dir}/eng.txt "
-            f"-V_min_freq {freq} 3 "
-            f"-save_name {lang} "
-            f"-output_vocab "
-            f"{preproc_dir_cmd_str}"
-            f">> {preproc_log_file} 2>&1 "
-        )
-        await p.wait()
-        print(f"Preprocessed {lang}")
-    else:
-        print(f"Skip preprocessing {lang} as already done")
 
-    device_id = await device_set.acquire_device()
+        async def preprocess():
+            lang_align_dir.mkdir(parents=True, exist_ok=True)
+            returncode = await run_subprocess(
+                f"preprocess:{lang}", "nlm_preprocess",
+                lambda lease: (
+                    f"python {opt.nlm_dir/'preprocess.py'} "
+                    f"-train {opt.bible_dir/lang}.txt {opt.bible_dir}/eng.txt "
+                    f"-V_min_freq {freq} 3 "
+                    f"-save_name {lang} "
+                    f"-output_vocab "
+                    f"{preproc_dir_cmd_str}"
+                    f">> {preproc_log_file} 2>&1 "
+                ),
+                resource_pool, trace)
+            check_returncode(returncode, f"Preprocessing {lang}", preproc_log_file)
+            print(f"Preprocessed {lang}")
+
+        # The outputs are not known here, the state file marks it done for
+        # the same Bibles and settings
+        bibles = [opt.bible_dir/f"{lang}.txt", opt.bible_dir/"eng.txt"]
+        signature = {
+            "bibles": [[str(b), b.stat().st_size, b.stat().st_mtime_ns] if b.exists() else [str(b)] for b in bibles],
+            "preproc_dir": str(preproc_dir),
+            "modified": opt.nlm_modified,
+        }
+        train_deps.append(dag.add(Job(f"preprocess:{lang}", preprocess, cost=bible_size(opt, lang),
+                                      signature=signature)).name)
+
     if opt.nlm_modified:
         opts_cmd_str = \
         f"-data_dir {preproc_dir}/ "
@@ -227,39 +345,77 @@ async def align_emb_nlm(lang, device_set, opt):
         opts_cmd_str = \
         f"-learning_rate 1.0 "
         f"-stop_threshold 0.99 "
-    p = await asyncio.create_subprocess_shell(
-        f"python -u {opt.nlm_dir}/train.py "
-        f"-data {lang} "
-        f"-gpuid {device_id} "
-        f"-save_dir {lang_align_dir} "
-        f"-batch_size 64 "
-        f"-epoch_size 20 "
-        f"-opt_type SGD "
-        f"-n_layer 2 "
-        f"-emb_size 300 "
-        f"-h_size 300 "
-        f"-seed 111 "
-        f"-dr_rate 0.3 "
-        f"-remove_models "
-        f"{opts_cmd_str}"
-        f">> {align_log_file} 2>&1 "
-    )
-    await p.wait()
-    await device_set.release_device(device_id)
-    shutil.move(lang_align_dir/f"{lang}.lang0.vec", aligned_emb_file)
-    shutil.move(lang_align_dir/f"{lang}.lang1.vec", lang_align_dir/"eng.vec")
-    print(f"Aligned {lang}")
+
+    async def train():
+        lang_align_dir.mkdir(parents=True, exist_ok=True)
+        returncode = await run_subprocess(
+            f"train:{lang}", "nlm_train",
+            lambda lease: (
+                f"python -u {opt.nlm_dir}/train.py "
+                f"-data {lang} "
+                f"-gpuid {lease.device_id} "
+                f"-save_dir {lang_align_dir} "
+                f"-batch_size 64 "
+                f"-epoch_size 20 "
+                f"-opt_type SGD "
+                f"-n_layer 2 "
+                f"-emb_size 300 "
+                f"-h_size 300 "
+                f"-seed 111 "
+                f"-dr_rate 0.3 "
+                f"-remove_models "
+                f"{opts_cmd_str}"
+                f">> {align_log_file} 2>&1 "
+            ),
+            resource_pool, trace, gpu=True, gpu_mem_mb=opt.job_gpu_mem_mb)
+        check_returncode(returncode, f"Training {lang}", align_log_file)
+
+    async def move():
+        shutil.move(lang_align_dir/f"{lang}.lang0.vec", aligned_emb_file)
+        shutil.move(lang_align_dir/f"{lang}.lang1.vec", lang_align_dir/"eng.vec")
+        print(f"Aligned {lang}")
+
+    dag.add(Job(f"train:{lang}", train, deps=train_deps, cost=cost, force=opt.overwrite_align,
+                outputs=[lang_align_dir/f"{lang}.lang0.vec", lang_align_dir/f"{lang}.lang1.vec"]))
+    dag.add(Job(f"move:{lang}", move, deps=[f"train:{lang}"], force=opt.overwrite_align,
+                outputs=[aligned_emb_file, lang_align_dir/"eng.vec"]))
 
 async def main():
     opt = parser.parse_args()
-    device_set = DeviceSet(opt.num_gpus)
-    task_functions = {"fb": align_emb_fb, "nlm": align_emb_nlm, "vecmap": align_emb_vecmap}
-    task_function = task_functions.get(opt.algorithm)
-    if task_function == None:
+    resource_pool = ResourcePool(opt.num_cores, opt.num_gpus, opt.gpu_mem_mb)
+    emb_cache = EmbeddingCache(opt.emb_cache_dir or opt.bible_dir/".emb_cache")
+    opt.corpus_stats = CorpusStatsIndex(opt.corpus_stats_file or opt.bible_dir/".corpus_stats.json")
+    trace = JobTrace(opt.trace_interval)
+    job_builders = {"fb": add_fb_jobs, "nlm": add_nlm_jobs, "vecmap": add_vecmap_jobs, "procrustes": add_procrustes_jobs}
+    add_jobs = job_builders.get(opt.algorithm)
+    if add_jobs == None:
         print("Could not retrieve task function")
         return
-    align_tasks = [asyncio.create_task(task_function(lang, device_set, opt)) for lang in opt.langs]
-    await asyncio.gather(*align_tasks)
+    opt.align_dir.mkdir(parents=True, exist_ok=True)
+    if opt.algorithm != "nlm":
+        opt.emb_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        opt.nlm_preproc_dir.mkdir(parents=True, exist_ok=True)
+    dag = JobDAG(opt.state_file or opt.align_dir/".align_state.json", trace)
+    for lang in opt.langs:
+        add_jobs(dag, lang, resource_pool, emb_cache, trace, opt)
+    try:
+        status = await dag.run()
+    finally:
+        if trace.processes or trace.jobs:
+            trace_dir = opt.trace_dir or opt.align_dir/"traces"
+            trace_name = f"align_{time.strftime('%Y%m%d-%H%M%S', time.localtime(trace.started))}"
+            trace.write_chrome_trace(trace_dir/f"{trace_name}.json", dag.deps())
+            summary = trace.summary(resource_pool.num_cores, resource_pool.num_gpus, dag.deps())
+            (trace_dir/f"{trace_name}.txt").write_text(summary + "\n")
+            print(summary)
+            print(f"Trace written to {trace_dir/trace_name}.json")
+    for name, job_status in status.items():
+        if job_status == "skipped":
+            print(f"Skip {name} as already done")
+    failed = [name for name, job_status in status.items() if job_status in ("failed", "blocked")]
+    if failed:
+        print(f"{len(failed)} of {len(status)} jobs did not complete: {', '.join(failed)}")
 
 if __name__ == "__main__":
     asyncio.run(main())
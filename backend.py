@@ -0,0 +1,64 @@
+import os
+import numpy
+import profiling
+
+# Array library used for the embedding matrices. numpy runs everywhere,
+# cupy keeps the whole pipeline on one GPU.
+BACKENDS = ["numpy", "cupy", "auto"]
+BACKEND_ENV_VAR = "EMO_LEX_BACKEND"
+
+_xp = None
+
+def cupy_available():
+    try:
+        import cupy
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        return False
+
+def set_backend(name=None):
+    global _xp
+    name = name or os.environ.get(BACKEND_ENV_VAR) or "numpy"
+    if name not in BACKENDS:
+        raise ValueError("Unknown array backend %s, expected one of %s" % (name, ", ".join(BACKENDS)))
+    if name == "auto":
+        name = "cupy" if cupy_available() else "numpy"
+    if name == "cupy":
+        import cupy
+        _xp = cupy
+    else:
+        _xp = numpy
+    return _xp
+
+def get_xp():
+    if _xp is None:
+        set_backend()
+    return _xp
+
+def backend_name():
+    return get_xp().__name__
+
+def get_array_module(*arrays):
+    for x in arrays:
+        if type(x).__module__.startswith("cupy"):
+            import cupy
+            return cupy
+    return numpy
+
+def to_device(x):
+    xp = get_xp()
+    if xp is not numpy and not type(x).__module__.startswith("cupy"):
+        profiling.count("h2d_transfers")
+        profiling.count("h2d_bytes", numpy.asarray(x).nbytes)
+    return xp.asarray(x)
+
+def to_host(x):
+    if type(x).__module__.startswith("cupy"):
+        profiling.count("d2h_transfers")
+        profiling.count("d2h_bytes", x.nbytes)
+        return x.get()
+    return numpy.asarray(x)
+
+def add_backend_argument(parser):
+    parser.add_argument("--backend", choices=BACKENDS, default=None,
+                        help="Array backend, defaults to $%s or numpy" % BACKEND_ENV_VAR)
@@ -0,0 +1,366 @@
+import io
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import argparse
+import contextlib
+import platform
+import subprocess
+import numpy as np
+import profiling
+from pathlib import Path
+from backend import set_backend
+from eval_utils import load_vectors, load_lexicon, compute_csls_scores, compute_csls_topk, compute_csls_maps
+from nns_format import save_nns_binary, save_nns_tsv, nns_binary_path
+from vec_parser import read_vec_file, parse_vec_parallel
+from create_emos_utils import load_trans_file, get_emo_ratings, get_all_emo_ratings
+
+parser = argparse.ArgumentParser(description="Benchmarks of the evaluation hot paths on synthetic data")
+parser.add_argument("--sizes", type=str, nargs="+", default=["10000x100", "50000x300"],
+                    help="Synthetic data sizes as <words>x<dim>, e.g. 10000x100 100000x300 500000x300")
+parser.add_argument("--benchmarks", type=str, nargs="+", default=None, help="Benchmarks to run, defaults to all")
+parser.add_argument("--data_dir", type=Path, default=Path(".bench_data"), help="Where the synthetic data is generated, reused by later runs")
+parser.add_argument("--history", type=Path, default=None, help="JSON file the results of every run are appended to, defaults to <data_dir>/history.json")
+parser.add_argument("--repeat", type=int, default=3, help="Timed runs of every benchmark, the fastest one counts")
+parser.add_argument("--threshold", type=float, default=0.2, help="Fail when a benchmark is this much slower than its baseline")
+parser.add_argument("--min_delta_s", type=float, default=0.005, help="Ignore slowdowns smaller than this many seconds, which are timer noise")
+parser.add_argument("--rss_threshold", type=float, default=0.2, help="Fail when the memory growth of a benchmark is this much above its baseline")
+parser.add_argument("--baseline_runs", type=int, default=5, help="Number of earlier runs on this host whose median is the baseline")
+parser.add_argument("--max_csls_words", type=int, default=50000, help="Skip the quadratic CSLS benchmarks above this vocabulary size")
+parser.add_argument("--csls_queries", type=int, default=1000, help="Source words scored by compute_csls_scores, which holds their full similarity matrix")
+parser.add_argument("--no_record", action="store_true", help="Compare against the history without appending this run")
+parser.add_argument("--no_check", action="store_true", help="Skip the equivalence checks")
+parser.add_argument("--seed", type=int, default=0)
+
+EMOTIONS = ["anger", "fear", "joy", "sadness"]
+NUM_TRANSLATIONS = 10
+
+def parse_size(size):
+    n, d = size.lower().split("x")
+    return int(n), int(d)
+
+def write_vec(fname, words, x):
+    with io.open(fname, "w", encoding="utf-8", newline="\n") as f:
+        f.write("%d %d\n" % x.shape)
+        for start in range(0, len(words), 10000):
+            block = x[start:start + 10000]
+            rows = (" ".join(["%s"] + ["%.5f"] * x.shape[1]) % ((w,) + tuple(v)) for w, v in zip(words[start:], block))
+            f.write("\n".join(rows) + "\n")
+
+def generate(data_dir, n, d, seed=0):
+    # Embedding pair, test dictionary, translations and an English emotion
+    # lexicon for n words of dimension d. Source word i is a noisy copy of
+    # target word i so that the neighbours are meaningful.
+    size_dir = data_dir/f"{n}x{d}"
+    paths = {
+        "src_emb": size_dir/"src.vec",
+        "tgt_emb": size_dir/"tgt.vec",
+        "dico": size_dir/"dico.txt",
+        "trans_tsv": size_dir/"trans.txt",
+        "trans_bin": size_dir/"trans_bin.txt",
+        "emo_lex": size_dir/"eng.txt",
+        "vec_cache": size_dir/"cache",
+    }
+    if (size_dir/"done.json").exists():
+        return paths
+    size_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Generating {n}x{d} data in {size_dir}")
+    rng = np.random.default_rng(seed)
+    words_src = [f"s{i}" for i in range(n)]
+    words_tgt = [f"t{i}" for i in range(n)]
+    x_tgt = rng.standard_normal((n, d), dtype=np.float32)
+    x_src = x_tgt + 1.5 * rng.standard_normal((n, d), dtype=np.float32)
+    write_vec(paths["src_emb"], words_src, x_src)
+    write_vec(paths["tgt_emb"], words_tgt, x_tgt)
+    with open(paths["dico"], "w") as f:
+        f.writelines(f"s{i}\tt{i}\n" for i in range(0, n, 3))
+    # Every source word gets the right translation among random ones
+    tgt_idx = rng.integers(0, n, size=(n, NUM_TRANSLATIONS), dtype=np.int32)
+    tgt_idx[np.arange(n), rng.integers(0, NUM_TRANSLATIONS, size=n)] = np.arange(n)
+    scores = np.sort(rng.random((n, NUM_TRANSLATIONS), dtype=np.float32), axis=1)[:, ::-1].copy()
+    arrays = {
+        "src_idx": np.arange(n, dtype=np.int32),
+        "tgt_idx": tgt_idx,
+        "scores": scores,
+        "correct": np.ones(n, dtype=np.int8),
+    }
+    save_nns_tsv(paths["trans_tsv"], arrays, words_src, words_tgt)
+    save_nns_binary(nns_binary_path(paths["trans_bin"]), arrays, words_src, words_tgt)
+    with open(paths["emo_lex"], "w") as f:
+        f.write("word\temotion\trating\n")
+        for emotion in EMOTIONS:
+            ratings = np.round(rng.random(n // 2), 3)
+            ratings[::25] = 0.0
+            f.writelines(f"t{2 * i}\t{emotion}\t{r}\n" for i, r in enumerate(ratings.tolist()))
+    (size_dir/"done.json").write_text(json.dumps({"n": n, "dim": d, "seed": seed}))
+    return paths
+
+def load_emo_lex(filename):
+    emo_lex = {emotion: {} for emotion in EMOTIONS}
+    with open(filename) as f:
+        f.readline()
+        for line in f:
+            word, emotion, rating = line.rstrip("\n").split("\t")
+            emo_lex[emotion][word] = float(rating)
+    return emo_lex
+
+class Data:
+    # Inputs of the benchmarks of one size, loaded once on first use
+    def __init__(self, paths, n, d):
+        self.paths = paths
+        self.n = n
+        self.d = d
+        self._loaded = {}
+
+    def get(self, name):
+        if name not in self._loaded:
+            self._loaded[name] = getattr(self, f"_load_{name}")()
+        return self._loaded[name]
+
+    def _load_vectors(self):
+        load = lambda f: load_vectors(str(f), maxload=0, verbose=False, cache_dir=str(self.paths["vec_cache"]))
+        return load(self.paths["src_emb"]), load(self.paths["tgt_emb"])
+
+    def _load_lexicon(self):
+        (words_src, _), (words_tgt, _) = self.get("vectors")
+        return load_lexicon(str(self.paths["dico"]), words_src, words_tgt, verbose=False)[0]
+
+    def _load_translations(self):
+        return load_trans_file(str(self.paths["trans_bin"]))
+
+    def _load_emo_lex(self):
+        return load_emo_lex(self.paths["emo_lex"])
+
+# Every benchmark takes the Data of a size and returns the function to time
+# and the number of items it processes, or None to skip the size
+
+def bench_load_vectors_text(data, opt):
+    return lambda: load_vectors(str(data.paths["src_emb"]), maxload=0, verbose=False, use_cache=False), data.n
+
+def bench_load_vectors_cached(data, opt):
+    data.get("vectors")
+    return lambda: load_vectors(str(data.paths["src_emb"]), maxload=0, verbose=False,
+                                cache_dir=str(data.paths["vec_cache"])), data.n
+
+def bench_load_lexicon(data, opt):
+    (words_src, _), (words_tgt, _) = data.get("vectors")
+    return lambda: load_lexicon(str(data.paths["dico"]), words_src, words_tgt, verbose=False), len(range(0, data.n, 3))
+
+def bench_compute_csls_scores(data, opt):
+    if data.n > opt.max_csls_words:
+        return None
+    (_, x_src), (_, x_tgt) = data.get("vectors")
+    idx_src = list(range(min(opt.csls_queries, data.n)))
+    return lambda: compute_csls_scores(x_src.copy(), x_tgt.copy(), idx_src), len(idx_src)
+
+def bench_compute_csls_maps(data, opt):
+    if data.n > opt.max_csls_words:
+        return None
+    (words_src, x_src), (_, x_tgt) = data.get("vectors")
+    lexicon = data.get("lexicon")
+    return lambda: compute_csls_maps(x_src.copy(), words_src, x_tgt.copy(), lexicon, set(), 3), data.n
+
+def bench_load_trans_file_tsv(data, opt):
+    return lambda: load_trans_file(str(data.paths["trans_tsv"])), data.n
+
+def bench_load_trans_file_binary(data, opt):
+    return lambda: load_trans_file(str(data.paths["trans_bin"])), data.n
+
+def bench_get_emo_ratings(data, opt):
+    trans, _, _ = data.get("translations")
+    emo_lex = data.get("emo_lex")
+    return lambda: [get_emo_ratings(trans, emo_lex[emotion]) for emotion in EMOTIONS], data.n * len(EMOTIONS)
+
+def bench_get_all_emo_ratings(data, opt):
+    trans, _, tgt_vocab = data.get("translations")
+    emo_lex = data.get("emo_lex")
+    return lambda: get_all_emo_ratings(trans, emo_lex, EMOTIONS, tgt_vocab), data.n * len(EMOTIONS)
+
+BENCHMARKS = {
+    "load_vectors_text": bench_load_vectors_text,
+    "load_vectors_cached": bench_load_vectors_cached,
+    "load_lexicon": bench_load_lexicon,
+    "compute_csls_scores": bench_compute_csls_scores,
+    "compute_csls_maps": bench_compute_csls_maps,
+    "load_trans_file_tsv": bench_load_trans_file_tsv,
+    "load_trans_file_binary": bench_load_trans_file_binary,
+    "get_emo_ratings": bench_get_emo_ratings,
+    "get_all_emo_ratings": bench_get_all_emo_ratings,
+}
+
+# Equivalence checks: every faster path against the reference it replaced.
+# Each raises AssertionError when the outputs differ.
+
+def check_vector_cache(data, opt):
+    words_text, x_text = load_vectors(str(data.paths["src_emb"]), maxload=0, verbose=False, use_cache=False)
+    (words_cached, x_cached), _ = data.get("vectors")
+    assert list(words_text) == list(words_cached), "cached vocabulary differs from the .vec file"
+    np.testing.assert_array_equal(x_text, x_cached, "cached vectors differ from the .vec file")
+
+def check_vec_parser(data, opt):
+    # Parallel reader against the serial one, whole and cut by maxload
+    fname = str(data.paths["src_emb"])
+    for dtype in (np.float64, np.float32):
+        for maxload in (0, data.n // 3):
+            words_serial, x_serial, _, _ = read_vec_file(fname, maxload=maxload, workers=1, dtype=dtype)
+            words_parallel, x_parallel, _, _ = parse_vec_parallel(fname, maxload=maxload, workers=2, dtype=dtype)
+            assert words_serial == words_parallel, f"parallel vocabulary differs from the serial reader ({np.dtype(dtype)}, maxload {maxload})"
+            np.testing.assert_array_equal(x_serial, x_parallel, f"parallel vectors differ from the serial reader ({np.dtype(dtype)}, maxload {maxload})")
+
+def check_csls_topk(data, opt):
+    # Tiled top-k against the dense compute_csls_scores matrix
+    if data.n > opt.max_csls_words:
+        return
+    (_, x_src), (_, x_tgt) = data.get("vectors")
+    idx_src = list(range(min(opt.csls_queries, data.n)))
+    dense = compute_csls_scores(x_src.copy(), x_tgt.copy(), idx_src)
+    scores, nn = compute_csls_topk(x_src.copy(), x_tgt.copy(), idx_src, acc_at=1)
+    np.testing.assert_allclose(scores[:, 0], dense.max(axis=1), rtol=0, atol=1e-4,
+                               err_msg="tiled CSLS scores differ from compute_csls_scores")
+    # Ties can only change the winner between near-equal scores
+    picked = np.take_along_axis(dense, nn[:, :1], axis=1)[:, 0]
+    np.testing.assert_allclose(picked, dense.max(axis=1), rtol=0, atol=1e-4,
+                               err_msg="tiled CSLS neighbours differ from compute_csls_scores")
+
+def check_trans_formats(data, opt):
+    trans_tsv, src_tsv, tgt_tsv = load_trans_file(str(data.paths["trans_tsv"]))
+    trans_bin, src_bin, tgt_bin = load_trans_file(str(data.paths["trans_bin"]))
+    assert trans_tsv == trans_bin, "binary translations differ from the TSV"
+    assert list(src_tsv) == list(src_bin) and list(tgt_tsv) == list(tgt_bin), "translation vocabularies differ"
+
+def check_emo_ratings(data, opt):
+    trans, src_vocab, tgt_vocab = data.get("translations")
+    emo_lex = data.get("emo_lex")
+    ratings, derived = get_all_emo_ratings(trans, emo_lex, EMOTIONS, tgt_vocab)
+    for j, emotion in enumerate(EMOTIONS):
+        reference = get_emo_ratings(trans, emo_lex[emotion])
+        ids = src_vocab.ids(reference.keys())
+        assert derived[:, j].sum() == len(reference), f"{emotion}: derived words differ from get_emo_ratings"
+        assert derived[ids, j].all(), f"{emotion}: derived words differ from get_emo_ratings"
+        np.testing.assert_array_equal(ratings[ids, j], np.fromiter(reference.values(), dtype=float, count=len(reference)),
+                                      f"{emotion}: ratings differ from get_emo_ratings")
+
+CHECKS = {
+    "vector_cache": check_vector_cache,
+    "vec_parser": check_vec_parser,
+    "csls_topk": check_csls_topk,
+    "trans_formats": check_trans_formats,
+    "emo_ratings": check_emo_ratings,
+}
+
+def measure(run, repeat):
+    # Fastest of repeat runs, and the peak RSS and RSS growth over all of them
+    times = []
+    profiling.enable()
+    try:
+        for _ in range(repeat):
+            gc.collect()
+            with profiling.timer("run"), contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+    finally:
+        timer = profiling.disable().to_dict()["timers"]["run"]
+    return {
+        "best_s": round(min(times), 6),
+        "median_s": round(float(np.median(times)), 6),
+        "peak_rss_mb": timer["peak_rss_mb"],
+        "peak_growth_mb": timer["peak_growth_mb"],
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def load_history(filename):
+    if not filename.exists():
+        return []
+    return json.loads(filename.read_text())
+
+def find_regressions(history, results, host, opt):
+    # Benchmarks slower, or growing more memory, than the median of their
+    # last baseline_runs results on this host by more than the threshold
+    regressions = []
+    for key, result in results.items():
+        past = [run["results"][key] for run in history if run.get("host") == host and key in run["results"]]
+        past = past[-opt.baseline_runs:]
+        if not past:
+            continue
+        base_s = float(np.median([p["best_s"] for p in past]))
+        if result["best_s"] > base_s * (1 + opt.threshold) and result["best_s"] - base_s > opt.min_delta_s:
+            regressions.append(f"{key}: {result['best_s']:.4f}s vs baseline {base_s:.4f}s (+{100 * (result['best_s'] / base_s - 1):.0f}%)")
+        base_mb = float(np.median([p["peak_growth_mb"] for p in past]))
+        # Growth below a few MB is noise
+        if result["peak_growth_mb"] > max(base_mb * (1 + opt.rss_threshold), base_mb + 4):
+            regressions.append(f"{key}: RSS growth {result['peak_growth_mb']:.1f} MB vs baseline {base_mb:.1f} MB")
+    return regressions
+
+def main(opt):
+    set_backend("numpy")
+    names = opt.benchmarks or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("Unknown benchmarks %s, expected some of %s" % (", ".join(unknown), ", ".join(BENCHMARKS)))
+    results = {}
+    failed_checks = []
+    header = f"{'benchmark':<24} {'size':>12} {'best_s':>9} {'median_s':>9} {'items/s':>12} {'peak_rss_mb':>11} {'growth_mb':>9}"
+    for size in opt.sizes:
+        n, d = parse_size(size)
+        data = Data(generate(opt.data_dir, n, d, opt.seed), n, d)
+        print(header)
+        print("-" * len(header))
+        for name in names:
+            bench = BENCHMARKS[name](data, opt)
+            if bench is None:
+                print(f"{name:<24} {size:>12} {'skipped':>9}")
+                continue
+            run, items = bench
+            result = measure(run, opt.repeat)
+            result.update({"n": n, "dim": d, "items": items, "items_per_s": round(items / result["best_s"], 1)})
+            results[f"{name}@{size}"] = result
+            print(f"{name:<24} {size:>12} {result['best_s']:>9.4f} {result['median_s']:>9.4f} {result['items_per_s']:>12,.0f} "
+                  f"{result['peak_rss_mb']:>11.1f} {result['peak_growth_mb']:>9.1f}")
+        if not opt.no_check:
+            for name, check in CHECKS.items():
+                try:
+                    check(data, opt)
+                    print(f"Check {name}@{size}: ok")
+                except AssertionError as e:
+                    failed_checks.append(f"{name}@{size}: {e}")
+                    print(f"Check {name}@{size}: FAILED {e}")
+        print()
+
+    host = socket.gethostname()
+    opt.history = opt.history or opt.data_dir/"history.json"
+    history = load_history(opt.history)
+    regressions = find_regressions(history, results, host, opt)
+    if not opt.no_record:
+        history.append({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "host": host,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "results": results,
+            "regressions": regressions,
+            "failed_checks": failed_checks,
+        })
+        opt.history.parent.mkdir(parents=True, exist_ok=True)
+        tmp = opt.history.with_name(f"{opt.history.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(history, indent=2))
+        os.replace(tmp, opt.history)
+    for regression in regressions:
+        print("Regression:", regression)
+    if regressions or failed_checks:
+        print(f"{len(regressions)} regressions, {len(failed_checks)} failed checks")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -1,6 +1,11 @@
 import io
 import argparse
+import profiling
+from profiling import add_profile_argument
 from eval_utils import *
+from nns_format import nns_arrays, nns_binary_path, save_nns_binary, save_nns_tsv
+from backend import set_backend, add_backend_argument, backend_name
+from csls_shard import set_workers, add_workers_argument
 
 parser = argparse.ArgumentParser(description='Computation of nearest neighbors')
 parser.add_argument("--src_emb", type=str, default='', help="Load source embeddings")
@@ -9,15 +14,23 @@ parser.add_argument('--center', action='store_true', help='whether to center emb
 parser.add_argument("--dico_test", type=str, default='', help="test dictionary")
 parser.add_argument("--nn_words", type=str, default='', help="Words to get nearest neighbours for")
 parser.add_argument("--maxload", type=int, default=200000)
-parser.add_argument("--nns_file", type=str, default='', help="Path to save nearest neighbours")
-params = parser.parse_args()
+parser.add_argument("--dtype", choices=DTYPES, default="float32", help="Floating point precision of the embeddings")
+parser.add_argument("--tile_mb", type=int, default=DEFAULT_TILE_BYTES >> 20, help="Memory budget in MB for one block of CSLS similarities")
+parser.add_argument("--penalty_cache_dir", type=str, default='', help="Directory for cached CSLS penalties, defaults to csls_cache next to the target embeddings")
+parser.add_argument("--no_penalty_cache", action='store_true', help="Always recompute CSLS penalties")
+parser.add_argument("--nns_file", type=str, default='', help="Path to save nearest neighbours, the binary file is written with a .nns.npz suffix")
+parser.add_argument("--tsv", action='store_true', help="Also write the nearest neighbours as TSV to --nns_file")
+add_backend_argument(parser)
+add_workers_argument(parser)
+add_profile_argument(parser)
 
-def save_nns(filename, nns, words_src, words_tgt):
-    fout = io.open(filename, "w", encoding="utf-8")
-    for src_idx, (tgt_idx, scores, correct) in nns.items():
-        tgt_words = ",".join((words_tgt[int(idx)] for idx in tgt_idx))
-        fout.write("%s\t%s\t%s\t%d\n" % (words_src[int(src_idx)], tgt_words, ",".join(map(lambda s: str(s.round(4)), scores)), int(correct)))
-    fout.close()
+@profiling.timed()
+def save_nns(filename, nns, words_src, words_tgt, tsv=False):
+    # The binary file is what the emotion stages read, the TSV is for humans
+    arrays = nns_arrays(nns)
+    save_nns_binary(nns_binary_path(filename), arrays, words_src, words_tgt)
+    if tsv:
+        save_nns_tsv(filename, arrays, words_src, words_tgt)
 
 def load_nn_words(filename):
     fin = io.open(filename, "r", encoding="utf-8")
@@ -25,17 +38,36 @@ def load_nn_words(filename):
     fin.close()
     return nn_words
 
-print("Computing nearest neighbours based on %s" % params.dico_test)
+@profiling.timed()
+def compute_nns(x_src, words_src, x_tgt, words_tgt, nns_file, dico_test='', nn_words=None,
+                tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None, tsv=False):
+    src2tgt = None
+    if dico_test != '':
+        src2tgt, lexicon_size = load_lexicon(dico_test, words_src, words_tgt)
+    nns = compute_csls_maps(x_src, words_src, x_tgt, src2tgt, nn_words or set(), 3, k=10, tile_bytes=tile_bytes, penalty_cache=penalty_cache)
+    save_nns(nns_file, nns, words_src, words_tgt, tsv=tsv)
+    return nns
 
-words_tgt, x_tgt = load_vectors(params.tgt_emb, maxload=params.maxload, center=params.center)
-words_src, x_src = load_vectors(params.src_emb, maxload=params.maxload, center=params.center)
+def main(params):
+    set_backend(params.backend)
+    set_workers(params.workers)
+    print("Computing nearest neighbours based on %s (%s backend)" % (params.dico_test, backend_name()))
 
-nn_words = set()
-if params.nn_words:
-    nn_words = load_nn_words(params.nn_words)
+    words_tgt, x_tgt = load_vectors(params.tgt_emb, maxload=params.maxload, center=params.center, dtype=params.dtype)
+    words_src, x_src = load_vectors(params.src_emb, maxload=params.maxload, center=params.center, dtype=params.dtype)
 
-src2tgt = None
-if params.dico_test != '':
-    src2tgt, lexicon_size = load_lexicon(params.dico_test, words_src, words_tgt)
-nns = compute_csls_maps(x_src, words_src, x_tgt, src2tgt, nn_words, 3, k=10)
-save_nns(params.nns_file, nns, words_src, words_tgt)
+    nn_words = set()
+    if params.nn_words:
+        nn_words = load_nn_words(params.nn_words)
+
+    penalty_cache = None
+    if not params.no_penalty_cache:
+        penalty_cache = csls_penalty_cache(params.src_emb, params.tgt_emb, params.maxload, params.center, params.dtype,
+                                           cache_dir=params.penalty_cache_dir or None)
+    compute_nns(x_src, words_src, x_tgt, words_tgt, params.nns_file, params.dico_test, nn_words,
+                tile_bytes=params.tile_mb << 20, penalty_cache=penalty_cache, tsv=params.tsv)
+
+if __name__ == "__main__":
+    params = parser.parse_args()
+    with profiling.profile_to(params.profile_file):
+        main(params)
@@ -0,0 +1,87 @@
+import os
+import json
+import collections
+from pathlib import Path
+
+# Bump when the statistics of a file change for the same contents
+CORPUS_STATS_VERSION = 1
+# Frequency thresholds tried for fastText's -minCount, largest first
+MIN_COUNTS = (5, 4, 3, 2)
+
+def read_vec_count(fname):
+    # Number of vectors in a .vec file, from its header line
+    with open(fname, "rb") as f:
+        return int(f.readline().split()[0])
+
+def scan_corpus(fname):
+    # Line, token and type counts and the frequency histogram of a
+    # whitespace tokenised text, in one streaming pass
+    counts = collections.Counter()
+    lines = 0
+    with open(fname, "rb") as f:
+        for line in f:
+            lines += 1
+            counts.update(line.split())
+    histogram = collections.Counter(counts.values())
+    return {
+        "lines": lines,
+        "tokens": sum(counts.values()),
+        "types": len(counts),
+        # Number of types seen exactly c times, by c
+        "histogram": {str(c): n for c, n in sorted(histogram.items())},
+    }
+
+class CorpusStats:
+    def __init__(self, lines, tokens, types, histogram):
+        self.lines = lines
+        self.tokens = tokens
+        self.types = types
+        self.histogram = {int(c): n for c, n in histogram.items()}
+
+    def vocab_size(self, min_count=1):
+        # Types seen at least min_count times, the vocabulary fastText keeps
+        # for -minCount min_count, without its end of line token
+        return sum(n for c, n in self.histogram.items() if c >= min_count)
+
+    def min_count(self, min_vocab):
+        # Largest threshold of MIN_COUNTS that keeps at least min_vocab types,
+        # the smallest one when none does
+        for min_count in MIN_COUNTS:
+            if self.vocab_size(min_count) >= min_vocab:
+                return min_count
+        return MIN_COUNTS[-1]
+
+class CorpusStatsIndex:
+    # Statistics of the Bible texts by path, stored in one JSON file and
+    # rescanned only when a file's size or mtime changes
+    def __init__(self, index_file):
+        self.index_file = Path(index_file)
+        self._entries = {}
+        if self.index_file.exists():
+            try:
+                index = json.loads(self.index_file.read_text())
+                if index.get("version") == CORPUS_STATS_VERSION:
+                    self._entries = index["files"]
+            except (ValueError, KeyError):
+                self._entries = {}
+
+    def get(self, fname):
+        # CorpusStats of fname, None when it does not exist
+        path = str(Path(fname).resolve())
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        entry = self._entries.get(path)
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, **scan_corpus(path)}
+            self._entries[path] = entry
+            self._save()
+        return CorpusStats(entry["lines"], entry["tokens"], entry["types"], entry["histogram"])
+
+    def _save(self):
+        self.index_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = "%s.%d.tmp" % (self.index_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"version": CORPUS_STATS_VERSION, "files": self._entries}, f)
+        os.replace(tmp, self.index_file)
@@ -1,43 +1,56 @@
 import io
 import argparse
+import numpy as np
+import profiling
+from profiling import add_profile_argument
 from collections import defaultdict
-from create_emos_utils import load_trans_file, get_emo_ratings
+from vocab import as_vocabulary
+from create_emos_utils import load_trans_file, get_all_emo_ratings, translation_strings
 
 parser = argparse.ArgumentParser(description='Creation of derived emotion lexicon')
 parser.add_argument("--trans_file", type=str, default='', help="Load translations file")
 parser.add_argument("--emo_lex", type=str, default='', help="Load emotion lexicon")
 parser.add_argument("--induct_emos_file", type=str, default='', help="File to write induced emotions to")
-params = parser.parse_args()
+add_profile_argument(parser)
 
+@profiling.timed()
 def load_emo_lex(emo_lex_file, words):
     fin = io.open(emo_lex_file, "r", encoding="utf-8")
     fin.readline()
+    rows = [line.split("\t") for line in fin]
+    fin.close()
+    known = (as_vocabulary(words).ids(row[0] for row in rows) >= 0).tolist()
     emo_lex = defaultdict(dict)
-    for line in fin:
-        word, emotion, rating = line.split("\t")
+    for (word, emotion, rating), k in zip(rows, known):
         rating = float(rating)
-        if word in words:
+        if k:
             emo_lex[emotion][word] = rating
-    fin.close()
     return emo_lex
 
-def create_emo_lex(derived_emo_lex, trans, induct_emos_file, emotion):
-    print("Number of derived emotion ratings:", len(derived_emo_lex))
-    trans = {word_src: tgt_words for word_src, tgt_words in trans}
-    for word, emo in derived_emo_lex.items():
-        translations = ",".join([t[0] for t in trans[word]])
-        induct_emos_file.write(f"{word}\t{translations}\t{emotion}\t{emo}\n")
+def create_emo_lex(words, translations, ratings, derived, induct_emos_file, emotion):
+    print("Number of derived emotion ratings:", int(derived.sum()))
+    for i in np.flatnonzero(derived).tolist():
+        induct_emos_file.write(f"{words[i]}\t{translations[i]}\t{emotion}\t{ratings[i]}\n")
 
-if __name__ == "__main__":
+@profiling.timed()
+def create_emotions(translations, emo_lex_tgt, induct_emos_file, tgt_vocab=None):
+    emotions = list(emo_lex_tgt.keys())
+    ratings, derived = get_all_emo_ratings(translations, emo_lex_tgt, emotions, tgt_vocab)
+    words = [word_src for word_src, tgt_words in translations]
+    trans_strings = translation_strings(translations)
+    with open(induct_emos_file, "w") as induct_emos_out:
+        for j, emotion in enumerate(emotions):
+            print("\nStats for emotion:", emotion)
+            create_emo_lex(words, trans_strings, ratings[:, j].tolist(), derived[:, j], induct_emos_out, emotion)
+
+def main(params):
     print("Creation of emotion ratings using %s" % params.trans_file)
 
     translations, src_words, tgt_words = load_trans_file(params.trans_file)
     emo_lex_tgt = load_emo_lex(params.emo_lex, tgt_words)
-    report = []
+    create_emotions(translations, emo_lex_tgt, params.induct_emos_file, tgt_vocab=tgt_words)
 
-    with open(params.induct_emos_file, "w") as induct_emos_file:
-        for emotion in emo_lex_tgt.keys():
-            print("\nStats for emotion:", emotion)
-            single_emo_lex_tgt = emo_lex_tgt[emotion]
-            derived_emo_lex_src = get_emo_ratings(translations, single_emo_lex_tgt)
-            create_emo_lex(derived_emo_lex_src, translations, induct_emos_file, emotion)
+if __name__ == "__main__":
+    params = parser.parse_args()
+    with profiling.profile_to(params.profile_file):
+        main(params)
@@ -1,10 +1,23 @@
 import io
+import os
+import numpy as np
+import profiling
+from nns_format import nns_binary_path, nns_arrays, load_nns_binary
+from vocab import Vocabulary
 
+@profiling.timed()
 def load_trans_file(filename):
+    # Reads the binary neighbours file written by compute_nns when it
+    # exists, the TSV otherwise. Returns the translations with the
+    # vocabulary of their source words, in row order, and of the target
+    # words they use.
+    binary_file = nns_binary_path(filename)
+    if os.path.exists(binary_file):
+        arrays = load_nns_binary(binary_file)
+        return translations_from_arrays(arrays, arrays["words_src"], arrays["words_tgt"])
     fin = io.open(filename, "r", encoding="utf-8")
     trans = []
-    src_word_set = set()
-    tgt_word_set = set()
+    tgt_word_ids = {}
     for line in fin:
         line = line.strip().split("\t")
         word_src = line[0].strip()
@@ -12,12 +25,79 @@ def load_trans_file(filename):
         scores = map(float, line[2].strip().split(","))
 
         trans.append([word_src, list(zip(tgt_words, scores))])
-        src_word_set.add(word_src)
-        tgt_word_set.update(tgt_words)
+        for tgt_word in tgt_words:
+            tgt_word_ids.setdefault(tgt_word, len(tgt_word_ids))
     fin.close()
-    return trans, src_word_set, tgt_word_set
+    profiling.count("rows_parsed", len(trans))
+    return trans, Vocabulary(word_src for word_src, _ in trans), Vocabulary(tgt_word_ids)
+
+@profiling.timed()
+def translations_from_arrays(arrays, words_src, words_tgt):
+    # Scores are rounded as in the TSV written by compute_nns: in float32,
+    # which decides the halfway cases, then again in float64 to get the
+    # value the TSV text parses to
+    src_words = [words_src[i] for i in arrays["src_idx"].tolist()]
+    tgt_words = [[words_tgt[i] for i in row] for row in arrays["tgt_idx"].tolist()]
+    scores = np.round(np.round(arrays["scores"], 4).astype(np.float64), 4).tolist()
+    trans = [[word_src, list(zip(tgt, sc))] for word_src, tgt, sc in zip(src_words, tgt_words, scores)]
+    profiling.count("translations_built", len(trans))
+    # Target ids in order of first use, as load_trans_file numbers them
+    used, first = np.unique(arrays["tgt_idx"].ravel(), return_index=True)
+    used = used[np.argsort(first)]
+    return trans, Vocabulary(src_words), Vocabulary(words_tgt[i] for i in used.tolist())
+
+def translations_from_nns(nns, words_src, words_tgt):
+    # Same structure as load_trans_file, built from compute_csls_maps output
+    return translations_from_arrays(nns_arrays(nns), words_src, words_tgt)
+
+def translation_matrix(trans, tgt_vocab=None):
+    # Source x target translation matrix in CSR form (indptr, indices) over
+    # tgt_vocab, the columns of every row in translation order
+    if tgt_vocab is None:
+        tgt_vocab = Vocabulary(dict.fromkeys(t[0] for _, tgt_words in trans for t in tgt_words))
+    lengths = np.fromiter((len(tgt_words) for _, tgt_words in trans), dtype=np.int64, count=len(trans))
+    indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    indices = tgt_vocab.ids(t[0] for _, tgt_words in trans for t in tgt_words)
+    if (indices < 0).any():
+        raise ValueError("Translations use target words that are not in the target vocabulary")
+    return indptr, indices, tgt_vocab
+
+def emotion_matrix(emo_lex, emotions, vocab):
+    # Vocabulary x emotions ratings. Missing and zero ratings are masked
+    # out, as `if emo:` does in get_emo_ratings
+    ratings = np.zeros((len(vocab), len(emotions)))
+    for j, emotion in enumerate(emotions):
+        lex = emo_lex.get(emotion, {})
+        ids = vocab.ids(lex.keys())
+        known = ids >= 0
+        ratings[ids[known], j] = np.fromiter(lex.values(), dtype=float, count=len(lex))[known]
+    return ratings, ratings != 0
+
+@profiling.timed()
+def get_all_emo_ratings(trans, emo_lex_tgt, emotions, tgt_vocab=None):
+    # get_emo_ratings for all emotions at once: the translation matrix times
+    # the target ratings, averaged over the translations that have a rating.
+    # Returns the source x emotions averages and the mask of derived ones.
+    indptr, indices, tgt_vocab = translation_matrix(trans, tgt_vocab)
+    ratings, rated = emotion_matrix(emo_lex_tgt, emotions, tgt_vocab)
+    lengths = np.diff(indptr)
+    sums = np.zeros((len(trans), len(emotions)))
+    counts = np.zeros((len(trans), len(emotions)))
+    # One translation rank at a time, so that ratings are summed in the
+    # same order as in get_emo_ratings and the averages are bit-identical
+    for rank in range(lengths.max(initial=0)):
+        rows = np.flatnonzero(lengths > rank)
+        cols = indices[indptr[rows] + rank]
+        sums[rows] += np.where(rated[cols], ratings[cols], 0.0)
+        counts[rows] += rated[cols]
+    derived = counts > 0
+    return np.divide(sums, counts, out=np.zeros_like(sums), where=derived), derived
+
+def translation_strings(trans):
+    return [",".join([t[0] for t in tgt_words]) for word_src, tgt_words in trans]
 
 def get_emo_ratings(trans, emo_lex_tgt):
+    # Reference implementation of one column of get_all_emo_ratings
     derived_emo_lex = {}
     for word_src, tgt_words in trans:
         emos = []
@@ -0,0 +1,203 @@
+import os
+import atexit
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy
+import profiling
+
+# Sharding of the blocked top-k sweeps of the CSLS code over worker
+# processes. The matrices live in shared memory: load_vectors places the
+# embeddings there once when workers are set, every other array a sweep reads
+# is copied there for that sweep only. A block is unlinked as soon as its
+# array is collected or released. Each worker maps the arrays by name,
+# takes a slice of the query rows and runs the same tiled loop on it, so the
+# merged rows are the ones a single process computes. numpy backend only.
+
+WORKERS_ENV_VAR = "EMO_LEX_WORKERS"
+# Sweeps below this many flops are not worth the round trip to the workers
+MIN_SHARD_FLOPS = 1 << 32
+SHARDS_PER_WORKER = 4
+BLAS_THREAD_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+_workers = 1
+_pool = None
+# id of a root array -> (weak reference to the array, its shared memory
+# block), dropped with the array so that its id is not mistaken for a later
+# array's
+_shared = {}
+
+def set_workers(n=None):
+    global _workers
+    if n is None:
+        n = int(os.environ.get(WORKERS_ENV_VAR) or 1)
+    if n < 0:
+        raise ValueError("Number of workers must not be negative, got %d" % n)
+    n = n or os.cpu_count()
+    if n != _workers:
+        stop_pool()
+    _workers = n
+    return n
+
+def get_workers():
+    return _workers
+
+def add_workers_argument(parser):
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes sharing the CSLS sweeps over shared memory, 0 for one per core, "
+                             "defaults to $%s or 1" % WORKERS_ENV_VAR)
+
+def use_workers(xp, flops):
+    return _workers > 1 and xp is numpy and flops >= MIN_SHARD_FLOPS
+
+def share(x, copy=False):
+    # Copy of the host array x in shared memory, which sweeps over x and its
+    # views hand to the workers without copying again. x itself when it is
+    # shared already, unless copy is set, or when there are no workers.
+    if _workers <= 1 or not isinstance(x, numpy.ndarray) or x.size == 0 or (not copy and _root(x) is not None):
+        return x.copy() if copy else x
+    # float16 is cast here, once, as the sweeps would otherwise send a new
+    # float32 copy (eval_utils.as_compute) to the workers every time
+    if x.dtype == numpy.float16:
+        x = x.astype(numpy.float32)
+    shm = shared_memory.SharedMemory(create=True, size=x.nbytes)
+    y = numpy.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)
+    y[...] = x
+    _shared[id(y)] = (weakref.ref(y), shm)
+    # The block can only be unmapped once no view of y is left, which is when
+    # y itself is collected
+    weakref.finalize(y, _free, id(y), shm).atexit = False
+    profiling.count("shared_bytes", x.nbytes)
+    return y
+
+def release(x):
+    # Unlinks the block x lives in now rather than when x is collected. x
+    # stays usable, later sweeps copy it like any other array.
+    root = _root(x)
+    if root is not None:
+        _unlink(id(root[0]))
+
+def _unlink(key):
+    entry = _shared.pop(key, None)
+    if entry is not None:
+        entry[1].unlink()
+
+def _free(key, shm):
+    if key in _shared and _shared[key][1] is shm:
+        _unlink(key)
+    shm.close()
+
+def _root(x):
+    base = x
+    while isinstance(base, numpy.ndarray):
+        entry = _shared.get(id(base))
+        if entry is not None and entry[0]() is base:
+            return base, entry[1]
+        base = base.base
+    return None
+
+def _address(x):
+    return x.__array_interface__["data"][0]
+
+def _spec(x, temp):
+    # Where a worker finds x: a shared block, the offset of x in it, its
+    # shape and strides. Arrays outside shared memory are copied to a new
+    # block that is appended to temp.
+    if x is None:
+        return None
+    root = _root(x)
+    if root is None:
+        x = numpy.ascontiguousarray(x)
+        shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+        numpy.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+        temp.append(shm)
+        return (shm.name, 0, x.shape, x.strides, x.dtype.str)
+    y, shm = root
+    return (shm.name, _address(x) - _address(y), x.shape, x.strides, x.dtype.str)
+
+def _attach(spec, attached):
+    name, offset, shape, strides, dtype = spec
+    if name not in attached:
+        attached[name] = shared_memory.SharedMemory(name=name)
+    return numpy.ndarray(shape, dtype=dtype, buffer=attached[name].buf, offset=offset, strides=strides)
+
+def _topk_shard(args):
+    # Blocks are mapped for one task only: a block released or collected in
+    # the parent is unlinked there, and its memory is only returned once no
+    # worker maps it any more
+    from eval_utils import topk_blocked_multi
+    q_spec, k_spec, topk, rankings, q_idx, start, end, bsz, tile_bytes = args
+    attached = {}
+    try:
+        x_q, x_k = _attach(q_spec, attached), _attach(k_spec, attached)
+        penalties = [None if p is None else _attach(p, attached) for _, p in rankings]
+        if q_idx is None:
+            x_q = x_q[start:end]
+        result = topk_blocked_multi(x_q, x_k, topk, [(scale, p) for (scale, _), p in zip(rankings, penalties)],
+                                    q_idx=q_idx, bsz=bsz, tile_bytes=tile_bytes)
+        # The views have to go before their blocks can be closed
+        del x_q, x_k, penalties
+        return result
+    finally:
+        for shm in attached.values():
+            try:
+                shm.close()
+            except BufferError:
+                # Still viewed from the traceback of a failed task, it is
+                # unmapped when that is collected
+                pass
+
+def get_pool():
+    # Workers are spawned rather than forked, so that they load BLAS afresh
+    # with their share of the cores instead of inheriting its thread pool
+    global _pool
+    if _pool is None:
+        threads = str(max(1, (os.cpu_count() or 1) // _workers))
+        saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+        for var in BLAS_THREAD_VARS:
+            os.environ.setdefault(var, threads)
+        try:
+            _pool = multiprocessing.get_context("spawn").Pool(_workers)
+        finally:
+            for var, value in saved.items():
+                if value is None:
+                    del os.environ[var]
+    return _pool
+
+@profiling.timed("topk_sharded")
+def topk_blocked_multi(x_q, x_k, topk, rankings, q_idx, bsz, tile_bytes, rows):
+    # eval_utils.topk_blocked_multi on shards of the query rows. Shards start
+    # on a multiple of rows, the tile height of the single process sweep, so
+    # that the workers walk the same tiles.
+    n_q = x_q.shape[0] if q_idx is None else len(q_idx)
+    tiles = -(-n_q // rows)
+    n_shards = min(tiles, _workers * SHARDS_PER_WORKER)
+    bounds = [min(n_q, rows * (tiles * s // n_shards)) for s in range(n_shards + 1)]
+    temp = []
+    try:
+        q_spec, k_spec = _spec(x_q, temp), _spec(x_k, temp)
+        ranking_specs = [(scale, _spec(penalty, temp)) for scale, penalty in rankings]
+        tasks = [(q_spec, k_spec, topk, ranking_specs, None if q_idx is None else numpy.asarray(q_idx[s:e]),
+                  s, e, bsz, tile_bytes) for s, e in zip(bounds[:-1], bounds[1:])]
+        shards = get_pool().map(_topk_shard, tasks)
+    finally:
+        for shm in temp:
+            shm.close()
+            shm.unlink()
+    profiling.count("shards", len(tasks))
+    return [(numpy.concatenate([shard[r][0] for shard in shards]), numpy.concatenate([shard[r][1] for shard in shards]))
+            for r in range(len(rankings))]
+
+def stop_pool():
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+
+@atexit.register
+def close():
+    # Stops the workers and unlinks the shared blocks at exit
+    stop_pool()
+    for key in list(_shared):
+        _unlink(key)
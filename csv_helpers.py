@@ -7,5 +7,5 @@ def read_csv_file(file_path):
 
 def write_all_rows(output_file_path, rows, mode='w'):
     with open(output_file_path, mode, encoding="utf-8", newline='') as output_file:
-        output_file_writer = csv.writer(output_file, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar="")
+        output_file_writer = csv.writer(output_file, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar=None)
         output_file_writer.writerows(rows)
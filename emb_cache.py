@@ -0,0 +1,70 @@
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+from pathlib import Path
+from eval_utils import file_checksum
+
+class EmbeddingCache:
+    # fastText embeddings stored under a hash of the training text and the
+    # skipgram hyperparameters, so that every algorithm and language reuses
+    # them. Concurrent requests for one key share a single training job.
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self._checksums = {}
+        self._inflight = {}
+        self._trained = set()
+
+    def checksum(self, fname):
+        st = os.stat(fname)
+        memo_key = (str(Path(fname).resolve()), st.st_size, st.st_mtime_ns)
+        if memo_key not in self._checksums:
+            self._checksums[memo_key] = file_checksum(fname)
+        return self._checksums[memo_key]
+
+    def key(self, input_file, params):
+        parts = {"input": self.checksum(input_file), "params": params}
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return self.cache_dir/key/"emb.vec"
+
+    async def get(self, input_file, params, train, force=False):
+        # Path of the embeddings of input_file. train(output_prefix) is a
+        # coroutine that writes <output_prefix>.vec and returns its exit
+        # code. force retrains an existing entry, once per key and process.
+        key = self.key(input_file, params)
+        if key in self._inflight:
+            return await self._inflight[key]
+        if self.path(key).is_file() and (not force or key in self._trained):
+            return self.path(key)
+        task = asyncio.ensure_future(self._train(key, input_file, params, train))
+        self._inflight[key] = task
+        try:
+            return await task
+        finally:
+            del self._inflight[key]
+
+    async def _train(self, key, input_file, params, train):
+        tmp = self.cache_dir/f"{key}.{os.getpid()}.tmp"
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+        try:
+            returncode = await train(tmp/"emb")
+            if returncode != 0 or not (tmp/"emb.vec").is_file():
+                raise RuntimeError(f"fastText training on {input_file} failed with exit code {returncode}")
+            for f in tmp.iterdir():
+                if f.name != "emb.vec":
+                    f.unlink()
+            meta = {"input": str(input_file), "checksum": self.checksum(input_file), "params": params}
+            (tmp/"meta.json").write_text(json.dumps(meta, indent=2))
+            entry = self.cache_dir/key
+            if entry.exists():
+                shutil.rmtree(entry)
+            tmp.rename(entry)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._trained.add(key)
+        return self.path(key)
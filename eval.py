@@ -1,6 +1,13 @@
+import io
 import argparse
+import contextlib
 import subprocess
+import concurrent.futures
 from pathlib import Path
+import json
+import profiling
+from stage_cache import StageCache, run_cached
+from nns_format import nns_binary_path
 
 parser = argparse.ArgumentParser()
 
@@ -15,6 +22,16 @@ parser.add_argument("--nns_dir", type=Path, required=True)
 parser.add_argument("--reports_dir", type=Path, required=True)
 
 parser.add_argument("--skip_eval", action="store_true")
+parser.add_argument("--dtype", choices=["float32", "float16", "float64"], default="float32")
+parser.add_argument("--nns_tsv", action="store_true", help="Also write derived word translations as TSV next to the binary files")
+parser.add_argument("--jobs", type=int, default=1, help="Number of languages to evaluate concurrently")
+parser.add_argument("--in_process", action="store_true", help="Run all stages of a language in this process instead of one subprocess per stage")
+parser.add_argument("--stage_cache_dir", type=Path, help="Directory for cached stage outputs, defaults to <reports_dir>/.stage_cache")
+parser.add_argument("--no_stage_cache", action="store_true", help="Do not read or write the stage cache")
+parser.add_argument("--force", action="store_true", help="Rerun every stage even if its inputs are unchanged")
+parser.add_argument("--backend", choices=["numpy", "cupy", "auto"], help="Array backend for the embedding stages, defaults to $EMO_LEX_BACKEND or numpy")
+parser.add_argument("--workers", type=int, help="Worker processes for the CSLS sweeps of eval_align and compute_nns, 0 for one per core")
+parser.add_argument("--profile", action="store_true", help="Write a profile of every language and a table of all of them to <reports_dir>/<exp_id>/profile")
 
 def create_expanded_path(path):
     path = Path(path)
@@ -28,94 +45,336 @@ nns_script = "compute_nns.py"
 eval_emos_script = "eval_emos.py"
 create_emos_script = "create_emos.py"
 
-if __name__ == "__main__":
-    opt = parser.parse_args()
-    report_file_loc = opt.reports_dir/opt.exp_id
-    mkdir(report_file_loc)
-    report_file = open(report_file_loc/"report.txt", "w")
-    log_file = open(report_file_loc/"logs.txt", "w")
-    for lang in opt.langs:
-        print("Processing", lang)
-        lang_align_dir = opt.align_dir/lang
-        lang_code = lang.split("_")[0]
-        src_emb_file = f"{lang_align_dir/lang}.vec"
-        tgt_emb_file = f"{lang_align_dir}/eng.vec"
-        trans_file = f"{opt.trans_dir/lang_code}_eng.txt"
+def lang_files(lang, opt):
+    lang_align_dir = opt.align_dir/lang
+    lang_code = lang.split("_")[0]
+    src_emb_file = f"{lang_align_dir/lang}.vec"
+    tgt_emb_file = f"{lang_align_dir}/eng.vec"
+    trans_file = f"{opt.trans_dir/lang_code}_eng.txt" if opt.trans_dir else ""
+    return src_emb_file, tgt_emb_file, trans_file
 
-        report_file.write(f"{lang}:\n")
+def stage_cache(opt):
+    if opt.no_stage_cache:
+        return None
+    return StageCache(opt.stage_cache_dir or opt.reports_dir/".stage_cache", force=opt.force)
 
-        if not opt.skip_eval:
-            subprocess.run(
-                [
-                    "python", "-u", f"{eval_align_script}",
-                    "--src_emb", f"{src_emb_file}",
-                    "--tgt_emb", f"{tgt_emb_file}",
-                    "--dico_test", f"{trans_file}",
-                    "--report_file", f"{report_file_loc}/eval_align_report.txt"
-                ],
-                stderr=subprocess.STDOUT,
-                stdout=log_file,
-                check=True)
-            with open(report_file_loc/"eval_align_report.txt", "r") as fin:
-                report_file.write(fin.read())
-            print("Evaluated translation precision")
-        
-        nns_dir = opt.nns_dir/opt.exp_id
-        mkdir(nns_dir)
-        nns_file = f"{nns_dir/lang}.txt"
-        nns_cmd = [
-            "python", "-u", f"{nns_script}",
-            "--src_emb", f"{src_emb_file}",
-            "--tgt_emb", f"{tgt_emb_file}",
-            "--nns_file", f"{nns_file}"
-        ]
-        if not opt.skip_eval:
-            nns_cmd.extend(["--dico_test", f"{trans_file}"])
-        subprocess.run(
-            nns_cmd,
+def nns_outputs(opt, nns_file):
+    outputs = {"nns": nns_binary_path(nns_file)}
+    if opt.nns_tsv:
+        outputs["tsv"] = nns_file
+    return outputs
+
+def profile_args(opt, report_file_loc, lang, stage):
+    # Stage subprocesses write their own profile, merged by run_lang_profiled
+    if not opt.profile:
+        return []
+    return ["--profile_file", f"{report_file_loc/'profile'/lang}.{stage}.json"]
+
+def lang_stage_inputs(opt, src_emb_file, tgt_emb_file, trans_file, nns_file, lang_code):
+    # Input files and parameters that determine the outputs of every stage
+    eval_inputs = [] if opt.skip_eval else [trans_file]
+    return {
+        "eval_align": ([src_emb_file, tgt_emb_file, trans_file], {"dtype": opt.dtype}),
+        "compute_nns": ([src_emb_file, tgt_emb_file] + eval_inputs, {"dtype": opt.dtype, "tsv": opt.nns_tsv}),
+        "eval_emos": ([nns_binary_path(nns_file), f"{opt.emo_lex_dir/lang_code}.txt"], {}),
+        "create_emos": ([nns_binary_path(nns_file), f"{opt.emo_lex_dir}/eng.txt"], {}),
+    }
+
+def run_lang_subprocess(lang, opt, report_file_loc, scratch_dir, report_file, log_file):
+    src_emb_file, tgt_emb_file, trans_file = lang_files(lang, opt)
+    lang_code = lang.split("_")[0]
+    backend_args = ["--backend", opt.backend] if opt.backend else []
+    if opt.workers is not None:
+        backend_args.extend(["--workers", str(opt.workers)])
+    cache = stage_cache(opt)
+    nns_dir = opt.nns_dir/opt.exp_id
+    mkdir(nns_dir)
+    nns_file = f"{nns_dir/lang}.txt"
+    stages = lang_stage_inputs(opt, src_emb_file, tgt_emb_file, trans_file, nns_file, lang_code)
+
+    if not opt.skip_eval:
+        outputs = {"report": scratch_dir/"eval_align_report.txt"}
+        reused = run_cached(cache, "eval_align", *stages["eval_align"], outputs, lambda: subprocess.run(
+            [
+                "python", "-u", f"{eval_align_script}",
+                "--src_emb", f"{src_emb_file}",
+                "--tgt_emb", f"{tgt_emb_file}",
+                "--dico_test", f"{trans_file}",
+                "--report_file", f"{scratch_dir}/eval_align_report.txt",
+                "--dtype", opt.dtype,
+                *backend_args,
+                *profile_args(opt, report_file_loc, lang, "eval_align")
+            ],
+            stderr=subprocess.STDOUT,
+            stdout=log_file,
+            check=True))
+        with open(scratch_dir/"eval_align_report.txt", "r") as fin:
+            report_file.write(fin.read())
+        print("Reused" if reused else "Evaluated", "translation precision")
+
+    nns_cmd = [
+        "python", "-u", f"{nns_script}",
+        "--src_emb", f"{src_emb_file}",
+        "--tgt_emb", f"{tgt_emb_file}",
+        "--nns_file", f"{nns_file}",
+        "--dtype", opt.dtype,
+        *backend_args,
+        *profile_args(opt, report_file_loc, lang, "compute_nns")
+    ]
+    if not opt.skip_eval:
+        nns_cmd.extend(["--dico_test", f"{trans_file}"])
+    if opt.nns_tsv:
+        nns_cmd.append("--tsv")
+    reused = run_cached(cache, "compute_nns", *stages["compute_nns"], nns_outputs(opt, nns_file), lambda: subprocess.run(
+        nns_cmd,
+        stderr=subprocess.STDOUT,
+        stdout=log_file,
+        check=True
+    ))
+    print("Reused" if reused else "Calculated", "nearest neighbors")
+
+    emos_dir = report_file_loc/"emos"
+    mkdir(emos_dir)
+    if not opt.skip_eval:
+        emos_eval_dir = report_file_loc/"emos_eval"
+        mkdir(emos_eval_dir)
+        outputs = {
+            "report": scratch_dir/"eval_emos_report.txt",
+            "emos": emos_dir/f"{lang}_emos.txt",
+            "emos_eval": emos_eval_dir/f"{lang}_emos.txt",
+        }
+        reused = run_cached(cache, "eval_emos", *stages["eval_emos"], outputs, lambda: subprocess.run(
+            [
+                "python", "-u", f"{eval_emos_script}",
+                "--trans_file", f"{nns_file}",
+                "--emo_lex", f"{opt.emo_lex_dir/lang_code}.txt",
+                "--report_file", f"{scratch_dir}/eval_emos_report.txt",
+                "--induct_emos_file", f"{emos_dir}/{lang}_emos.txt",
+                "--induct_emos_eval_file", f"{emos_eval_dir}/{lang}_emos.txt",
+                *profile_args(opt, report_file_loc, lang, "eval_emos")
+            ],
             stderr=subprocess.STDOUT,
             stdout=log_file,
             check=True
-        )
-        print("Calculated nearest neighbors")
+        ))
+        with open(scratch_dir/"eval_emos_report.txt", "r") as fin:
+            report_file.write(fin.read())
+        report_file.flush()
+    else:
+        reused = run_cached(cache, "create_emos", *stages["create_emos"], {"emos": emos_dir/f"{lang}_emos.txt"}, lambda: subprocess.run(
+            [
+                "python", "-u", f"{create_emos_script}",
+                "--trans_file", f"{nns_file}",
+                "--emo_lex", f"{opt.emo_lex_dir}/eng.txt",
+                "--induct_emos_file", f"{emos_dir}/{lang}_emos.txt",
+                *profile_args(opt, report_file_loc, lang, "create_emos")
+            ],
+            stderr=subprocess.STDOUT,
+            stdout=log_file,
+            check=True
+        ))
+
+    print("Reused" if reused else "Evaluated", "emotion correlations")
+
+def run_lang_in_process(lang, opt, report_file_loc, scratch_dir, report_file, log_file):
+    # Same stages as run_lang_subprocess, but the embeddings and lexicons are
+    # loaded once, only when a stage is not cached, and handed from stage to
+    # stage in memory
+    import eval_utils
+    import eval_align
+    import compute_nns
+    import eval_emos
+    import create_emos
+    from backend import set_backend
+    from csls_shard import set_workers, share, release
+    from create_emos_utils import load_trans_file, translations_from_nns
+
+    src_emb_file, tgt_emb_file, trans_file = lang_files(lang, opt)
+    lang_code = lang.split("_")[0]
+    cache = stage_cache(opt)
+    nns_dir = opt.nns_dir/opt.exp_id
+    mkdir(nns_dir)
+    nns_file = f"{nns_dir/lang}.txt"
+    emos_dir = report_file_loc/"emos"
+    mkdir(emos_dir)
+    stages = lang_stage_inputs(opt, src_emb_file, tgt_emb_file, trans_file, nns_file, lang_code)
+    loaded = {}
 
-        emos_dir = report_file_loc/"emos"
-        mkdir(emos_dir)
+    def embeddings():
+        if not loaded:
+            set_backend(opt.backend)
+            set_workers(opt.workers)
+            loaded["tgt"] = eval_utils.load_vectors(tgt_emb_file, dtype=opt.dtype)
+            loaded["src"] = eval_utils.load_vectors(src_emb_file, dtype=opt.dtype)
+            loaded["penalty_cache"] = eval_utils.csls_penalty_cache(src_emb_file, tgt_emb_file, dtype=opt.dtype)
+        return loaded["src"], loaded["tgt"], loaded["penalty_cache"]
+
+    def run_eval_align():
+        (words_src, x_src), (words_tgt, x_tgt), penalty_cache = embeddings()
+        # The evaluation renormalises its inputs in place, copies keep the
+        # neighbours identical to the ones computed by the CLI scripts. With
+        # CSLS workers the copies are made in shared memory, once.
+        x_src, x_tgt = share(x_src, copy=True), share(x_tgt, copy=True)
+        try:
+            eval_align.evaluate_alignment(x_src, x_tgt, words_src, words_tgt, trans_file,
+                                          report_file=scratch_dir/"eval_align_report.txt",
+                                          penalty_cache=penalty_cache)
+        finally:
+            release(x_src)
+            release(x_tgt)
+
+    if not opt.skip_eval:
+        with contextlib.redirect_stdout(log_file):
+            reused = run_cached(cache, "eval_align", *stages["eval_align"],
+                                {"report": scratch_dir/"eval_align_report.txt"}, run_eval_align)
+        with open(scratch_dir/"eval_align_report.txt", "r") as fin:
+            report_file.write(fin.read())
+        print("Reused" if reused else "Evaluated", "translation precision")
+
+    translations = []
+
+    def run_compute_nns():
+        (words_src, x_src), (words_tgt, x_tgt), penalty_cache = embeddings()
+        nns = compute_nns.compute_nns(x_src, words_src, x_tgt, words_tgt, nns_file,
+                                      dico_test="" if opt.skip_eval else trans_file,
+                                      penalty_cache=penalty_cache, tsv=opt.nns_tsv)
+        translations.append(translations_from_nns(nns, words_src, words_tgt))
+
+    with contextlib.redirect_stdout(log_file):
+        reused = run_cached(cache, "compute_nns", *stages["compute_nns"], nns_outputs(opt, nns_file), run_compute_nns)
+    print("Reused" if reused else "Calculated", "nearest neighbors")
+    # The emotion stages do not read the embeddings, their shared memory
+    # goes before the next language loads its own
+    for side in ("src", "tgt"):
+        if side in loaded:
+            release(loaded[side][1])
+
+    def lang_translations():
+        if not translations:
+            translations.append(load_trans_file(nns_file))
+        return translations[0]
+
+    def run_eval_emos():
+        trans, src_words, tgt_words = lang_translations()
+        emo_lex_src, emo_lex_tgt = eval_emos.load_emo_lex(f"{opt.emo_lex_dir/lang_code}.txt", src_words, tgt_words)
+        eval_emos.evaluate_emotions(trans, emo_lex_src, emo_lex_tgt,
+                                    f"{scratch_dir}/eval_emos_report.txt",
+                                    f"{emos_dir}/{lang}_emos.txt",
+                                    f"{report_file_loc}/emos_eval/{lang}_emos.txt",
+                                    src_vocab=src_words, tgt_vocab=tgt_words)
+
+    def run_create_emos():
+        trans, src_words, tgt_words = lang_translations()
+        emo_lex_tgt = create_emos.load_emo_lex(f"{opt.emo_lex_dir}/eng.txt", tgt_words)
+        create_emos.create_emotions(trans, emo_lex_tgt, f"{emos_dir}/{lang}_emos.txt", tgt_vocab=tgt_words)
+
+    with contextlib.redirect_stdout(log_file):
         if not opt.skip_eval:
             emos_eval_dir = report_file_loc/"emos_eval"
             mkdir(emos_eval_dir)
-            subprocess.run(
-                [
-                    "python", "-u", f"{eval_emos_script}",
-                    "--trans_file", f"{nns_file}",
-                    "--emo_lex", f"{opt.emo_lex_dir/lang_code}.txt",
-                    "--report_file", f"{report_file_loc}/eval_emos_report.txt",
-                    "--induct_emos_file", f"{emos_dir}/{lang}_emos.txt",
-                    "--induct_emos_eval_file", f"{emos_eval_dir}/{lang}_emos.txt"
-                ],
-                stderr=subprocess.STDOUT,
-                stdout=log_file,
-                check=True
-            )
-            with open(report_file_loc/"eval_emos_report.txt", "r") as fin:
-                report_file.write(fin.read())
-            report_file.flush()
+            outputs = {
+                "report": scratch_dir/"eval_emos_report.txt",
+                "emos": emos_dir/f"{lang}_emos.txt",
+                "emos_eval": emos_eval_dir/f"{lang}_emos.txt",
+            }
+            reused = run_cached(cache, "eval_emos", *stages["eval_emos"], outputs, run_eval_emos)
         else:
-            subprocess.run(
-                [
-                    "python", "-u", f"{create_emos_script}",
-                    "--trans_file", f"{nns_file}",
-                    "--emo_lex", f"{opt.emo_lex_dir}/eng.txt",
-                    "--induct_emos_file", f"{emos_dir}/{lang}_emos.txt",
-                ],
-                stderr=subprocess.STDOUT,
-                stdout=log_file,
-                check=True
-            )
-
-        print("Evaluated emotion correlations")
-
-        report_file.write("\n")
-        print("Finished", lang)
+            reused = run_cached(cache, "create_emos", *stages["create_emos"],
+                                {"emos": emos_dir/f"{lang}_emos.txt"}, run_create_emos)
+    if not opt.skip_eval:
+        with open(scratch_dir/"eval_emos_report.txt", "r") as fin:
+            report_file.write(fin.read())
+        report_file.flush()
+    print("Reused" if reused else "Evaluated", "emotion correlations")
+
+def run_lang_profiled(lang, opt, report_file_loc, scratch_dir, report_file, log_file):
+    # Runs the stages of a language, with --profile under a profile of this
+    # process that is merged with the profiles of the stage subprocesses into
+    # profile/<lang>.json
+    run_lang = run_lang_in_process if opt.in_process else run_lang_subprocess
+    if not opt.profile:
+        run_lang(lang, opt, report_file_loc, scratch_dir, report_file, log_file)
+        return
+    profile_dir = report_file_loc/"profile"
+    mkdir(profile_dir)
+    stages = ["eval_align", "compute_nns", "eval_emos", "create_emos"]
+    for stage in stages:
+        (profile_dir/f"{lang}.{stage}.json").unlink(missing_ok=True)
+    profiling.enable()
+    try:
+        run_lang(lang, opt, report_file_loc, scratch_dir, report_file, log_file)
+    finally:
+        profile = profiling.disable().to_dict()
+    profiles, prefixes = [profile], [None]
+    for stage in stages:
+        stage_file = profile_dir/f"{lang}.{stage}.json"
+        if stage_file.exists():
+            profiles.append(json.loads(stage_file.read_text()))
+            prefixes.append(stage)
+            stage_file.unlink()
+    merged = profiling.merge_profiles(profiles, prefixes)
+    merged["wall_s"] = profile["wall_s"]
+    merged["peak_rss_mb"] = max(p["peak_rss_mb"] for p in profiles)
+    merged["mode"] = "in_process" if opt.in_process else "subprocess"
+    profiling.write_profile(profile_dir/f"{lang}.json", merged)
+
+def write_profile_table(opt, report_file_loc):
+    profile_dir = report_file_loc/"profile"
+    profiles = {}
+    for lang in opt.langs:
+        if (profile_dir/f"{lang}.json").exists():
+            profiles[lang] = json.loads((profile_dir/f"{lang}.json").read_text())
+    if not profiles:
+        return
+    table = profiling.format_profiles(profiles)
+    (profile_dir/"profile.txt").write_text(table + "\n")
+    print(table)
+
+def run_lang_job(lang, opt, report_file_loc):
+    # Worker side of --jobs, every language gets its own scratch directory for
+    # stage reports and logs and hands its part of report.txt back as a string
+    scratch_dir = report_file_loc/"scratch"/lang
+    mkdir(scratch_dir)
+    report = io.StringIO()
+    with open(scratch_dir/"logs.txt", "w") as log_file:
+        print("Processing", lang)
+        run_lang_profiled(lang, opt, report_file_loc, scratch_dir, report, log_file)
+    return report.getvalue()
+
+def run_langs_parallel(opt, report_file_loc, report_file, log_file):
+    with concurrent.futures.ProcessPoolExecutor(opt.jobs) as pool:
+        futures = {lang: pool.submit(run_lang_job, lang, opt, report_file_loc) for lang in opt.langs}
+        for lang in opt.langs:
+            report_file.write(f"{lang}:\n")
+            try:
+                report_file.write(futures[lang].result())
+                print("Finished", lang)
+            except Exception as e:
+                report_file.write(f"Failed: {e}\n")
+                print(f"Failed {lang}: {e}")
+            report_file.write("\n")
+            report_file.flush()
+            lang_log_file = report_file_loc/"scratch"/lang/"logs.txt"
+            if lang_log_file.exists():
+                log_file.write(f"==> {lang}\n")
+                log_file.write(lang_log_file.read_text())
+
+if __name__ == "__main__":
+    opt = parser.parse_args()
+    report_file_loc = opt.reports_dir/opt.exp_id
+    mkdir(report_file_loc)
+    report_file = open(report_file_loc/"report.txt", "w")
+    log_file = open(report_file_loc/"logs.txt", "w")
+    if opt.jobs > 1:
+        run_langs_parallel(opt, report_file_loc, report_file, log_file)
+    else:
+        for lang in opt.langs:
+            print("Processing", lang)
+            report_file.write(f"{lang}:\n")
+            run_lang_profiled(lang, opt, report_file_loc, report_file_loc, report_file, log_file)
+            report_file.write("\n")
+            print("Finished", lang)
     report_file.close()
     log_file.close()
+    if opt.profile:
+        write_profile_table(opt, report_file_loc)
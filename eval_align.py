@@ -7,9 +7,13 @@
 # LICENSE file in the root directory of this source tree.
 
 import io
-import cupy as np
+import numpy as np
 import argparse
+import profiling
+from profiling import add_profile_argument
 from eval_utils import *
+from backend import set_backend, add_backend_argument, backend_name
+from csls_shard import set_workers, add_workers_argument, share
 
 parser = argparse.ArgumentParser(description='Evaluation of word alignment')
 parser.add_argument("--src_emb", type=str, default='', help="Load source embeddings")
@@ -19,57 +23,82 @@ parser.add_argument("--src_mat", type=str, default='', help="Load source alignme
 parser.add_argument("--tgt_mat", type=str, default='', help="Load target alignment matrix. If none given, the aligment matrix is the identity.")
 parser.add_argument("--dico_test", type=str, default='', help="test dictionary")
 parser.add_argument("--maxload", type=int, default=200000)
+parser.add_argument("--dtype", choices=DTYPES, default="float32", help="Floating point precision of the embeddings")
+parser.add_argument("--tile_mb", type=int, default=DEFAULT_TILE_BYTES >> 20, help="Memory budget in MB for one block of CSLS similarities")
+parser.add_argument("--penalty_cache_dir", type=str, default='', help="Directory for cached CSLS penalties, defaults to csls_cache next to the target embeddings")
+parser.add_argument("--no_penalty_cache", action='store_true', help="Always recompute CSLS penalties")
 parser.add_argument("--nomatch", action='store_true', help="no exact match in lexicon")
 parser.add_argument("--report_file", type=str, help="File to write report to")
-params = parser.parse_args()
+add_backend_argument(parser)
+add_workers_argument(parser)
+add_profile_argument(parser)
 
 
 ###### SPECIFIC FUNCTIONS ######
 # function specific to evaluation
 # the rest of the functions are in utils.py
 
-def load_transform(fname, d1=300, d2=300):
+def load_transform(fname, d1=300, d2=300, dtype=DEFAULT_DTYPE):
     fin = io.open(fname, 'r', encoding='utf-8', newline='\n', errors='ignore')
-    R = np.zeros([d1, d2])
+    R = np.zeros([d1, d2], dtype=compute_dtype(dtype))
     for i, line in enumerate(fin):
         tokens = line.split(' ')
         R[i, :] = np.array(tokens[0:d2], dtype=float)
-    return R
+    return to_device(R)
+
+
+@profiling.timed()
+def evaluate_alignment(x_src, x_tgt, words_src, words_tgt, dico_test, report_file=None, bsz=1024, k=10,
+                       tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
+    src2tgt, lexicon_size = load_lexicon(dico_test, words_src, words_tgt)
+
+    accs = compute_accuracies(x_src, x_tgt, src2tgt, cutoffs=[1, 3, 5], csls_ks=[k], lexicon_size=-1, bsz=bsz,
+                              tile_bytes=tile_bytes, penalty_cache=penalty_cache)
+    nnacc_1, nnacc_3, nnacc_5 = (accs["nn"][c] for c in (1, 3, 5))
+    cslsproc_1, cslsproc_3, cslsproc_5 = (accs["csls"][k][c] for c in (1, 3, 5))
+    print("NN@1 = %.4f - NN@3 = %.4f - NN@5 = %.4f" % (nnacc_1, nnacc_3, nnacc_5))
+    print("CSLS@1 = %.4f - CSLS@3 = %.4f - CSLS@5 = %.4f" % (cslsproc_1, cslsproc_3, cslsproc_5))
+    print("Coverage = %.4f" % (len(src2tgt) / lexicon_size))
+
+    if report_file:
+        with open(report_file, "w") as f:
+            f.write("P@1 = %.4f - P@3 = %.4f - P@5 = %.4f\n" % (cslsproc_1, cslsproc_3, cslsproc_5))
+            f.write("P@3 = %.2f\n" % (cslsproc_3 * 100))
+            f.write("Full P@3 = %.2f\n" % (cslsproc_3 * 100 * (len(src2tgt) / lexicon_size)))
+    return accs
 
 
 ###### MAIN ######
 
-print("Evaluation of alignment on %s" % params.dico_test)
-if params.nomatch:
-    print("running without exact string matches")
-
-words_tgt, x_tgt = load_vectors(params.tgt_emb, maxload=params.maxload, center=params.center)
-words_src, x_src = load_vectors(params.src_emb, maxload=params.maxload, center=params.center)
-
-if params.tgt_mat != "":
-    R_tgt = load_transform(params.tgt_mat)
-    x_tgt = np.dot(x_tgt, R_tgt)
-if params.src_mat != "":
-    R_src = load_transform(params.src_mat)
-    x_src = np.dot(x_src, R_src)
-
-src2tgt, lexicon_size = load_lexicon(params.dico_test, words_src, words_tgt)
-
-# bsz = len(x_tgt)
-bsz = 1024
-k = 10
-nnacc_1 = compute_nn_accuracy(x_src, x_tgt, src2tgt, lexicon_size=-1, bsz=bsz)
-nnacc_3 = compute_nn_accuracy(x_src, x_tgt, src2tgt, lexicon_size=-1, bsz=bsz, acc_at=3)
-nnacc_5 = compute_nn_accuracy(x_src, x_tgt, src2tgt, lexicon_size=-1, bsz=bsz, acc_at=5)
-cslsproc_1 = compute_csls_accuracy(x_src, x_tgt, src2tgt, lexicon_size=-1, bsz=bsz, k=k)
-cslsproc_3 = compute_csls_accuracy(x_src, x_tgt, src2tgt, lexicon_size=-1, bsz=bsz, acc_at=3, k=k)
-cslsproc_5 = compute_csls_accuracy(x_src, x_tgt, src2tgt, lexicon_size=-1, bsz=bsz, acc_at=5, k=k)
-print("NN@1 = %.4f - NN@3 = %.4f - NN@5 = %.4f" % (nnacc_1, nnacc_3, nnacc_5))
-print("CSLS@1 = %.4f - CSLS@3 = %.4f - CSLS@5 = %.4f" % (cslsproc_1, cslsproc_3, cslsproc_5))
-print("Coverage = %.4f" % (len(src2tgt) / lexicon_size))
-
-if params.report_file:
-    with open(params.report_file, "w") as f:
-        f.write("P@1 = %.4f - P@3 = %.4f - P@5 = %.4f\n" % (cslsproc_1, cslsproc_3, cslsproc_5))
-        f.write("P@3 = %.2f\n" % (cslsproc_3 * 100))
-        f.write("Full P@3 = %.2f\n" % (cslsproc_3 * 100 * (len(src2tgt) / lexicon_size)))
+def main(params):
+    xp = set_backend(params.backend)
+    set_workers(params.workers)
+    print("Evaluation of alignment on %s (%s backend)" % (params.dico_test, backend_name()))
+    if params.nomatch:
+        print("running without exact string matches")
+
+    words_tgt, x_tgt = load_vectors(params.tgt_emb, maxload=params.maxload, center=params.center, dtype=params.dtype)
+    words_src, x_src = load_vectors(params.src_emb, maxload=params.maxload, center=params.center, dtype=params.dtype)
+
+    if params.tgt_mat != "":
+        R_tgt = load_transform(params.tgt_mat, dtype=params.dtype)
+        # Shared once here rather than copied to the workers on every sweep
+        x_tgt = share(xp.dot(as_compute(x_tgt), R_tgt).astype(params.dtype))
+    if params.src_mat != "":
+        R_src = load_transform(params.src_mat, dtype=params.dtype)
+        x_src = share(xp.dot(as_compute(x_src), R_src).astype(params.dtype))
+
+    penalty_cache = None
+    if not params.no_penalty_cache:
+        mat_checksums = [file_checksum(mat) for mat in (params.src_mat, params.tgt_mat) if mat != ""]
+        penalty_cache = csls_penalty_cache(params.src_emb, params.tgt_emb, params.maxload, params.center, params.dtype,
+                                           cache_dir=params.penalty_cache_dir or None, extra=mat_checksums)
+
+    # bsz = len(x_tgt)
+    evaluate_alignment(x_src, x_tgt, words_src, words_tgt, params.dico_test, params.report_file, bsz=1024, k=10,
+                       tile_bytes=params.tile_mb << 20, penalty_cache=penalty_cache)
+
+if __name__ == "__main__":
+    params = parser.parse_args()
+    with profiling.profile_to(params.profile_file):
+        main(params)
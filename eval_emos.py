@@ -1,10 +1,13 @@
 import io
-import cupy as np
+import numpy as np
 import argparse
+import profiling
+from profiling import add_profile_argument
 from collections import defaultdict
 from csv_helpers import write_all_rows
 from eval_utils import *
-from create_emos_utils import load_trans_file, get_emo_ratings
+from vocab import Vocabulary, as_vocabulary
+from create_emos_utils import load_trans_file, get_all_emo_ratings, emotion_matrix, translation_strings
 
 parser = argparse.ArgumentParser(description='Evaluation of emotions')
 parser.add_argument("--trans_file", type=str, default='', help="Load translations file")
@@ -12,18 +15,26 @@ parser.add_argument("--emo_lex", type=str, default='', help="Load emotion lexico
 parser.add_argument("--report_file", type=str, default='', help="File to write report to")
 parser.add_argument("--induct_emos_file", type=str, default='', help="File to write induced emotions to")
 parser.add_argument("--induct_emos_eval_file", type=str, default='', help="File to write evaluation of induced emotions to")
-params = parser.parse_args()
+parser.add_argument("--bootstrap", type=int, default=0, help="Number of bootstrap resamples for confidence intervals, 0 to skip")
+parser.add_argument("--bootstrap_report_file", type=str, default='', help="File to write bootstrap confidence intervals to")
+parser.add_argument("--compare_trans_file", type=str, default='', help="Translations file of a second run, e.g. another exp_id, for paired bootstrap differences")
+parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the bootstrap intervals")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the bootstrap resamples")
+add_profile_argument(parser)
 
+@profiling.timed()
 def load_emo_lex(emo_lex_file, src_words, tgt_words):
     fin = io.open(emo_lex_file, "r", encoding="utf-8")
     fin.readline()
+    rows = [line.split("\t") for line in fin]
+    fin.close()
+    tgt_known = (as_vocabulary(tgt_words).ids(row[0] for row in rows) >= 0).tolist()
     emo_lex_src = defaultdict(dict)
     emo_lex_tgt = defaultdict(dict)
     src_word_count = defaultdict(lambda: defaultdict(int))
-    for line in fin:
-        word_tgt, word_src, emotion, rating = line.split("\t")
+    for (word_tgt, word_src, emotion, rating), known in zip(rows, tgt_known):
         rating = float(rating)
-        if word_tgt in tgt_words:
+        if known:
             emo_lex_tgt[emotion][word_tgt] = rating
         if (word_src != "NO TRANSLATION"):
             src_word_count[emotion][word_src] += 1
@@ -32,54 +43,180 @@ def load_emo_lex(emo_lex_file, src_words, tgt_words):
                 emo_lex_src[emotion][word_src] = rating
             else:
                 emo_lex_src[emotion][word_src] = ((emo_lex_src[emotion][word_src] * (word_count - 1)) + rating)/word_count
-    fin.close()
     return emo_lex_src, emo_lex_tgt
 
-def eval_emo_lex(derived_emo_lex, emo_lex, trans, induct_emos_file, induct_emos_eval_file, emotion):
-    print("Number of derived emotion ratings:", len(derived_emo_lex))
-    derived_emos = []
-    real_emos = []
-    words = []
-    trans = {word_src: tgt_words for word_src, tgt_words in trans}
-    for word, emo in derived_emo_lex.items():
-        translations = ",".join([t[0] for t in trans[word]])
-        induct_emos_file.write(f"{word}\t{translations}\t{emotion}\t{emo}\n")
-        real_emo = emo_lex.get(word, None)
-        if real_emo:
-            induct_emos_eval_file.write(f"{word}\t{translations}\t{emotion}\t{emo}\t{real_emo}\n")
-            derived_emos.append(emo)
-            real_emos.append(real_emo)
-            words.append(word)
-    
-    print("Coverage in test set:", len(derived_emos) / len(derived_emo_lex))
-
-    derived_emos = np.array(derived_emos, dtype=float)
-    real_emos = np.array(real_emos, dtype=float)
-    corr_coeff = np.corrcoef(derived_emos, real_emos, rowvar=False)
+@profiling.timed()
+def emotion_correlations(derived_emos, real_emos, covered):
+    # Pearson correlation of every emotion column over its covered words,
+    # in the same steps as np.corrcoef
+    n = covered.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        derived_c = np.where(covered, derived_emos - np.where(covered, derived_emos, 0.0).sum(axis=0) / n, 0.0)
+        real_c = np.where(covered, real_emos - np.where(covered, real_emos, 0.0).sum(axis=0) / n, 0.0)
+        cov = (derived_c * real_c).sum(axis=0) / (n - 1)
+        derived_std = np.sqrt((derived_c * derived_c).sum(axis=0) / (n - 1))
+        real_std = np.sqrt((real_c * real_c).sum(axis=0) / (n - 1))
+        return np.clip(cov / derived_std / real_std, -1, 1)
+
+def eval_emo_lex(words, translations, derived_emos, derived, real_emos, covered, corr_coeff, induct_emos_file, induct_emos_eval_file, emotion):
+    num_derived = int(derived.sum())
+    print("Number of derived emotion ratings:", num_derived)
+    derived_list = derived_emos.tolist()
+    real_list = real_emos.tolist()
+    for i in np.flatnonzero(derived).tolist():
+        induct_emos_file.write(f"{words[i]}\t{translations[i]}\t{emotion}\t{derived_list[i]}\n")
+    covered_idx = np.flatnonzero(covered)
+    for i in covered_idx.tolist():
+        induct_emos_eval_file.write(f"{words[i]}\t{translations[i]}\t{emotion}\t{derived_list[i]}\t{real_list[i]}\n")
+
+    print("Coverage in test set:", len(covered_idx) / num_derived)
+
+    derived_emos = derived_emos[covered_idx]
     top_words = np.argsort(-derived_emos)[:10]
     print(derived_emos[top_words])
-    top_words = [words[int(idx)] for idx in top_words]
+    top_words = [words[i] for i in covered_idx[top_words].tolist()]
     print(top_words)
-    corr_coeff = np.around(corr_coeff[0, 1], 3)
+    corr_coeff = np.around(corr_coeff, 3)
     print("Correlation:", corr_coeff)
-    return [corr_coeff, len(derived_emo_lex), derived_emos.shape[0]]
+    return [corr_coeff, num_derived, len(covered_idx)]
 
-if __name__ == "__main__":
-    print("Evaluation of emotion ratings on %s" % params.trans_file)
+@profiling.timed()
+def evaluate_emotions(translations, emo_lex_src, emo_lex_tgt, report_file, induct_emos_file, induct_emos_eval_file,
+                      src_vocab=None, tgt_vocab=None):
+    # Induction, coverage and correlation of every emotion in one pass over
+    # source x emotions matrices, only the file output is per emotion.
+    # src_vocab and tgt_vocab are the vocabularies from load_trans_file.
+    emotions = list(emo_lex_src.keys())
+    if src_vocab is None:
+        src_vocab = Vocabulary(word_src for word_src, tgt_words in translations)
+    trans_strings = translation_strings(translations)
+    derived_emos, derived = get_all_emo_ratings(translations, emo_lex_tgt, emotions, tgt_vocab)
+    real_emos, rated = emotion_matrix(emo_lex_src, emotions, src_vocab)
+    covered = derived & rated
+    corr_coeffs = emotion_correlations(derived_emos, real_emos, covered)
 
-    translations, src_words, tgt_words = load_trans_file(params.trans_file)
-    emo_lex_src, emo_lex_tgt = load_emo_lex(params.emo_lex, src_words, tgt_words)
     report = []
-
-    with open(params.induct_emos_file, "w") as induct_emos_file,\
-        open(params.induct_emos_eval_file, "w") as induct_emos_eval_file:
-        for emotion in emo_lex_src.keys():
+    with open(induct_emos_file, "w") as induct_emos_out,\
+        open(induct_emos_eval_file, "w") as induct_emos_eval_out:
+        for j, emotion in enumerate(emotions):
             print("\nStats for emotion:", emotion)
-            single_emo_lex_src = emo_lex_src[emotion]
-            single_emo_lex_tgt = emo_lex_tgt[emotion]
-            derived_emo_lex_src = get_emo_ratings(translations, single_emo_lex_tgt)
-            report_record = eval_emo_lex(derived_emo_lex_src, single_emo_lex_src, translations, induct_emos_file, induct_emos_eval_file, emotion)
+            report_record = eval_emo_lex(src_vocab, trans_strings, derived_emos[:, j], derived[:, j], real_emos[:, j], covered[:, j],
+                                         corr_coeffs[j], induct_emos_out, induct_emos_eval_out, emotion)
             report_record.insert(0, emotion)
             report.append(report_record)
 
-    write_all_rows(params.report_file, report)
+    write_all_rows(report_file, report)
+    return report
+
+def bootstrap_counts(rng, num_resamples, n):
+    # How often each of n items is drawn in every resample, from one
+    # num_resamples x n matrix of resampled indices
+    draws = rng.integers(0, n, size=(num_resamples, n))
+    draws += np.arange(num_resamples)[:, np.newaxis] * n
+    return np.bincount(draws.ravel(), minlength=num_resamples * n).reshape(num_resamples, n).astype(float)
+
+def weighted_correlations(counts, derived_emos, real_emos, covered):
+    # Pearson correlation of every resample (rows of counts) and emotion
+    # (columns) over the covered items, each item weighted by how often it
+    # was drawn, from six resamples x items by items x emotions products
+    x = np.where(covered, derived_emos, 0.0)
+    y = np.where(covered, real_emos, 0.0)
+    profiling.count("flops", 12 * counts.shape[0] * counts.shape[1] * x.shape[1])
+    w = counts @ covered.astype(float)
+    sx, sy = counts @ x, counts @ y
+    sxx, syy, sxy = counts @ (x * x), counts @ (y * y), counts @ (x * y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corr = (w * sxy - sx * sy) / np.sqrt((w * sxx - sx * sx) * (w * syy - sy * sy))
+    return np.clip(corr, -1, 1)
+
+@profiling.timed()
+def bootstrap_correlations(runs, real_emos, num_resamples, seed=0, bsz=256):
+    # Bootstrap distribution of the correlation of every run in runs, a list
+    # of (derived_emos, covered) over the same items. Runs share resamples,
+    # so their differences are paired.
+    rng = np.random.default_rng(seed)
+    n = real_emos.shape[0]
+    samples = [[] for _ in runs]
+    for start in range(0, num_resamples, bsz):
+        counts = bootstrap_counts(rng, min(bsz, num_resamples - start), n)
+        for r, (derived_emos, covered) in enumerate(runs):
+            samples[r].append(weighted_correlations(counts, derived_emos, real_emos, covered))
+    return [np.concatenate(s, axis=0) for s in samples]
+
+def run_emotion_arrays(translations, emo_lex_tgt, emotions, items, src_vocab=None, tgt_vocab=None):
+    # Derived ratings of one run over the rows of the items Vocabulary
+    if src_vocab is None:
+        src_vocab = Vocabulary(word_src for word_src, tgt_words in translations)
+    derived_emos, derived = get_all_emo_ratings(translations, emo_lex_tgt, emotions, tgt_vocab)
+    rows = items.ids(src_vocab)
+    known = rows >= 0
+    run_emos = np.zeros((len(items), len(emotions)))
+    run_derived = np.zeros((len(items), len(emotions)), dtype=bool)
+    run_emos[rows[known]] = derived_emos[known]
+    run_derived[rows[known]] = derived[known]
+    return run_emos, run_derived
+
+@profiling.timed()
+def bootstrap_emotions(runs, emo_lex_src, report_file, num_resamples=1000, confidence=0.95, seed=0):
+    # Confidence intervals of the correlation of every emotion. runs holds
+    # (translations, emo_lex_tgt, src_vocab, tgt_vocab) of one run, or of
+    # two runs whose paired difference is reported as well. The resampled
+    # items are the source words with a gold rating that some run translated.
+    emotions = list(emo_lex_src.keys())
+    items = Vocabulary(dict.fromkeys(
+        word for _, _, src_vocab, _ in runs for word in src_vocab
+        if any(word in emo_lex_src[emotion] for emotion in emotions)))
+    real_emos, rated = emotion_matrix(emo_lex_src, emotions, items)
+    run_arrays = []
+    for translations, emo_lex_tgt, src_vocab, tgt_vocab in runs:
+        run_emos, run_derived = run_emotion_arrays(translations, emo_lex_tgt, emotions, items, src_vocab, tgt_vocab)
+        run_arrays.append((run_emos, run_derived & rated))
+    points = [emotion_correlations(run_emos, real_emos, covered) for run_emos, covered in run_arrays]
+    samples = bootstrap_correlations(run_arrays, real_emos, num_resamples, seed)
+
+    alpha = (1 - confidence) / 2 * 100
+    def interval(x):
+        return np.nanpercentile(x, [alpha, 100 - alpha], axis=0)
+
+    print("\nBootstrap of %d resamples over %d words, %g%% intervals" % (num_resamples, len(items), confidence * 100))
+    report = []
+    intervals = [interval(s) for s in samples]
+    for j, emotion in enumerate(emotions):
+        record = [emotion]
+        for point, (lo, hi) in zip(points, intervals):
+            record.extend([np.around(point[j], 3), np.around(lo[j], 3), np.around(hi[j], 3)])
+        if len(runs) == 2:
+            diff = samples[0][:, j] - samples[1][:, j]
+            diff = diff[~np.isnan(diff)]
+            lo, hi = interval(diff)
+            p = min(1.0, 2 * min((diff <= 0).mean(), (diff >= 0).mean())) if diff.size else np.nan
+            record.extend([np.around(points[0][j] - points[1][j], 3), np.around(lo, 3), np.around(hi, 3), np.around(p, 4)])
+        print(emotion + ":", " ".join(map(str, record[1:])))
+        report.append(record)
+
+    if report_file:
+        write_all_rows(report_file, report)
+    return report
+
+def main(params):
+    print("Evaluation of emotion ratings on %s" % params.trans_file)
+
+    translations, src_words, tgt_words = load_trans_file(params.trans_file)
+    emo_lex_src, emo_lex_tgt = load_emo_lex(params.emo_lex, src_words, tgt_words)
+    evaluate_emotions(translations, emo_lex_src, emo_lex_tgt, params.report_file, params.induct_emos_file, params.induct_emos_eval_file,
+                      src_vocab=src_words, tgt_vocab=tgt_words)
+
+    if params.bootstrap > 0:
+        runs = [(translations, emo_lex_tgt, src_words, tgt_words)]
+        if params.compare_trans_file:
+            print("Paired with %s" % params.compare_trans_file)
+            other, other_src, other_tgt = load_trans_file(params.compare_trans_file)
+            _, other_emo_lex_tgt = load_emo_lex(params.emo_lex, other_src, other_tgt)
+            runs.append((other, other_emo_lex_tgt, other_src, other_tgt))
+        bootstrap_emotions(runs, emo_lex_src, params.bootstrap_report_file, params.bootstrap,
+                           params.confidence, params.seed)
+
+if __name__ == "__main__":
+    params = parser.parse_args()
+    with profiling.profile_to(params.profile_file):
+        main(params)
@@ -5,137 +5,522 @@
 # LICENSE file in the root directory of this source tree.
 
 import io
+import os
+import json
+import hashlib
+import itertools
 import numpy as np
 import collections
+import profiling
+import csls_shard
+from vec_parser import read_vec_file
+from backend import get_array_module, to_device, to_host
+from vocab import Vocabulary, as_vocabulary
 
 def unit_norm(x):
-    norm = np.linalg.norm(x, axis=1)
+    xp = get_array_module(x)
+    norm = xp.linalg.norm(x, axis=1)
     norm[norm == 0] = 1
-    return x / norm[:, np.newaxis]
+    return x / norm[:, xp.newaxis]
 
-def load_vectors(fname, maxload=200000, norm=True, center=False, verbose=True):
+VEC_CACHE_VERSION = 1
+DEFAULT_DTYPE = np.float32
+DTYPES = ["float32", "float16", "float64"]
+# Memory budget for the working arrays of one tile in the blocked CSLS code,
+# see tile_shape
+DEFAULT_TILE_BYTES = 256 << 20
+
+def compute_dtype(dtype):
+    # float16 is a storage format only, numpy has no fast float16 matmul
+    dtype = np.dtype(dtype)
+    return np.dtype(np.float32) if dtype == np.float16 else dtype
+
+def cache_dtype(dtype):
+    return np.dtype(np.float64) if np.dtype(dtype).itemsize > 4 else np.dtype(np.float32)
+
+def as_compute(x):
+    if x.dtype == np.float16:
+        return x.astype(np.float32)
+    return x
+
+def file_checksum(fname, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def vec_cache_paths(fname, cache_dir=None):
+    prefix = str(fname) + ".cache"
+    if cache_dir is not None:
+        prefix = os.path.join(cache_dir, os.path.basename(prefix))
+    return prefix + ".json", prefix + ".bin", prefix + ".vocab"
+
+def read_vec_cache_header(fname, cache_dir=None):
+    header_file, matrix_file, vocab_file = vec_cache_paths(fname, cache_dir)
+    if not (os.path.isfile(header_file) and os.path.isfile(matrix_file) and os.path.isfile(vocab_file)):
+        return None
+    try:
+        with open(header_file, 'r') as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if header.get("version") != VEC_CACHE_VERSION:
+        return None
+    st = os.stat(fname)
+    if header["source_size"] != st.st_size:
+        return None
+    if header["source_mtime_ns"] != st.st_mtime_ns:
+        # Touched but possibly unchanged, only the checksum decides
+        if file_checksum(fname) != header["source_checksum"]:
+            return None
+        header["source_mtime_ns"] = st.st_mtime_ns
+        write_json_atomic(header_file, header)
+    return header
+
+def write_json_atomic(fname, obj):
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, fname)
+
+@profiling.timed()
+def build_vec_cache(fname, maxload=200000, cache_dir=None, verbose=True, workers=None, dtype=DEFAULT_DTYPE):
+    st = os.stat(fname)
+    checksum = file_checksum(fname)
+    words, x, n_total, d = read_vec_file(fname, maxload, workers, cache_dtype(dtype))
+    write_vec_cache(fname, words, x, n_total, d, checksum, st, cache_dir, verbose)
+    return words, x
+
+def write_vec_cache(fname, words, x, n_total, d, checksum, st, cache_dir=None, verbose=True):
+    # x holds the first rows of fname as parsed, st and checksum describe
+    # the file they were parsed from
+    header_file, matrix_file, vocab_file = vec_cache_paths(fname, cache_dir)
+    n = x.shape[0]
+    header = {
+        "version": VEC_CACHE_VERSION,
+        "n_rows": n,
+        "n_words": len(words),
+        "n_total": n_total,
+        "dim": d,
+        "dtype": x.dtype.name,
+        "normalized": False,
+        "centered": False,
+        "source_checksum": checksum,
+        "source_size": st.st_size,
+        "source_mtime_ns": st.st_mtime_ns,
+    }
+    try:
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_suffix = ".%d.tmp" % os.getpid()
+        x.tofile(matrix_file + tmp_suffix)
+        with io.open(vocab_file + tmp_suffix, 'w', encoding='utf-8', newline='\n') as f:
+            f.write("\n".join(words))
+        os.replace(matrix_file + tmp_suffix, matrix_file)
+        os.replace(vocab_file + tmp_suffix, vocab_file)
+        # The header is written last so that it marks a complete cache
+        write_json_atomic(header_file, header)
+        if verbose:
+            print("Wrote vector cache %s" % matrix_file)
+    except OSError as e:
+        print("Could not write vector cache for %s: %s" % (fname, e))
+
+@profiling.timed()
+def save_vectors(fname, words, x, cache_dir=None, verbose=True):
+    # Writes x as a .vec file, with enough digits that it parses back to
+    # exactly x in float32, and the vector cache of that file, so that the
+    # next load_vectors of fname does not parse the text
+    x = np.ascontiguousarray(to_host(x), dtype=np.float32)
+    n, d = x.shape
+    row_format = "%s " + " ".join(["%.9g"] * d)
+    tmp = "%s.%d.tmp" % (fname, os.getpid())
+    with io.open(tmp, 'w', encoding='utf-8', newline='\n') as f:
+        f.write("%d %d\n" % (n, d))
+        for i in range(0, n, 4096):
+            f.write("".join(row_format % ((w,) + tuple(v)) + "\n" for w, v in zip(words[i:i + 4096], x[i:i + 4096].tolist())))
+    os.replace(tmp, fname)
+    write_vec_cache(fname, words, x, n, d, file_checksum(fname), os.stat(fname), cache_dir, verbose)
+
+@profiling.timed()
+def load_cached_vectors(fname, maxload=200000, cache_dir=None, verbose=True, workers=None, dtype=DEFAULT_DTYPE):
+    header = read_vec_cache_header(fname, cache_dir)
+    if header is not None:
+        n = min(header["n_total"], maxload) if maxload > 0 else header["n_total"]
+        if n > header["n_rows"] or np.dtype(header["dtype"]).itemsize < cache_dtype(dtype).itemsize:
+            header = None
+    if header is None:
+        words, x = build_vec_cache(fname, maxload, cache_dir, verbose, workers, dtype)
+        return words, x
+    _, matrix_file, vocab_file = vec_cache_paths(fname, cache_dir)
+    x = np.memmap(matrix_file, dtype=header["dtype"], mode='r', shape=(header["n_rows"], header["dim"]))[:n]
+    with io.open(vocab_file, 'r', encoding='utf-8', newline='\n') as f:
+        words = [line.rstrip('\n') for line in itertools.islice(f, min(n, header["n_words"]))]
+    profiling.count("rows_mapped", n)
+    return words, x
+
+@profiling.timed()
+def load_vectors(fname, maxload=200000, norm=True, center=False, verbose=True, use_cache=True, cache_dir=None, workers=None, dtype=DEFAULT_DTYPE):
     if verbose:
         print("Loading vectors from %s" % fname)
-    fin = io.open(fname, 'r', encoding='utf-8', newline='\n', errors='ignore')
-    n, d = map(int, fin.readline().split())
-    if maxload > 0:
-        n = min(n, maxload)
-    x = np.zeros([n, d])
-    words = []
-    for i, line in enumerate(fin):
-        if i >= n:
-            break
-        tokens = line.rstrip().split(' ')
-        words.append(tokens[0])
-        v = np.array(tokens[1:], dtype=float)
-        x[i, :] = v
+    if use_cache:
+        words, x = load_cached_vectors(fname, maxload, cache_dir, verbose, workers, dtype)
+    else:
+        words, x, _, _ = read_vec_file(fname, maxload, workers, cache_dtype(dtype))
     if norm:
         # x /= np.linalg.norm(x, axis=1)[:, np.newaxis] + 1e-8
-        x = unit_norm(x)
+        x = unit_norm(np.asarray(x, dtype=compute_dtype(dtype)))
+    else:
+        # The cache is mapped read-only
+        x = np.array(x, dtype=compute_dtype(dtype))
     if center:
         x -= x.mean(axis=0)[np.newaxis, :]
         # x /= np.linalg.norm(x, axis=1)[:, np.newaxis] + 1e-8
         x = unit_norm(x)
+    x = to_device(x.astype(dtype, copy=False))
+    # With CSLS workers the sweeps read the matrix from shared memory
+    x = csls_shard.share(x)
+    profiling.count("bytes_allocated", x.nbytes)
     if verbose:
         print("%d word vectors loaded" % (len(words)))
-    return words, x
+    return Vocabulary(words), x
 
 def idx(words):
-    w2i = {}
-    for i, w in enumerate(words):
-        if w not in w2i:
-            w2i[w] = i
-    return w2i
+    # Built once per Vocabulary, plain word lists are indexed on every call
+    return as_vocabulary(words).word2id
+
+class GoldLexicon(collections.defaultdict):
+    # Source index -> set of gold target indices, plus the same pairs in CSR
+    # form (src_ids, indptr, indices) so that predictions can be checked as
+    # whole arrays. build_csr() must be called again after modifying it.
+    def __init__(self, *args):
+        super().__init__(set, *args)
+        self.build_csr()
+
+    # defaultdict copies and pickles itself as type(self)(default_factory,
+    # items), which does not match this constructor
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    def __copy__(self):
+        return type(self)(self)
+
+    copy = __copy__
+
+    def build_csr(self):
+        self.src_ids = np.fromiter(self.keys(), dtype=np.int64, count=len(self))
+        counts = np.fromiter((len(self[s]) for s in self.keys()), dtype=np.int64, count=len(self))
+        self.indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.indices = np.fromiter(itertools.chain.from_iterable(sorted(self[s]) for s in self.keys()),
+                                   dtype=np.int64, count=int(self.indptr[-1]))
+        self._codes = None
+        return self
 
+    def pair_codes(self, stride, xp=np):
+        # Sorted src * stride + tgt for every gold pair, on the device of xp
+        if self._codes is None or self._codes[0] != stride:
+            rows = np.repeat(self.src_ids, np.diff(self.indptr))
+            self._codes = (stride, np.sort(rows * stride + self.indices), {})
+        device_codes = self._codes[2]
+        if xp.__name__ not in device_codes:
+            device_codes[xp.__name__] = xp.asarray(self._codes[1])
+        return device_codes[xp.__name__]
+
+    def contains(self, idx_src, xp=np):
+        return xp.isin(xp.asarray(idx_src, dtype=np.int64), xp.asarray(self.src_ids))
+
+    def hits(self, idx_src, nn, n_tgt=None):
+        # hits[j, t] is whether nn[j, t] is a gold translation of idx_src[j],
+        # computed on the device nn lives on
+        xp = get_array_module(nn)
+        idx_src = xp.asarray(idx_src, dtype=np.int64)
+        nn = xp.asarray(nn, dtype=np.int64)
+        if n_tgt is None:
+            n_tgt = int(nn.max()) + 1 if nn.size else 0
+        stride = max(n_tgt, int(self.indices.max()) + 1 if self.indices.size else 0, 1)
+        codes = self.pair_codes(stride, xp)
+        if codes.size == 0:
+            return xp.zeros(nn.shape, dtype=bool)
+        query = idx_src.reshape(-1, 1) * stride + nn
+        pos = xp.minimum(xp.searchsorted(codes, query), codes.size - 1)
+        return codes[pos] == query
+
+def as_gold_lexicon(lexicon):
+    if lexicon is None or isinstance(lexicon, GoldLexicon):
+        return lexicon
+    return GoldLexicon(lexicon)
+
+@profiling.timed()
 def load_lexicon(filename, words_src, words_tgt, verbose=True):
     f = io.open(filename, 'r', encoding='utf-8')
-    lexicon = collections.defaultdict(set)
-    idx_src , idx_tgt = idx(words_src), idx(words_tgt)
-    vocab = set()
+    pairs = []
     for line in f:
         whitespace_parts = line.strip().split()
         tab_parts = line.strip().split("\t")
         if len(whitespace_parts) > 2 and len(tab_parts) == 2:
-            word_src, word_tgt = line.strip().split("\t")
+            pairs.append(tab_parts)
         else:
-            word_src, word_tgt = line.strip().split()
-        if word_src in idx_src and word_tgt in idx_tgt:
-            lexicon[idx_src[word_src]].add(idx_tgt[word_tgt])
-        vocab.add(word_src)
+            word_src, word_tgt = whitespace_parts
+            pairs.append((word_src, word_tgt))
+    f.close()
+    profiling.count("lexicon_pairs_parsed", len(pairs))
+    ids_src = as_vocabulary(words_src).ids(p[0] for p in pairs)
+    ids_tgt = as_vocabulary(words_tgt).ids(p[1] for p in pairs)
+    known = (ids_src >= 0) & (ids_tgt >= 0)
+    lexicon = GoldLexicon()
+    for i, j in zip(ids_src[known].tolist(), ids_tgt[known].tolist()):
+        lexicon[i].add(j)
+    lexicon.build_csr()
+    vocab = {p[0] for p in pairs}
     if verbose:
         coverage = len(lexicon) / float(len(vocab))
         print("Coverage of source vocab: %.4f" % (coverage))
     return lexicon, float(len(vocab))
 
+@profiling.timed()
 def compute_nn_accuracy(x_src, x_tgt, lexicon, acc_at=1, bsz=100, lexicon_size=-1):
     if lexicon_size < 0:
         lexicon_size = len(lexicon)
+    lexicon = as_gold_lexicon(lexicon)
     idx_src = list(lexicon.keys())
     acc = 0.0
-    x_src /= np.linalg.norm(x_src, axis=1)[:, np.newaxis] + 1e-8
-    x_tgt /= np.linalg.norm(x_tgt, axis=1)[:, np.newaxis] + 1e-8
+    xp = get_array_module(x_src, x_tgt)
+    x_src, x_tgt = as_compute(x_src), as_compute(x_tgt)
+    x_src /= xp.linalg.norm(x_src, axis=1)[:, xp.newaxis] + 1e-8
+    x_tgt /= xp.linalg.norm(x_tgt, axis=1)[:, xp.newaxis] + 1e-8
+    profiling.count("flops", 2 * len(idx_src) * x_tgt.shape[0] * x_tgt.shape[1])
     for i in range(0, len(idx_src), bsz):
         e = min(i + bsz, len(idx_src))
-        scores = np.dot(x_tgt, x_src[idx_src[i:e]].T)
+        scores = xp.dot(x_tgt, x_src[idx_src[i:e]].T)
         # pred = scores.argmax(axis=0)
         pred = scores.argpartition(acc_at, axis=0)[-acc_at:]
-        for j in range(i, e):
-            # if pred[j - i] in lexicon[idx_src[j]]:
-            if any(int(p) in lexicon[idx_src[j]] for p in pred[:, j-i]):
-                acc += 1.0
+        acc += float(lexicon.hits(idx_src[i:e], pred.T, x_tgt.shape[0]).any(axis=1).sum())
     return acc / lexicon_size
 
+@profiling.timed()
 def compute_csls_scores(x_src, x_tgt, idx_src, k=10, bsz=1024):
-    x_src /= np.linalg.norm(x_src, axis=1)[:, np.newaxis] + 1e-8
-    x_tgt /= np.linalg.norm(x_tgt, axis=1)[:, np.newaxis] + 1e-8
+    xp = get_array_module(x_src, x_tgt)
+    x_src, x_tgt = as_compute(x_src), as_compute(x_tgt)
+    x_src /= xp.linalg.norm(x_src, axis=1)[:, xp.newaxis] + 1e-8
+    x_tgt /= xp.linalg.norm(x_tgt, axis=1)[:, xp.newaxis] + 1e-8
 
     sr = x_src[list(idx_src)]
-    sc = np.dot(sr, x_tgt.T)
+    profiling.count("flops", 2 * (len(sr) + x_src.shape[0]) * x_tgt.shape[0] * x_tgt.shape[1])
+    profiling.count("bytes_allocated", 2 * len(sr) * x_tgt.shape[0] * sr.itemsize)
+    sc = xp.dot(sr, x_tgt.T)
     similarities = 2 * sc
-    sc2 = np.zeros(x_tgt.shape[0])
+    sc2 = xp.zeros(x_tgt.shape[0], dtype=x_tgt.dtype)
     for i in range(0, x_tgt.shape[0], bsz):
         j = min(i + bsz, x_tgt.shape[0])
-        sc_batch = np.dot(x_tgt[i:j, :], x_src.T)
-        dotprod = np.partition(sc_batch, -k, axis=1)[:, -k:]
-        sc2[i:j] = np.mean(dotprod, axis=1)
-    similarities -= sc2[np.newaxis, :]
+        sc_batch = xp.dot(x_tgt[i:j, :], x_src.T)
+        dotprod = xp.partition(sc_batch, -k, axis=1)[:, -k:]
+        sc2[i:j] = xp.mean(dotprod, axis=1)
+    similarities -= sc2[xp.newaxis, :]
 
     # nn = np.argmax(similarities, axis=1).tolist()
     return similarities
 
-def compute_csls_maps(x_src, words_src, x_tgt, lexicon, nn_words, acc_at=1, lexicon_size=-1, k=10, bsz=1024):
+@profiling.timed()
+def tile_shape(n_q, n_k, topk, itemsize, bsz, tile_bytes):
+    # Rows and columns of the tiles of topk_blocked_multi. Every element of a
+    # tile takes itemsize bytes in the product, itemsize in the score buffer
+    # and 8 in the int64 argpartition result, and the buffer also holds the
+    # topk best columns so far, so that a tile stays within tile_bytes.
+    per_element = 2 * itemsize + 8
+    rows = max(1, min(n_q, bsz, tile_bytes // (per_element * (topk + 1))))
+    cols = max(1, min(n_k, tile_bytes // (per_element * rows) - topk))
+    return rows, cols
+
+def topk_blocked_multi(x_q, x_k, topk, rankings, q_idx=None, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES):
+    # Top scoring columns of scale * x_q.x_k^T - penalty for every (scale, penalty)
+    # in rankings, walking the matrix in tiles of about tile_bytes so that it is
+    # never held in memory whole. Every tile product is shared by all rankings.
+    xp = get_array_module(x_q, x_k)
+    n_q = x_q.shape[0] if q_idx is None else len(q_idx)
+    n_k = x_k.shape[0]
+    topk = min(topk, n_k)
+    dtype = compute_dtype(x_q.dtype)
+    rows, cols = tile_shape(n_q, n_k, topk, dtype.itemsize, bsz, tile_bytes)
+    # Every tile product and its argpartition are fresh rows x cols arrays
+    profiling.count("flops", 2 * n_q * n_k * x_q.shape[1])
+    profiling.count("bytes_allocated", n_q * n_k * (dtype.itemsize + 8) + len(rankings) * n_q * topk * (dtype.itemsize + 8))
+    if n_q > 1 and csls_shard.use_workers(xp, 2 * n_q * n_k * x_q.shape[1]):
+        return csls_shard.topk_blocked_multi(x_q, x_k, topk, rankings, q_idx=q_idx, bsz=bsz, tile_bytes=tile_bytes, rows=rows)
+    top_scores = [xp.empty((n_q, topk), dtype=dtype) for _ in rankings]
+    top_idx = [xp.empty((n_q, topk), dtype=np.int64) for _ in rankings]
+    # Negated scores, the best columns so far followed by the current tile,
+    # so that argpartition picks the best ones without a negated copy
+    buf = xp.empty(rows * (topk + cols), dtype=dtype)
+    for i in range(0, n_q, rows):
+        e = min(i + rows, n_q)
+        q = x_q[i:e] if q_idx is None else x_q[q_idx[i:e]]
+        best = [(None, None) for _ in rankings]
+        for j in range(0, n_k, cols):
+            f = min(j + cols, n_k)
+            sims = xp.dot(q, x_k[j:f].T)
+            for r, (scale, penalty) in enumerate(rankings):
+                best_neg, best_idx = best[r]
+                nb = 0 if best_neg is None else best_neg.shape[1]
+                # A contiguous view, as argpartition is slower on strided rows
+                neg = buf[:(e - i) * (nb + f - j)].reshape(e - i, nb + f - j)
+                if nb:
+                    neg[:, :nb] = best_neg
+                xp.multiply(sims, -scale, out=neg[:, nb:])
+                if penalty is not None:
+                    neg[:, nb:] += penalty[xp.newaxis, j:f]
+                if neg.shape[1] > topk:
+                    part = xp.argpartition(neg, topk - 1, axis=1)[:, :topk]
+                else:
+                    part = xp.broadcast_to(xp.arange(neg.shape[1]), neg.shape)
+                # Columns below nb are earlier best ones, the others the tile's
+                cand = part + (j - nb)
+                if nb:
+                    kept = part < nb
+                    cand[kept] = xp.take_along_axis(best_idx, xp.where(kept, part, 0), axis=1)[kept]
+                best[r] = (xp.take_along_axis(neg, part, axis=1), cand)
+            # Gone before the next product is allocated
+            del sims
+        for r, (best_neg, best_idx) in enumerate(best):
+            order = xp.argsort(best_neg, axis=1, kind='stable')
+            top_scores[r][i:e] = -xp.take_along_axis(best_neg, order, axis=1)
+            top_idx[r][i:e] = xp.take_along_axis(best_idx, order, axis=1)
+    return list(zip(top_scores, top_idx))
+
+def topk_blocked(x_q, x_k, topk, q_idx=None, penalty=None, scale=1, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES):
+    return topk_blocked_multi(x_q, x_k, topk, [(scale, penalty)], q_idx=q_idx, bsz=bsz, tile_bytes=tile_bytes)[0]
+
+_penalty_memo = {}
+
+class PenaltyCache:
+    # CSLS penalties of one aligned embedding pair, kept in memory for the
+    # process and on disk under cache_dir so that later runs skip the sweep
+    def __init__(self, key, cache_dir=None):
+        self.key = key
+        self.cache_dir = cache_dir
+
+    def path(self, side, k):
+        return os.path.join(self.cache_dir, "%s.%s.k%d.npy" % (self.key, side, k))
+
+    def get(self, side, k, compute):
+        memo_key = (self.key, side, k)
+        if memo_key in _penalty_memo:
+            return _penalty_memo[memo_key]
+        penalty = None
+        if self.cache_dir is not None and os.path.isfile(self.path(side, k)):
+            try:
+                penalty = to_device(np.load(self.path(side, k)))
+            except (OSError, ValueError):
+                penalty = None
+        if penalty is None:
+            penalty = compute()
+            if self.cache_dir is not None:
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    tmp = "%s.%d.tmp.npy" % (self.path(side, k), os.getpid())
+                    np.save(tmp, to_host(penalty))
+                    os.replace(tmp, self.path(side, k))
+                except OSError as e:
+                    print("Could not write CSLS penalty cache: %s" % e)
+        _penalty_memo[memo_key] = penalty
+        return penalty
+
+def vectors_checksum(fname, cache_dir=None):
+    header = read_vec_cache_header(fname, cache_dir)
+    if header is not None:
+        return header["source_checksum"]
+    return file_checksum(fname)
+
+def csls_penalty_cache(src_emb, tgt_emb, maxload=200000, center=False, dtype=DEFAULT_DTYPE, cache_dir=None, extra=()):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(tgt_emb)), "csls_cache")
+    parts = [vectors_checksum(src_emb), vectors_checksum(tgt_emb), maxload, bool(center), np.dtype(dtype).name]
+    parts.extend(extra)
+    key = hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+    return PenaltyCache(key, cache_dir)
+
+def csls_penalty(x_src, x_tgt, side="tgt", k=10, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
+    # side="tgt" is the penalty of every target word (sc2), side="src" the
+    # same quantity for every source word
+    return csls_penalties(x_src, x_tgt, [k], side, bsz=bsz, tile_bytes=tile_bytes, penalty_cache=penalty_cache)[k]
+
+@profiling.timed()
+def csls_penalties(x_src, x_tgt, ks, side="tgt", bsz=1024, tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
+    # Penalties for several k from a single top-max(ks) sweep
+    top_scores = []
+    def compute(k):
+        if not top_scores:
+            x_q, x_k = (x_tgt, x_src) if side == "tgt" else (x_src, x_tgt)
+            top_scores.append(topk_blocked(x_q, x_k, max(ks), bsz=bsz, tile_bytes=tile_bytes)[0])
+        return top_scores[0][:, :k].mean(axis=1)
+    if penalty_cache is None:
+        return {k: compute(k) for k in ks}
+    return {k: penalty_cache.get(side, k, lambda k=k: compute(k)) for k in ks}
+
+@profiling.timed()
+def compute_csls_topk(x_src, x_tgt, idx_src, acc_at=1, k=10, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
+    xp = get_array_module(x_src, x_tgt)
+    x_src, x_tgt = as_compute(x_src), as_compute(x_tgt)
+    x_src /= xp.linalg.norm(x_src, axis=1)[:, xp.newaxis] + 1e-8
+    x_tgt /= xp.linalg.norm(x_tgt, axis=1)[:, xp.newaxis] + 1e-8
+
+    sc2 = csls_penalty(x_src, x_tgt, "tgt", k=k, bsz=bsz, tile_bytes=tile_bytes, penalty_cache=penalty_cache)
+    return topk_blocked(x_src, x_tgt, acc_at, q_idx=xp.asarray(idx_src, dtype=np.int64),
+                        penalty=sc2, scale=2, bsz=bsz, tile_bytes=tile_bytes)
+
+@profiling.timed()
+def compute_csls_maps(x_src, words_src, x_tgt, lexicon, nn_words, acc_at=1, lexicon_size=-1, k=10, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
     # idx_src = list(idx(words_src).values())
-    idx_map = idx(words_src)
-    idx_src = []
+    vocab_src = as_vocabulary(words_src)
     if nn_words:
-        idx_src = [idx for word, idx in idx_map.items() if word in nn_words]
+        ids = vocab_src.ids(nn_words)
+        idx_src = np.unique(ids[ids >= 0]).tolist()
     else:
-        idx_src = list(idx_map.values())
-    similarities = compute_csls_scores(x_src, x_tgt, idx_src, k=k, bsz=bsz)
-    nn = np.argpartition(-similarities, range(acc_at), axis=1)[:, :acc_at]
-    max_scores = np.take_along_axis(similarities, nn, axis=1)
+        idx_src = list(vocab_src.word2id.values())
+    max_scores, nn = compute_csls_topk(x_src, x_tgt, idx_src, acc_at=acc_at, k=k, bsz=bsz, tile_bytes=tile_bytes, penalty_cache=penalty_cache)
+    correct = np.zeros(len(nn), dtype=np.int64)
+    lexicon = as_gold_lexicon(lexicon)
+    if lexicon is not None:
+        xp = get_array_module(nn)
+        hit = lexicon.hits(idx_src, nn, x_tgt.shape[0]).any(axis=1)
+        correct = to_host(xp.where(lexicon.contains(idx_src, xp), xp.where(hit, 2, 0), 1))
+    # The map is only read on the host, move it there in one transfer
+    max_scores, nn = to_host(max_scores), to_host(nn)
     map = {}
     print(len(nn))
-    for k in range(0, len(nn)):
-        correct = 0
-        if lexicon != None:
-            if idx_src[k] not in lexicon:
-                correct = 1
-            elif any(int(w) in lexicon[idx_src[k]] for w in nn[k]):
-                correct = 2
-        map[idx_src[k]] = (nn[k], max_scores[k], correct)
+    for k, c in enumerate(correct.tolist()):
+        map[idx_src[k]] = (nn[k], max_scores[k], c)
     return map
 
-def compute_csls_accuracy(x_src, x_tgt, lexicon, acc_at=1, lexicon_size=-1, k=10, bsz=1024):
+@profiling.timed()
+def compute_csls_accuracy(x_src, x_tgt, lexicon, acc_at=1, lexicon_size=-1, k=10, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
     if lexicon_size < 0:
         lexicon_size = len(lexicon)
+    lexicon = as_gold_lexicon(lexicon)
     idx_src = list(lexicon.keys())
-    similarities = compute_csls_scores(x_src, x_tgt, idx_src, k=k, bsz=bsz)
-    nn = np.argpartition(-similarities, range(acc_at), axis=1)[:, :acc_at]
-    correct = 0.0
-    for k in range(0, len(lexicon)):
-        # if nn[k] in lexicon[idx_src[k]]:
-        if any(int(w) in lexicon[idx_src[k]] for w in nn[k]):
-            correct += 1.0
+    _, nn = compute_csls_topk(x_src, x_tgt, idx_src, acc_at=acc_at, k=k, bsz=bsz, tile_bytes=tile_bytes, penalty_cache=penalty_cache)
+    correct = float(lexicon.hits(idx_src, nn, x_tgt.shape[0]).any(axis=1).sum())
     print(correct, len(lexicon), lexicon_size)
     return correct / lexicon_size
+
+@profiling.timed()
+def compute_accuracies(x_src, x_tgt, lexicon, cutoffs=(1, 3, 5), csls_ks=(10,), lexicon_size=-1, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
+    # NN@c and CSLS@c for every cutoff c and CSLS k from one similarity pass,
+    # returned as {"nn": {c: acc}, "csls": {k: {c: acc}}}
+    if lexicon_size < 0:
+        lexicon_size = len(lexicon)
+    lexicon = as_gold_lexicon(lexicon)
+    idx_src = list(lexicon.keys())
+    xp = get_array_module(x_src, x_tgt)
+    x_src, x_tgt = as_compute(x_src), as_compute(x_tgt)
+    x_src /= xp.linalg.norm(x_src, axis=1)[:, xp.newaxis] + 1e-8
+    x_tgt /= xp.linalg.norm(x_tgt, axis=1)[:, xp.newaxis] + 1e-8
+
+    sc2 = csls_penalties(x_src, x_tgt, csls_ks, "tgt", bsz=bsz, tile_bytes=tile_bytes, penalty_cache=penalty_cache)
+    rankings = [(1, None)] + [(2, sc2[k]) for k in csls_ks]
+    results = topk_blocked_multi(x_src, x_tgt, max(cutoffs), rankings, q_idx=xp.asarray(idx_src, dtype=np.int64),
+                                 bsz=bsz, tile_bytes=tile_bytes)
+    accs = []
+    for _, nn in results:
+        hits = xp.cumsum(lexicon.hits(idx_src, nn, x_tgt.shape[0]), axis=1) > 0
+        accs.append({c: float(hits[:, min(c, hits.shape[1]) - 1].sum()) / lexicon_size for c in cutoffs})
+    return {"nn": accs[0], "csls": dict(zip(csls_ks, accs[1:]))}
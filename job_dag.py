@@ -0,0 +1,151 @@
+import os
+import json
+import asyncio
+from pathlib import Path
+from resource_pool import job_priority
+
+class JobFailed(RuntimeError):
+    pass
+
+class Job:
+    # One node of a JobDAG. run is a coroutine function that raises on
+    # failure. A job is complete when all its outputs exist or, if it has
+    # none, when the state file records it with the same signature. force
+    # reruns it even when it is complete.
+    def __init__(self, name, run, deps=(), cost=0, outputs=(), signature=None, force=False):
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.cost = cost
+        self.outputs = [Path(o) for o in outputs]
+        self.signature = signature
+        self.force = force
+
+class JobDAG:
+    # Jobs with explicit dependency edges. Ready jobs start longest remaining
+    # path first, where a path is the summed cost of a job and everything
+    # that depends on it, and a failed job blocks only its dependents.
+    # Completed jobs are recorded in state_file so that a rerun resumes, and
+    # the span of every job that ran in trace, a JobTrace.
+    def __init__(self, state_file=None, trace=None):
+        self.jobs = {}
+        self.trace = trace
+        self.state_file = Path(state_file) if state_file is not None else None
+        self.state = {}
+        if self.state_file is not None and self.state_file.exists():
+            try:
+                self.state = json.loads(self.state_file.read_text())
+            except ValueError:
+                self.state = {}
+
+    def add(self, job):
+        # Jobs are shared by name, the first one added wins
+        return self.jobs.setdefault(job.name, job)
+
+    def dependents(self):
+        dependents = {name: [] for name in self.jobs}
+        for job in self.jobs.values():
+            for dep in job.deps:
+                if dep not in self.jobs:
+                    raise ValueError(f"{job.name} depends on unknown job {dep}")
+                dependents[dep].append(job.name)
+        return dependents
+
+    def priorities(self):
+        dependents = self.dependents()
+        priority = {}
+        visiting = set()
+        def visit(name):
+            if name not in priority:
+                if name in visiting:
+                    raise ValueError(f"Dependency cycle through {name}")
+                visiting.add(name)
+                priority[name] = self.jobs[name].cost + max((visit(d) for d in dependents[name]), default=0)
+            return priority[name]
+        for name in self.jobs:
+            visit(name)
+        return priority
+
+    def is_complete(self, job):
+        if job.force:
+            return False
+        if job.outputs:
+            return all(o.exists() for o in job.outputs)
+        return job.name in self.state and self.state[job.name] == job.signature
+
+    def plan(self):
+        # Jobs to run: every incomplete job that something still needs, which
+        # is every incomplete sink and the incomplete dependencies of the
+        # jobs that run
+        dependents = self.dependents()
+        to_run = set()
+        def visit(name):
+            if name in to_run or self.is_complete(self.jobs[name]):
+                return
+            to_run.add(name)
+            for dep in self.jobs[name].deps:
+                visit(dep)
+        for name, names in dependents.items():
+            if not names:
+                visit(name)
+        return to_run
+
+    def record(self, job):
+        if self.state_file is None:
+            return
+        self.state[job.name] = job.signature
+        tmp = self.state_file.with_name(f"{self.state_file.name}.{os.getpid()}.tmp")
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps(self.state, indent=2, sort_keys=True))
+        os.replace(tmp, self.state_file)
+
+    async def _run_job(self, job, priority):
+        job_priority.set(priority)
+        if self.trace is None:
+            await job.run()
+            return
+        start = self.trace.now()
+        status = "failed"
+        try:
+            await job.run()
+            status = "done"
+        finally:
+            self.trace.job(job.name, start, self.trace.now(), status)
+
+    def deps(self):
+        return {name: job.deps for name, job in self.jobs.items()}
+
+    async def run(self):
+        # Returns the status of every job: done, skipped (complete before the
+        # run), failed or blocked (a dependency failed)
+        priority = self.priorities()
+        dependents = self.dependents()
+        to_run = self.plan()
+        status = {name: "skipped" for name in self.jobs if name not in to_run}
+        running = {}
+        while to_run or running:
+            ready = [name for name in to_run
+                     if all(status.get(dep) in ("done", "skipped") for dep in self.jobs[name].deps)]
+            for name in sorted(ready, key=lambda n: -priority[n]):
+                to_run.discard(name)
+                running[asyncio.ensure_future(self._run_job(self.jobs[name], priority[name]))] = name
+            if not running:
+                raise ValueError("Jobs %s can never become ready" % ", ".join(sorted(to_run)))
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                name = running.pop(task)
+                if task.exception() is None:
+                    status[name] = "done"
+                    self.record(self.jobs[name])
+                    continue
+                status[name] = "failed"
+                print(f"Failed {name}: {task.exception()}")
+                blocked = list(dependents[name])
+                while blocked:
+                    dependent = blocked.pop()
+                    if dependent in to_run:
+                        to_run.discard(dependent)
+                        status[dependent] = "blocked"
+                        print(f"Skip {dependent} as {name} failed")
+                        blocked.extend(dependents[dependent])
+        return status
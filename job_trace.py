@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import asyncio
+from pathlib import Path
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def process_tree_rss(pid, children):
+    # Resident memory in bytes of pid and its descendants, None when /proc is
+    # not available
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            if p == pid:
+                return None
+        stack.extend(children.get(p, ()))
+    return total
+
+def process_children():
+    # Parent pid -> child pids of every process in /proc
+    children = {}
+    try:
+        pids = [int(p) for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return children
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, the fields follow its ')'
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(pid)
+    return children
+
+def busy_time(spans):
+    # Length of the union of (start, end) spans
+    busy = 0.0
+    last_end = None
+    for start, end in sorted(spans):
+        if last_end is not None:
+            start = max(start, last_end)
+        if end > start:
+            busy += end - start
+        last_end = end if last_end is None else max(last_end, end)
+    return busy
+
+class JobTrace:
+    # Timeline of the subprocesses of an align.py run: when each one asked
+    # for resources, started and ended, its exit code, leased threads and
+    # GPU, and the peak RSS of its process tree sampled from /proc every
+    # interval seconds. Also records the span of every JobDAG job. Written
+    # as a Chrome trace (chrome://tracing, ui.perfetto.dev) and as a table.
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.started = time.time()
+        self._t0 = time.monotonic()
+        self.processes = []
+        self.jobs = []
+        self._live = {}
+        self._sampler = None
+
+    def now(self):
+        return time.monotonic() - self._t0
+
+    def job(self, name, start, end, status):
+        self.jobs.append({"name": name, "start": start, "end": end, "status": status})
+
+    async def run(self, name, kind, cmd, lease, requested, env=None):
+        # Runs cmd as a shell subprocess on lease, requested is when the
+        # lease was asked for. Returns the exit code.
+        record = {
+            "name": name, "kind": kind, "cmd": cmd,
+            "threads": lease.threads, "device": lease.device_id,
+            "requested": requested, "start": self.now(), "end": None,
+            "returncode": None, "peak_rss": None,
+        }
+        self.processes.append(record)
+        p = await asyncio.create_subprocess_shell(cmd, env=env)
+        self._live[p.pid] = record
+        if self._sampler is None or self._sampler.done():
+            self._sampler = asyncio.ensure_future(self._sample())
+        try:
+            await p.wait()
+        finally:
+            self._sample_once()
+            del self._live[p.pid]
+            record["end"] = self.now()
+            record["returncode"] = p.returncode
+        return p.returncode
+
+    def _sample_once(self):
+        children = process_children()
+        for pid, record in self._live.items():
+            rss = process_tree_rss(pid, children)
+            if rss is not None:
+                record["peak_rss"] = max(record["peak_rss"] or 0, rss)
+
+    async def _sample(self):
+        while self._live:
+            self._sample_once()
+            await asyncio.sleep(self.interval)
+
+    def critical_path(self, deps):
+        # Chain of jobs that ended the run: the job that ended last, then
+        # its dependency that ended last, and so on
+        spans = {job["name"]: job for job in self.jobs}
+        if not spans:
+            return []
+        name = max(spans, key=lambda n: spans[n]["end"])
+        path = [name]
+        while True:
+            ran = [d for d in deps.get(name, ()) if d in spans]
+            if not ran:
+                break
+            name = max(ran, key=lambda n: spans[n]["end"])
+            path.append(name)
+        return path[::-1]
+
+    def chrome_trace(self, deps=None):
+        # One trace process per resource: the CPU lanes, each GPU, and the
+        # queue of waiting requests, plus the DAG jobs. Lanes are assigned
+        # so that spans on one lane never overlap.
+        us = lambda t: round(t * 1e6)
+        events = []
+        pids = {}
+        lanes = {}
+
+        def pid_of(resource):
+            if resource not in pids:
+                pids[resource] = len(pids) + 1
+                events.append({"ph": "M", "name": "process_name", "pid": pids[resource], "args": {"name": resource}})
+                events.append({"ph": "M", "name": "process_sort_index", "pid": pids[resource], "args": {"sort_index": pids[resource]}})
+                lanes[resource] = []
+            return pids[resource]
+
+        def lane_of(resource, start, end):
+            ends = lanes[resource]
+            for i, lane_end in enumerate(ends):
+                if lane_end <= start:
+                    ends[i] = end
+                    return i
+            ends.append(end)
+            return len(ends) - 1
+
+        def span(resource, name, cat, start, end, args):
+            pid = pid_of(resource)
+            events.append({"ph": "X", "name": name, "cat": cat, "pid": pid, "tid": lane_of(resource, start, end),
+                           "ts": us(start), "dur": us(end - start), "args": args})
+
+        pid_of("DAG jobs")
+        for job in sorted(self.jobs, key=lambda j: j["start"]):
+            span("DAG jobs", job["name"], "job", job["start"], job["end"], {"status": job["status"]})
+        for record in sorted(self.processes, key=lambda r: r["requested"]):
+            if record["end"] is None:
+                continue
+            args = {k: record[k] for k in ("kind", "threads", "device", "returncode", "cmd")}
+            args["peak_rss_mb"] = None if record["peak_rss"] is None else round(record["peak_rss"] / 2**20, 1)
+            args["wait_s"] = round(record["start"] - record["requested"], 3)
+            if record["start"] > record["requested"]:
+                span("Queue", record["name"], "wait", record["requested"], record["start"], {"kind": record["kind"]})
+            resource = "CPU" if record["device"] is None else f"GPU {record['device']}"
+            span(resource, record["name"], record["kind"], record["start"], record["end"], args)
+        # Busy cores and GPU jobs over time as counters
+        changes = []
+        for record in self.processes:
+            if record["end"] is None:
+                continue
+            gpu = 0 if record["device"] is None else 1
+            changes.append((record["start"], record["threads"], gpu))
+            changes.append((record["end"], -record["threads"], -gpu))
+        cores = gpus = 0
+        counter_pid = pid_of("Usage")
+        for t, d_cores, d_gpus in sorted(changes):
+            cores += d_cores
+            gpus += d_gpus
+            events.append({"ph": "C", "name": "busy", "pid": counter_pid, "ts": us(t),
+                           "args": {"cores": cores, "gpu_jobs": gpus}})
+        if deps is not None:
+            for i, name in enumerate(self.critical_path(deps)):
+                job = next(j for j in self.jobs if j["name"] == name)
+                events.append({"ph": "i", "name": f"critical path {i}: {name}", "s": "g", "pid": pids["DAG jobs"],
+                               "tid": 0, "ts": us(job["end"])})
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started))}}
+
+    def write_chrome_trace(self, filename, deps=None):
+        filename = Path(filename)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(deps), f)
+
+    def summary(self, num_cores, num_gpus, deps=None):
+        lines = []
+        wall = max([r["end"] for r in self.processes if r["end"] is not None] +
+                   [j["end"] for j in self.jobs] + [0.0])
+        header = f"{'job':<24} {'kind':<16} {'wait_s':>8} {'run_s':>8} {'exit':>5} {'threads':>7} {'gpu':>4} {'peak_rss_mb':>11}"
+        lines.append(header)
+        lines.append("-" * len(header))
+        for record in sorted(self.processes, key=lambda r: r["start"]):
+            if record["end"] is None:
+                continue
+            rss = "-" if record["peak_rss"] is None else f"{record['peak_rss'] / 2**20:.1f}"
+            device = "-" if record["device"] is None else str(record["device"])
+            lines.append(f"{record['name']:<24} {record['kind']:<16} "
+                         f"{record['start'] - record['requested']:>8.1f} {record['end'] - record['start']:>8.1f} "
+                         f"{record['returncode']:>5} {record['threads']:>7} {device:>4} {rss:>11}")
+        lines.append("")
+        kinds = {}
+        for record in self.processes:
+            if record["end"] is not None:
+                total = kinds.setdefault(record["kind"], [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += record["start"] - record["requested"]
+                total[2] += record["end"] - record["start"]
+        for kind, (n, wait, run) in sorted(kinds.items()):
+            lines.append(f"{kind}: {n} runs, {run:.1f}s running, {wait:.1f}s waiting")
+        lines.append(f"Wall time: {wall:.1f}s")
+        if wall > 0:
+            core_s = sum((r["end"] - r["start"]) * r["threads"] for r in self.processes if r["end"] is not None)
+            lines.append(f"CPU: {core_s:.1f} core-s of {num_cores * wall:.1f}, {100 * core_s / (num_cores * wall):.0f}% busy")
+            for device in range(num_gpus):
+                busy = busy_time([(r["start"], r["end"]) for r in self.processes
+                                  if r["end"] is not None and r["device"] == device])
+                lines.append(f"GPU {device}: {busy:.1f}s with a job, {100 * busy / wall:.0f}% busy")
+        if deps is not None:
+            path = self.critical_path(deps)
+            if path:
+                lines.append(f"Critical path: {' -> '.join(path)}")
+        return "\n".join(lines)
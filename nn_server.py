@@ -0,0 +1,253 @@
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from eval_utils import *
+from create_emos import load_emo_lex
+from create_emos_utils import translations_from_arrays, get_emo_ratings
+from backend import set_backend, add_backend_argument, backend_name
+
+parser = argparse.ArgumentParser(description='Server for nearest neighbours and derived emotions of source words')
+parser.add_argument("--src_emb", type=str, default='', help="Load source embeddings")
+parser.add_argument("--tgt_emb", type=str, default='', help="Load target embeddings")
+parser.add_argument("--emo_lex", type=str, default='', help="Load target emotion lexicon")
+parser.add_argument('--center', action='store_true', help='whether to center embeddings or not')
+parser.add_argument("--maxload", type=int, default=200000)
+parser.add_argument("--dtype", choices=DTYPES, default="float32", help="Floating point precision of the embeddings")
+parser.add_argument("--csls_k", type=int, default=10, help="Neighbourhood size of the CSLS penalty")
+parser.add_argument("--topk", type=int, default=3, help="Default number of translations per word")
+parser.add_argument("--max_topk", type=int, default=100, help="Largest number of translations a request may ask for")
+parser.add_argument("--tile_mb", type=int, default=DEFAULT_TILE_BYTES >> 20, help="Memory budget in MB for the working arrays of one tile of CSLS scores")
+parser.add_argument("--penalty_cache_dir", type=str, default='', help="Directory for cached CSLS penalties, defaults to csls_cache next to the target embeddings")
+parser.add_argument("--no_penalty_cache", action='store_true', help="Always recompute CSLS penalties")
+parser.add_argument("--max_batch", type=int, default=1024, help="Most words answered by one similarity product")
+parser.add_argument("--batch_wait_ms", type=float, default=2.0, help="How long to wait for more requests before running a batch")
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8765)
+add_backend_argument(parser)
+
+class ServerStats:
+    # Request latencies and batch sizes over the last `window` requests
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.words = 0
+        self.batches = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+
+    def add_request(self, num_words, latency):
+        with self.lock:
+            self.requests += 1
+            self.words += num_words
+            self.latencies.append(latency)
+
+    def add_batch(self, num_words):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes.append(num_words)
+
+    def summary(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            latencies = np.array(self.latencies, dtype=float) * 1000
+            batch_sizes = np.array(self.batch_sizes, dtype=float)
+            stats = {
+                "uptime_s": round(uptime, 3),
+                "requests": self.requests,
+                "words": self.words,
+                "batches": self.batches,
+                "requests_per_s": round(self.requests / uptime, 3) if uptime > 0 else 0.0,
+                "words_per_s": round(self.words / uptime, 3) if uptime > 0 else 0.0,
+                "mean_batch_words": round(float(batch_sizes.mean()), 3) if batch_sizes.size else 0.0,
+            }
+            for p in (50, 95, 99):
+                stats["latency_ms_p%d" % p] = round(float(np.percentile(latencies, p)), 3) if latencies.size else 0.0
+            return stats
+
+class NNIndex:
+    # Aligned embedding pair, CSLS penalties and target emotion lexicon held
+    # in memory. Queries from concurrent requests are collected by a worker
+    # thread and answered with one top-k pass per batch.
+    def __init__(self, x_src, words_src, x_tgt, words_tgt, emo_lex_tgt=None, csls_k=10, max_topk=100,
+                 max_batch=1024, batch_wait=0.002, tile_bytes=DEFAULT_TILE_BYTES, penalty_cache=None):
+        xp = get_array_module(x_src, x_tgt)
+        # Normalised as in compute_csls_topk so that answers match compute_nns
+        self.x_src = as_compute(x_src) / (xp.linalg.norm(x_src, axis=1)[:, xp.newaxis] + 1e-8)
+        self.x_tgt = as_compute(x_tgt) / (xp.linalg.norm(x_tgt, axis=1)[:, xp.newaxis] + 1e-8)
+        self.words_src = words_src
+        self.words_tgt = words_tgt
+        self.word2id = idx(words_src)
+        self.emo_lex_tgt = emo_lex_tgt or {}
+        self.max_topk = max_topk
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.tile_bytes = tile_bytes
+        self.xp = xp
+        self.sc2 = csls_penalty(self.x_src, self.x_tgt, "tgt", k=csls_k, tile_bytes=tile_bytes, penalty_cache=penalty_cache)
+        self.stats = ServerStats()
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self.run_batches, daemon=True)
+        self.worker.start()
+
+    def query(self, words, k):
+        # Blocks until the batch holding these words has been answered
+        start = time.perf_counter()
+        k = max(1, min(k, self.max_topk))
+        known = [w for w in words if w in self.word2id]
+        result = {"results": [], "unknown": [w for w in words if w not in self.word2id]}
+        if known:
+            job = {"ids": [self.word2id[w] for w in known], "k": k, "done": threading.Event()}
+            self.pending.put(job)
+            job["done"].wait()
+            if "error" in job:
+                raise job["error"]
+            result["results"] = job["results"]
+        self.stats.add_request(len(words), time.perf_counter() - start)
+        return result
+
+    def next_batch(self):
+        jobs = [self.pending.get()]
+        num_words = len(jobs[0]["ids"])
+        deadline = time.perf_counter() + self.batch_wait
+        while num_words < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                job = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            num_words += len(job["ids"])
+        return jobs
+
+    def run_batches(self):
+        while True:
+            jobs = self.next_batch()
+            try:
+                self.answer(jobs)
+            except Exception as e:
+                for job in jobs:
+                    job["error"] = e
+            for job in jobs:
+                job["done"].set()
+
+    def answer(self, jobs):
+        # Unique source ids of all jobs, ranked against the target side at once
+        ids = sorted({i for job in jobs for i in job["ids"]})
+        k = max(job["k"] for job in jobs)
+        scores, nn = topk_blocked(self.x_src, self.x_tgt, k, q_idx=self.xp.asarray(ids, dtype=np.int64),
+                                  penalty=self.sc2, scale=2, tile_bytes=self.tile_bytes)
+        self.stats.add_batch(len(ids))
+        arrays = {"src_idx": np.array(ids), "tgt_idx": to_host(nn), "scores": to_host(scores)}
+        trans, _, _ = translations_from_arrays(arrays, self.words_src, self.words_tgt)
+        rows = {i: row for i, row in zip(ids, trans)}
+        for job in jobs:
+            job_trans = [[rows[i][0], rows[i][1][:job["k"]]] for i in job["ids"]]
+            emotions = {emotion: get_emo_ratings(job_trans, lex) for emotion, lex in self.emo_lex_tgt.items()}
+            job["results"] = [{
+                "word": word,
+                "translations": [{"word": w, "score": s} for w, s in tgt_words],
+                "emotions": {emotion: ratings[word] for emotion, ratings in emotions.items() if word in ratings},
+            } for word, tgt_words in job_trans]
+
+class NNRequestHandler(BaseHTTPRequestHandler):
+    # GET  /translate?word=<w>&word=<w>&k=<k>
+    # POST /translate  {"words": [...], "k": <k>}
+    # GET  /stats
+    index = None
+    default_k = 3
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def translate(self, words, k):
+        if not words:
+            self.send_json({"error": "no words given"}, 400)
+            return
+        try:
+            result = self.index.query(words, k)
+        except Exception as e:
+            # A failed batch is an answer too, not a dropped connection
+            self.send_json({"error": "%s: %s" % (type(e).__name__, e)}, 500)
+            return
+        self.send_json(result)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/stats":
+            self.send_json(self.index.stats.summary())
+        elif url.path == "/translate":
+            try:
+                k = int(query.get("k", [self.default_k])[0])
+            except ValueError:
+                self.send_json({"error": "k must be an integer"}, 400)
+                return
+            self.translate(query.get("word", []), k)
+        else:
+            self.send_json({"error": "unknown path %s" % url.path}, 404)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/translate":
+            self.send_json({"error": "unknown path %s" % self.path}, 404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            words = [str(w) for w in request.get("words", [])]
+            k = int(request.get("k", self.default_k))
+        except (ValueError, AttributeError, TypeError):
+            self.send_json({"error": "expected a JSON object with words and k"}, 400)
+            return
+        self.translate(words, k)
+
+    def log_message(self, format, *args):
+        pass
+
+class NNServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 resets bursts of concurrent clients
+    request_queue_size = 128
+    daemon_threads = True
+
+def main(params):
+    set_backend(params.backend)
+    print("Serving nearest neighbours of %s in %s (%s backend)" % (params.src_emb, params.tgt_emb, backend_name()))
+
+    words_tgt, x_tgt = load_vectors(params.tgt_emb, maxload=params.maxload, center=params.center, dtype=params.dtype)
+    words_src, x_src = load_vectors(params.src_emb, maxload=params.maxload, center=params.center, dtype=params.dtype)
+    emo_lex_tgt = {}
+    if params.emo_lex:
+        emo_lex_tgt = load_emo_lex(params.emo_lex, set(words_tgt))
+
+    penalty_cache = None
+    if not params.no_penalty_cache:
+        penalty_cache = csls_penalty_cache(params.src_emb, params.tgt_emb, params.maxload, params.center, params.dtype,
+                                           cache_dir=params.penalty_cache_dir or None)
+    NNRequestHandler.index = NNIndex(x_src, words_src, x_tgt, words_tgt, emo_lex_tgt, csls_k=params.csls_k,
+                                     max_topk=params.max_topk, max_batch=params.max_batch,
+                                     batch_wait=params.batch_wait_ms / 1000, tile_bytes=params.tile_mb << 20,
+                                     penalty_cache=penalty_cache)
+    NNRequestHandler.default_k = params.topk
+    server = NNServer((params.host, params.port), NNRequestHandler)
+    print("Listening on http://%s:%d" % (params.host, params.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,55 @@
+import io
+import os
+import numpy as np
+
+# Binary nearest neighbour file written by compute_nns next to the TSV path:
+#   src_idx   (N,)   source word indices
+#   tgt_idx   (N, k) target word indices, best first
+#   scores    (N, k) CSLS scores
+#   correct   (N,)   0 wrong, 1 not in the test dictionary, 2 correct
+#   words_src, words_tgt  vocabularies as newline separated UTF-8 bytes
+
+def nns_binary_path(nns_file):
+    nns_file = str(nns_file)
+    if nns_file.endswith(".npz"):
+        return nns_file
+    return os.path.splitext(nns_file)[0] + ".nns.npz"
+
+def encode_words(words):
+    return np.frombuffer("\n".join(words).encode("utf-8"), dtype=np.uint8)
+
+def decode_words(blob):
+    if blob.size == 0:
+        return []
+    return blob.tobytes().decode("utf-8").split("\n")
+
+def nns_arrays(nns):
+    # compute_csls_maps output as arrays
+    n = len(nns)
+    values = list(nns.values())
+    k = len(values[0][0]) if values else 0
+    return {
+        "src_idx": np.fromiter(nns.keys(), dtype=np.int32, count=n),
+        "tgt_idx": np.array([v[0] for v in values], dtype=np.int32).reshape(n, k),
+        "scores": np.array([v[1] for v in values], dtype=np.float32).reshape(n, k),
+        "correct": np.fromiter((v[2] for v in values), dtype=np.int8, count=n),
+    }
+
+def save_nns_binary(filename, arrays, words_src, words_tgt):
+    tmp = "%s.%d.tmp.npz" % (filename, os.getpid())
+    np.savez(tmp, words_src=encode_words(words_src), words_tgt=encode_words(words_tgt), **arrays)
+    os.replace(tmp, filename)
+
+def load_nns_binary(filename):
+    with np.load(filename) as f:
+        arrays = {name: f[name] for name in ("src_idx", "tgt_idx", "scores", "correct")}
+        arrays["words_src"] = decode_words(f["words_src"])
+        arrays["words_tgt"] = decode_words(f["words_tgt"])
+    return arrays
+
+def save_nns_tsv(filename, arrays, words_src, words_tgt):
+    fout = io.open(filename, "w", encoding="utf-8")
+    for src_idx, tgt_idx, scores, correct in zip(arrays["src_idx"], arrays["tgt_idx"], arrays["scores"], arrays["correct"]):
+        tgt_words = ",".join((words_tgt[int(idx)] for idx in tgt_idx))
+        fout.write("%s\t%s\t%s\t%d\n" % (words_src[int(src_idx)], tgt_words, ",".join(map(lambda s: str(s.round(4)), scores)), int(correct)))
+    fout.close()
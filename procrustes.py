@@ -0,0 +1,81 @@
+import numpy as np
+import profiling
+from backend import get_array_module, to_host
+from eval_utils import topk_blocked, csls_penalty, load_lexicon, DEFAULT_TILE_BYTES
+from vocab import as_vocabulary
+
+# Iterative Procrustes refinement with CSLS mutual nearest neighbour
+# dictionary induction (Conneau et al., 2018) on normalised embedding
+# matrices. Runs on the array backend of the matrices.
+
+def identical_pairs(words_src, words_tgt, max_rank=0):
+    # Seed dictionary of the words spelled the same in both languages, such
+    # as names and numbers, among the max_rank most frequent words of each
+    vocab_tgt = as_vocabulary(words_tgt)
+    src = np.arange(len(words_src) if max_rank <= 0 else min(max_rank, len(words_src)))
+    tgt = vocab_tgt.ids(words_src[i] for i in src.tolist())
+    known = (tgt >= 0) & ((tgt < max_rank) if max_rank > 0 else True)
+    return src[known], tgt[known]
+
+def dictionary_pairs(filename, words_src, words_tgt):
+    # Seed dictionary from a test dictionary style file of word pairs
+    lexicon, _ = load_lexicon(filename, words_src, words_tgt, verbose=False)
+    pairs = [(i, j) for i in sorted(lexicon) for j in sorted(lexicon[i])]
+    return np.array([p[0] for p in pairs], dtype=np.int64), np.array([p[1] for p in pairs], dtype=np.int64)
+
+@profiling.timed()
+def procrustes(x_src, x_tgt, src, tgt, bsz=65536):
+    # Orthogonal W minimising ||x_src[src] W - x_tgt[tgt]||, U V^T from the
+    # SVD of the d x d cross-covariance, which is summed over batches of
+    # pairs so that the gathered rows are never held whole
+    xp = get_array_module(x_src, x_tgt)
+    d = x_src.shape[1]
+    m = xp.zeros((d, d), dtype=np.float64)
+    src, tgt = xp.asarray(src), xp.asarray(tgt)
+    for i in range(0, len(src), bsz):
+        m += xp.dot(x_src[src[i:i + bsz]].T.astype(np.float64), x_tgt[tgt[i:i + bsz]].astype(np.float64))
+    profiling.count("flops", 2 * len(src) * d * d)
+    u, _, vt = xp.linalg.svd(m)
+    return xp.dot(u, vt).astype(x_src.dtype)
+
+@profiling.timed()
+def csls_mutual_nn(x_src, x_tgt, k=10, max_rank=15000, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES):
+    # Pairs (i, j) where j is the CSLS nearest neighbour of source word i and
+    # i the CSLS nearest neighbour of target word j, among the max_rank most
+    # frequent words of each language
+    xp = get_array_module(x_src, x_tgt)
+    if max_rank > 0:
+        x_src, x_tgt = x_src[:max_rank], x_tgt[:max_rank]
+    penalty_tgt = csls_penalty(x_src, x_tgt, "tgt", k=k, bsz=bsz, tile_bytes=tile_bytes)
+    penalty_src = csls_penalty(x_src, x_tgt, "src", k=k, bsz=bsz, tile_bytes=tile_bytes)
+    _, fwd = topk_blocked(x_src, x_tgt, 1, penalty=penalty_tgt, scale=2, bsz=bsz, tile_bytes=tile_bytes)
+    _, bwd = topk_blocked(x_tgt, x_src, 1, penalty=penalty_src, scale=2, bsz=bsz, tile_bytes=tile_bytes)
+    fwd, bwd = fwd[:, 0], bwd[:, 0]
+    src = xp.arange(len(fwd))
+    mutual = bwd[fwd] == src
+    return src[mutual], fwd[mutual]
+
+@profiling.timed()
+def refine(x_src, x_tgt, src, tgt, n_iter=5, k=10, max_rank=15000, bsz=1024, tile_bytes=DEFAULT_TILE_BYTES, log_file=None):
+    # Alternates Procrustes on the current dictionary, starting from the seed
+    # pairs (src, tgt), with a new dictionary of CSLS mutual nearest
+    # neighbours of the mapped source words. Stops early once the dictionary
+    # no longer changes. Both matrices are expected to be normalised.
+    # Returns W, so that x_src W is aligned to x_tgt.
+    if len(src) == 0:
+        raise ValueError("Procrustes refinement needs at least one seed pair")
+    xp = get_array_module(x_src, x_tgt)
+    w = procrustes(x_src, x_tgt, src, tgt)
+    print("Seed dictionary: %d pairs" % len(src), file=log_file, flush=True)
+    pairs = None
+    for it in range(n_iter):
+        new_src, new_tgt = csls_mutual_nn(xp.dot(x_src, w), x_tgt, k=k, max_rank=max_rank, bsz=bsz, tile_bytes=tile_bytes)
+        new_pairs = (to_host(new_src), to_host(new_tgt))
+        print("Iteration %d: %d mutual nearest neighbour pairs" % (it, len(new_pairs[0])), file=log_file, flush=True)
+        if len(new_pairs[0]) == 0:
+            break
+        if pairs is not None and all(np.array_equal(a, b) for a, b in zip(pairs, new_pairs)):
+            break
+        pairs = new_pairs
+        w = procrustes(x_src, x_tgt, new_src, new_tgt)
+    return w
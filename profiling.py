@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+
+# Timers, counters and peak memory of the evaluation hot paths. Off by
+# default: timer() then hands out a shared no-op context manager and count()
+# returns at once, so instrumented functions pay one global lookup per call.
+# enable() starts a Profile that also samples the resident memory of the
+# process in a background thread.
+
+_profile = None
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def current_rss():
+    # Resident memory of this process in bytes, the peak so far where /proc
+    # is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except (ImportError, OSError):
+            return 0
+
+class Profile:
+    # Timer paths are the names of the open timers joined by "/", so a
+    # function shows up under every stage that calls it
+    def __init__(self, sample_interval=0.01):
+        self.sample_interval = sample_interval
+        self.timers = {}
+        self.counters = {}
+        self.started = time.perf_counter()
+        self.peak_rss = current_rss()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._open = []
+        self._stop = threading.Event()
+        self._sampler = None
+        if sample_interval:
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            self.observe_rss()
+
+    def observe_rss(self):
+        rss = current_rss()
+        with self._lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            for entry in self._open:
+                entry["peak_rss"] = max(entry["peak_rss"], rss)
+        return rss
+
+    def enter(self, name):
+        stack = self._stack()
+        path = f"{stack[-1]['path']}/{name}" if stack else name
+        rss = current_rss()
+        entry = {"path": path, "start": time.perf_counter(), "rss": rss, "peak_rss": rss}
+        stack.append(entry)
+        with self._lock:
+            self._open.append(entry)
+        return entry
+
+    def exit(self, entry):
+        elapsed = time.perf_counter() - entry["start"]
+        rss = self.observe_rss()
+        self._stack().pop()
+        with self._lock:
+            self._open.remove(entry)
+            timer = self.timers.setdefault(entry["path"], {"calls": 0, "total_s": 0.0, "peak_rss": 0, "peak_growth": 0})
+            timer["calls"] += 1
+            timer["total_s"] += elapsed
+            timer["peak_rss"] = max(timer["peak_rss"], entry["peak_rss"], rss)
+            timer["peak_growth"] = max(timer["peak_growth"], max(entry["peak_rss"], rss) - entry["rss"])
+
+    def count(self, name, n):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.observe_rss()
+
+    def to_dict(self):
+        mb = lambda b: round(b / 2**20, 1)
+        with self._lock:
+            return {
+                "wall_s": round(time.perf_counter() - self.started, 6),
+                "peak_rss_mb": mb(self.peak_rss),
+                "timers": {path: {"calls": t["calls"], "total_s": round(t["total_s"], 6),
+                                  "peak_rss_mb": mb(t["peak_rss"]), "peak_growth_mb": mb(t["peak_growth"])}
+                           for path, t in self.timers.items()},
+                "counters": dict(self.counters),
+            }
+
+class _Timer:
+    __slots__ = ("profile", "name", "entry")
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.entry = self.profile.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.exit(self.entry)
+        return False
+
+_null_timer = contextlib.nullcontext()
+
+def enable(sample_interval=0.01):
+    # Starts a new profile, replacing the current one
+    global _profile
+    if _profile is not None:
+        _profile.stop()
+    _profile = Profile(sample_interval)
+    return _profile
+
+def disable():
+    # Stops profiling and returns the profile that was collected
+    global _profile
+    profile, _profile = _profile, None
+    if profile is not None:
+        profile.stop()
+    return profile
+
+def enabled():
+    return _profile is not None
+
+def timer(name):
+    if _profile is None:
+        return _null_timer
+    return _Timer(_profile, name)
+
+def timed(name=None):
+    # Decorator timing every call of a function under its name
+    def decorate(fn):
+        timer_name = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return fn(*args, **kwargs)
+            with _Timer(_profile, timer_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    if _profile is not None:
+        _profile.count(name, n)
+
+@contextlib.contextmanager
+def profile_to(filename, sample_interval=0.01):
+    # Profiles the block when filename is given and writes the profile there
+    if not filename:
+        yield None
+        return
+    profile = enable(sample_interval)
+    try:
+        yield profile
+    finally:
+        disable()
+        write_profile(filename, profile.to_dict())
+
+def add_profile_argument(parser):
+    parser.add_argument("--profile_file", type=str, default=None,
+                        help="Write timers, counters and peak memory of this run as JSON to this file")
+
+def write_profile(filename, profile):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    os.replace(tmp, filename)
+
+def merge_profiles(profiles, prefixes=None):
+    # One profile from several, such as the stage subprocesses of a
+    # language. Timer paths get the matching prefix, counters are summed.
+    merged = {"wall_s": 0.0, "peak_rss_mb": 0.0, "timers": {}, "counters": {}}
+    for i, profile in enumerate(profiles):
+        prefix = prefixes[i] if prefixes is not None else None
+        merged["wall_s"] += profile["wall_s"]
+        merged["peak_rss_mb"] = max(merged["peak_rss_mb"], profile["peak_rss_mb"])
+        for path, t in profile["timers"].items():
+            path = f"{prefix}/{path}" if prefix else path
+            total = merged["timers"].setdefault(path, {"calls": 0, "total_s": 0.0, "peak_rss_mb": 0.0, "peak_growth_mb": 0.0})
+            total["calls"] += t["calls"]
+            total["total_s"] = round(total["total_s"] + t["total_s"], 6)
+            total["peak_rss_mb"] = max(total["peak_rss_mb"], t["peak_rss_mb"])
+            total["peak_growth_mb"] = max(total["peak_growth_mb"], t["peak_growth_mb"])
+        for name, n in profile["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + n
+    merged["wall_s"] = round(merged["wall_s"], 6)
+    return merged
+
+def format_profiles(profiles):
+    # Table of the timers of {name: profile} summed over the profiles, in
+    # call tree order, followed by the counters
+    total = merge_profiles(list(profiles.values()))
+    wall = total["wall_s"] or 1.0
+    width = max([len(path.split("/")[-1]) + 2 * path.count("/") for path in total["timers"]] + [5])
+    header = f"{'timer':<{width}} {'calls':>8} {'total_s':>10} {'%wall':>6} {'mean_ms':>10} {'peak_rss_mb':>11} {'growth_mb':>9}"
+    lines = [f"{len(profiles)} profiles, {total['wall_s']:.2f}s wall, peak RSS {total['peak_rss_mb']:.1f} MB", "", header, "-" * len(header)]
+    for path in sorted(total["timers"], key=lambda p: p.split("/")):
+        t = total["timers"][path]
+        label = "  " * path.count("/") + path.split("/")[-1]
+        lines.append(f"{label:<{width}} {t['calls']:>8} {t['total_s']:>10.3f} {100 * t['total_s'] / wall:>6.1f} "
+                     f"{1000 * t['total_s'] / t['calls']:>10.3f} {t['peak_rss_mb']:>11.1f} {t['peak_growth_mb']:>9.1f}")
+    if total["counters"]:
+        lines.append("")
+        for name in sorted(total["counters"]):
+            lines.append(f"{name:<{width}} {total['counters'][name]:>20,}")
+    return "\n".join(lines)
@@ -0,0 +1,113 @@
+import os
+import asyncio
+import itertools
+import contextlib
+import contextvars
+
+# Environment variables that cap the threads of numpy, torch and friends
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+# Priority of the resource requests made by the current task, set by
+# JobDAG. Higher priority requests that fit are served first.
+job_priority = contextvars.ContextVar("job_priority", default=0)
+
+class Lease:
+    # Resources handed to one subprocess: a thread count, and a GPU id with
+    # the GPU memory it declared when it asked for a GPU
+    def __init__(self, threads, device_id=None, gpu_mem_mb=0):
+        self.threads = threads
+        self.device_id = device_id
+        self.gpu_mem_mb = gpu_mem_mb
+
+    def env(self):
+        # Environment for the subprocess so that its libraries stay within
+        # the leased threads
+        env = dict(os.environ)
+        for var in THREAD_ENV_VARS:
+            env[var] = str(self.threads)
+        return env
+
+class ResourcePool:
+    # CPU cores, GPU ids and optionally GPU memory as separate budgets shared
+    # by concurrent asyncio tasks. Every subprocess asks for what it needs and
+    # waits until it fits. A CPU request is granted as many threads as are
+    # free, between its min_threads and max_threads. Without gpu_mem_mb every
+    # GPU job gets a device to itself; with it, jobs share a device as long
+    # as their declared memory fits. Waiting requests are served in order of
+    # job_priority, a request only goes ahead of a higher priority one that
+    # does not fit yet.
+    def __init__(self, num_cores=None, num_gpus=0, gpu_mem_mb=None):
+        self.num_cores = num_cores or os.cpu_count() or 1
+        self.num_gpus = num_gpus
+        self.gpu_mem_mb = gpu_mem_mb
+        self._free_cores = self.num_cores
+        self._free_gpu_mem = {i: gpu_mem_mb for i in range(num_gpus)}
+        self._gpu_jobs = {i: 0 for i in range(num_gpus)}
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+
+    def _pick_device(self, gpu_mem_mb):
+        for device_id in range(self.num_gpus):
+            if self.gpu_mem_mb is None:
+                if self._gpu_jobs[device_id] == 0:
+                    return device_id
+            elif self._free_gpu_mem[device_id] >= gpu_mem_mb:
+                return device_id
+        return None
+
+    def _fits(self, min_threads, gpu, gpu_mem_mb):
+        if self._free_cores < min_threads:
+            return False
+        return not gpu or self._pick_device(gpu_mem_mb) is not None
+
+    def _first_in_line(self, entry):
+        return not any(other < entry and self._fits(*other[2]) for other in self._waiting)
+
+    async def acquire(self, min_threads=1, max_threads=1, gpu=False, gpu_mem_mb=0, priority=None):
+        if gpu and self.num_gpus == 0:
+            raise ValueError("A GPU was requested but the pool has no GPUs")
+        if gpu and self.gpu_mem_mb is not None and gpu_mem_mb > self.gpu_mem_mb:
+            raise ValueError("%d MB of GPU memory requested, GPUs have %d MB" % (gpu_mem_mb, self.gpu_mem_mb))
+        # A request larger than the machine would never fit
+        min_threads = max(1, min(min_threads, self.num_cores))
+        max_threads = max(min_threads, max_threads)
+        if priority is None:
+            priority = job_priority.get()
+        request = (min_threads, gpu, gpu_mem_mb)
+        entry = (-priority, next(self._seq), request)
+        async with self._cond:
+            self._waiting.append(entry)
+            try:
+                await self._cond.wait_for(lambda: self._fits(*request) and self._first_in_line(entry))
+            finally:
+                self._waiting.remove(entry)
+            threads = min(max_threads, self._free_cores)
+            self._free_cores -= threads
+            device_id = None
+            if gpu:
+                device_id = self._pick_device(gpu_mem_mb)
+                self._gpu_jobs[device_id] += 1
+                if self.gpu_mem_mb is not None:
+                    self._free_gpu_mem[device_id] -= gpu_mem_mb
+            # Lower priority requests that deferred to this one may fit in
+            # what is left
+            self._cond.notify_all()
+            return Lease(threads, device_id, gpu_mem_mb if gpu else 0)
+
+    async def release(self, lease):
+        async with self._cond:
+            self._free_cores += lease.threads
+            if lease.device_id is not None:
+                self._gpu_jobs[lease.device_id] -= 1
+                if self.gpu_mem_mb is not None:
+                    self._free_gpu_mem[lease.device_id] += lease.gpu_mem_mb
+            self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def lease(self, min_threads=1, max_threads=1, gpu=False, gpu_mem_mb=0, priority=None):
+        lease = await self.acquire(min_threads, max_threads, gpu, gpu_mem_mb, priority)
+        try:
+            yield lease
+        finally:
+            await self.release(lease)
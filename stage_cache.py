@@ -0,0 +1,112 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+import profiling
+from eval_utils import file_checksum, write_json_atomic
+
+# Bump when a stage's outputs change for the same inputs
+STAGE_CACHE_VERSION = 2
+
+def link_or_copy(src, dst):
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class StageCache:
+    # Outputs of eval.py stages stored under a hash of their input files and
+    # parameters. Outputs are hard-linked in and out of the cache, so stages
+    # must write to fresh files (see remove_outputs).
+    def __init__(self, cache_dir, force=False):
+        self.cache_dir = Path(cache_dir)
+        self.force = force
+        self._checksums_dir = self.cache_dir/"checksums"
+        self._checksums_dir.mkdir(parents=True, exist_ok=True)
+
+    def checksum(self, fname):
+        # Content hashes are remembered by path, size and mtime so that
+        # multi-hundred-MB embedding files are only read once. Every path has
+        # its own file, so that the eval.py --jobs workers sharing the cache
+        # never write over each other's entries.
+        path = str(Path(fname).resolve())
+        st = os.stat(path)
+        entry_file = self._checksums_dir/(hashlib.sha1(path.encode("utf-8")).hexdigest() + ".json")
+        try:
+            entry = json.loads(entry_file.read_text())
+            if entry["path"] == path and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                return entry["checksum"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        checksum = file_checksum(path)
+        write_json_atomic(entry_file, {"path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "checksum": checksum})
+        return checksum
+
+    def key(self, stage, inputs, params):
+        parts = {
+            "version": STAGE_CACHE_VERSION,
+            "stage": stage,
+            "inputs": [self.checksum(f) for f in inputs],
+            "params": params,
+        }
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def entry_dir(self, stage, key):
+        return self.cache_dir/stage/key
+
+    def restore(self, stage, key, outputs):
+        entry = self.entry_dir(stage, key)
+        if self.force or not (entry/"manifest.json").exists():
+            return False
+        manifest = json.loads((entry/"manifest.json").read_text())
+        if sorted(manifest) != sorted(outputs):
+            return False
+        for name, dst in outputs.items():
+            link_or_copy(entry/name, dst)
+        return True
+
+    def store(self, stage, key, outputs):
+        entry = self.entry_dir(stage, key)
+        tmp = entry.with_name(f"{key}.{os.getpid()}.tmp")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+        for name, src in outputs.items():
+            link_or_copy(src, tmp/name)
+        (tmp/"manifest.json").write_text(json.dumps(sorted(outputs)))
+        if entry.exists():
+            shutil.rmtree(entry)
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # Another worker stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+def remove_outputs(outputs):
+    for dst in outputs.values():
+        dst = Path(dst)
+        if dst.exists() or dst.is_symlink():
+            dst.unlink()
+
+def run_cached(cache, stage, inputs, params, outputs, run):
+    # Returns True when the outputs were reused from the cache. Outputs are
+    # unlinked before every run, with or without a cache, as they may be
+    # links to the inodes of a cache entry written by an earlier run.
+    with profiling.timer(stage):
+        if cache is None:
+            remove_outputs(outputs)
+            run()
+            return False
+        key = cache.key(stage, inputs, params)
+        if cache.restore(stage, key, outputs):
+            profiling.count("stages_reused")
+            return True
+        remove_outputs(outputs)
+        run()
+        cache.store(stage, key, outputs)
+        return False
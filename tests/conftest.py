@@ -0,0 +1,28 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# The modules live at the repository root, next to the scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eval_utils import unit_norm
+
+@pytest.fixture
+def embeddings():
+    # Normalised source and target matrices of random float64 vectors, whose
+    # near ties are far below the gaps the tests compare
+    rng = np.random.default_rng(0)
+    x_src = unit_norm(rng.standard_normal((300, 20)))
+    x_tgt = unit_norm(rng.standard_normal((400, 20)))
+    return x_src, x_tgt
+
+@pytest.fixture
+def lexicon_pairs():
+    # Gold pairs as a plain dict of sets, with several translations for
+    # some source words
+    rng = np.random.default_rng(1)
+    pairs = {}
+    for i in rng.choice(300, size=120, replace=False).tolist():
+        pairs[i] = set(rng.choice(400, size=int(rng.integers(1, 4)), replace=False).tolist())
+    return pairs
@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+import eval_utils
+from eval_utils import (GoldLexicon, PenaltyCache, compute_accuracies, compute_csls_accuracy, compute_csls_maps,
+                        compute_csls_scores, compute_csls_topk, compute_nn_accuracy, csls_penalties, csls_penalty,
+                        topk_blocked, topk_blocked_multi)
+
+# The tiled CSLS code against the full-matrix implementations it replaced
+
+def reference_nn_accuracy(x_src, x_tgt, lexicon, acc_at, true_topk=False):
+    # Dense NN@acc_at, as compute_nn_accuracy did with a dict of sets. Its
+    # argpartition(acc_at) slice is not always the acc_at best targets,
+    # compute_accuracies takes the true top acc_at instead.
+    idx_src = list(lexicon)
+    scores = np.dot(x_tgt, x_src[idx_src].T)
+    if true_topk:
+        pred = np.argsort(-scores, axis=0)[:acc_at]
+    else:
+        pred = scores.argpartition(acc_at, axis=0)[-acc_at:]
+    return sum(any(int(p) in lexicon[i] for p in pred[:, j]) for j, i in enumerate(idx_src)) / len(lexicon)
+
+def reference_csls_topk(x_src, x_tgt, idx_src, acc_at, k=10):
+    similarities = compute_csls_scores(x_src.copy(), x_tgt.copy(), idx_src, k=k)
+    nn = np.argsort(-similarities, axis=1, kind="stable")[:, :acc_at]
+    return np.take_along_axis(similarities, nn, axis=1), nn
+
+def reference_csls_accuracy(x_src, x_tgt, lexicon, acc_at, k=10):
+    idx_src = list(lexicon)
+    _, nn = reference_csls_topk(x_src, x_tgt, idx_src, acc_at, k=k)
+    return sum(any(int(w) in lexicon[i] for w in nn[j]) for j, i in enumerate(idx_src)) / len(lexicon)
+
+@pytest.mark.parametrize("tile_bytes", [1 << 10, 1 << 14, 1 << 28])
+@pytest.mark.parametrize("topk", [1, 5, 400])
+def test_topk_blocked_matches_dense(embeddings, tile_bytes, topk):
+    x_src, x_tgt = embeddings
+    penalty = np.random.default_rng(2).random(len(x_tgt))
+    q_idx = np.arange(0, len(x_src), 7)
+    scores, idx = topk_blocked(x_src, x_tgt, topk, q_idx=q_idx, penalty=penalty, scale=2, bsz=16, tile_bytes=tile_bytes)
+    dense = 2 * np.dot(x_src[q_idx], x_tgt.T) - penalty
+    expected = np.argsort(-dense, axis=1, kind="stable")[:, :topk]
+    np.testing.assert_array_equal(idx, expected)
+    np.testing.assert_allclose(scores, np.take_along_axis(dense, expected, axis=1), rtol=0, atol=1e-12)
+
+def test_topk_blocked_multi_matches_single_rankings(embeddings):
+    x_src, x_tgt = embeddings
+    penalty = np.random.default_rng(3).random(len(x_tgt))
+    rankings = [(1, None), (2, penalty)]
+    multi = topk_blocked_multi(x_src, x_tgt, 3, rankings, bsz=32, tile_bytes=1 << 12)
+    for (scale, p), (scores, idx) in zip(rankings, multi):
+        single_scores, single_idx = topk_blocked(x_src, x_tgt, 3, penalty=p, scale=scale, bsz=32, tile_bytes=1 << 12)
+        np.testing.assert_array_equal(idx, single_idx)
+        np.testing.assert_array_equal(scores, single_scores)
+
+def test_csls_penalty_matches_dense(embeddings):
+    x_src, x_tgt = embeddings
+    dense = np.dot(x_tgt, x_src.T)
+    expected = np.sort(dense, axis=1)[:, -10:].mean(axis=1)
+    np.testing.assert_allclose(csls_penalty(x_src, x_tgt, "tgt", k=10, tile_bytes=1 << 12), expected, rtol=0, atol=1e-12)
+    expected_src = np.sort(dense.T, axis=1)[:, -10:].mean(axis=1)
+    np.testing.assert_allclose(csls_penalty(x_src, x_tgt, "src", k=10, tile_bytes=1 << 12), expected_src, rtol=0, atol=1e-12)
+
+def test_csls_penalties_share_one_sweep(embeddings):
+    x_src, x_tgt = embeddings
+    penalties = csls_penalties(x_src, x_tgt, [5, 10])
+    for k in (5, 10):
+        np.testing.assert_allclose(penalties[k], csls_penalty(x_src, x_tgt, k=k), rtol=0, atol=1e-12)
+
+def test_compute_csls_topk_matches_dense(embeddings):
+    x_src, x_tgt = embeddings
+    idx_src = list(range(0, len(x_src), 3))
+    expected_scores, expected_nn = reference_csls_topk(x_src, x_tgt, idx_src, 3)
+    scores, nn = compute_csls_topk(x_src.copy(), x_tgt.copy(), idx_src, acc_at=3, tile_bytes=1 << 12)
+    np.testing.assert_array_equal(nn, expected_nn)
+    np.testing.assert_allclose(scores, expected_scores, rtol=0, atol=1e-12)
+
+def test_compute_csls_topk_float32_close_to_dense(embeddings):
+    x_src, x_tgt = (x.astype(np.float32) for x in embeddings)
+    idx_src = list(range(len(x_src)))
+    dense = compute_csls_scores(x_src.copy(), x_tgt.copy(), idx_src)
+    scores, nn = compute_csls_topk(x_src.copy(), x_tgt.copy(), idx_src, tile_bytes=1 << 12)
+    np.testing.assert_allclose(scores[:, 0], dense.max(axis=1), rtol=0, atol=1e-5)
+    np.testing.assert_allclose(np.take_along_axis(dense, nn, axis=1)[:, 0], dense.max(axis=1), rtol=0, atol=1e-5)
+
+def test_compute_csls_maps_matches_dense(embeddings, lexicon_pairs):
+    x_src, x_tgt = embeddings
+    words_src = ["s%d" % i for i in range(len(x_src))]
+    nn_words = {"s%d" % i for i in range(0, len(x_src), 2)} | {"missing"}
+    maps = compute_csls_maps(x_src.copy(), words_src, x_tgt.copy(), GoldLexicon(lexicon_pairs), nn_words, acc_at=3,
+                             tile_bytes=1 << 12)
+    idx_src = sorted(words_src.index(w) for w in nn_words if w in words_src)
+    assert sorted(maps) == idx_src
+    expected_scores, expected_nn = reference_csls_topk(x_src, x_tgt, idx_src, 3)
+    for j, i in enumerate(idx_src):
+        nn, scores, correct = maps[i]
+        np.testing.assert_array_equal(nn, expected_nn[j])
+        np.testing.assert_allclose(scores, expected_scores[j], rtol=0, atol=1e-12)
+        if i not in lexicon_pairs:
+            assert correct == 1
+        else:
+            assert correct == (2 if any(int(w) in lexicon_pairs[i] for w in nn) else 0)
+
+@pytest.mark.parametrize("acc_at", [1, 3, 5])
+def test_accuracies_match_dense(embeddings, lexicon_pairs, acc_at):
+    x_src, x_tgt = embeddings
+    lexicon = GoldLexicon(lexicon_pairs)
+    expected_nn = reference_nn_accuracy(x_src, x_tgt, lexicon_pairs, acc_at)
+    expected_csls = reference_csls_accuracy(x_src, x_tgt, lexicon_pairs, acc_at)
+    assert compute_nn_accuracy(x_src.copy(), x_tgt.copy(), lexicon, acc_at=acc_at) == pytest.approx(expected_nn)
+    assert compute_csls_accuracy(x_src.copy(), x_tgt.copy(), lexicon, acc_at=acc_at) == pytest.approx(expected_csls)
+    accs = compute_accuracies(x_src.copy(), x_tgt.copy(), lexicon, cutoffs=(acc_at,), csls_ks=(10,), tile_bytes=1 << 12)
+    assert accs["nn"][acc_at] == pytest.approx(reference_nn_accuracy(x_src, x_tgt, lexicon_pairs, acc_at, true_topk=True))
+    assert accs["csls"][10][acc_at] == pytest.approx(expected_csls)
+
+def test_penalty_cache_reuses_stored_penalties(embeddings, tmp_path, monkeypatch):
+    x_src, x_tgt = embeddings
+    monkeypatch.setattr(eval_utils, "_penalty_memo", {})
+    cache = PenaltyCache("pair", str(tmp_path))
+    computed = csls_penalty(x_src, x_tgt, "tgt", k=10, penalty_cache=cache)
+    assert (tmp_path/"pair.tgt.k10.npy").exists()
+    # A later run, without the in-process memo, reads the file instead of
+    # sweeping again
+    monkeypatch.setattr(eval_utils, "_penalty_memo", {})
+    reused = PenaltyCache("pair", str(tmp_path)).get("tgt", 10, lambda: pytest.fail("penalty recomputed"))
+    np.testing.assert_array_equal(reused, computed)
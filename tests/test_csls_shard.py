@@ -0,0 +1,73 @@
+import os
+import gc
+import numpy as np
+import pytest
+import csls_shard
+from eval_utils import compute_accuracies, csls_penalty, topk_blocked_multi, GoldLexicon
+
+@pytest.fixture
+def workers(monkeypatch):
+    # Two workers that take every sweep, however small
+    monkeypatch.setattr(csls_shard, "MIN_SHARD_FLOPS", 0)
+    csls_shard.set_workers(2)
+    yield
+    csls_shard.set_workers(1)
+
+def shm_names():
+    return set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_sharded_topk_matches_single_process(embeddings, workers, dtype):
+    x_src, x_tgt = (x.astype(dtype) for x in embeddings)
+    penalty = csls_penalty(x_src, x_tgt, "tgt", k=10)
+    rankings = [(1, None), (2, penalty)]
+    q_idx = np.arange(0, len(x_src), 3)
+    csls_shard.set_workers(1)
+    expected = topk_blocked_multi(x_src, x_tgt, 5, rankings, q_idx=q_idx, bsz=16, tile_bytes=1 << 12)
+    csls_shard.set_workers(2)
+    shared_src, shared_tgt = csls_shard.share(x_src), csls_shard.share(x_tgt)
+    for x_q in (x_src, shared_src):
+        sharded = topk_blocked_multi(x_q, shared_tgt, 5, rankings, q_idx=q_idx, bsz=16, tile_bytes=1 << 12)
+        for (scores, idx), (expected_scores, expected_idx) in zip(sharded, expected):
+            np.testing.assert_array_equal(idx, expected_idx)
+            np.testing.assert_array_equal(scores, expected_scores)
+    assert csls_shard._pool is not None
+
+def test_sharded_penalty_and_accuracies_match(embeddings, lexicon_pairs, workers):
+    x_src, x_tgt = (x.astype(np.float32) for x in embeddings)
+    lexicon = GoldLexicon(lexicon_pairs)
+    csls_shard.set_workers(1)
+    expected_penalty = csls_penalty(x_src, x_tgt, "src", k=10, bsz=16)
+    expected_accs = compute_accuracies(x_src.copy(), x_tgt.copy(), lexicon, bsz=16)
+    csls_shard.set_workers(2)
+    np.testing.assert_array_equal(csls_penalty(x_src, x_tgt, "src", k=10, bsz=16), expected_penalty)
+    assert compute_accuracies(csls_shard.share(x_src, copy=True), csls_shard.share(x_tgt, copy=True), lexicon, bsz=16) == expected_accs
+
+def test_share_casts_float16_once(workers):
+    x = np.arange(12, dtype=np.float16).reshape(3, 4)
+    shared = csls_shard.share(x)
+    assert shared.dtype == np.float32
+    np.testing.assert_array_equal(shared, x.astype(np.float32))
+    # Views of a shared array are shared already
+    view = shared[1:]
+    assert csls_shard.share(view) is view
+
+def test_share_without_workers_returns_the_array():
+    x = np.ones((3, 4), dtype=np.float32)
+    assert csls_shard.share(x) is x
+    copy = csls_shard.share(x, copy=True)
+    assert copy is not x and np.array_equal(copy, x)
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+def test_blocks_are_unlinked_on_release_and_collection(workers):
+    before = shm_names()
+    x = csls_shard.share(np.ones((100, 8), dtype=np.float32))
+    y = csls_shard.share(np.ones((100, 8), dtype=np.float32))
+    assert len(shm_names() - before) == 2
+    csls_shard.release(x)
+    # Released arrays stay usable
+    assert x.sum() == 800
+    del y
+    gc.collect()
+    assert shm_names() - before == set()
+    assert csls_shard._root(x) is None
@@ -0,0 +1,55 @@
+import copy
+import pickle
+import numpy as np
+from eval_utils import GoldLexicon, as_gold_lexicon, load_lexicon
+
+def test_csr_matches_the_sets(lexicon_pairs):
+    lexicon = GoldLexicon(lexicon_pairs)
+    assert lexicon.src_ids.tolist() == list(lexicon_pairs)
+    for s, start, end in zip(lexicon.src_ids.tolist(), lexicon.indptr[:-1].tolist(), lexicon.indptr[1:].tolist()):
+        assert lexicon.indices[start:end].tolist() == sorted(lexicon_pairs[s])
+
+def test_hits_match_set_membership(lexicon_pairs):
+    lexicon = GoldLexicon(lexicon_pairs)
+    rng = np.random.default_rng(4)
+    idx_src = rng.integers(0, 300, size=50)
+    nn = rng.integers(0, 400, size=(50, 5))
+    # Some certain hits
+    for j, s in enumerate(idx_src.tolist()):
+        if s in lexicon_pairs:
+            nn[j, 2] = min(lexicon_pairs[s])
+    expected = [[s in lexicon_pairs and int(t) in lexicon_pairs[s] for t in row] for s, row in zip(idx_src.tolist(), nn)]
+    assert lexicon.hits(idx_src, nn, 400).tolist() == expected
+    assert lexicon.contains(idx_src).tolist() == [s in lexicon_pairs for s in idx_src.tolist()]
+
+def test_hits_of_an_empty_lexicon():
+    assert not GoldLexicon().hits([0, 1], np.array([[0, 1], [1, 0]])).any()
+
+def test_build_csr_after_modification(lexicon_pairs):
+    lexicon = GoldLexicon(lexicon_pairs)
+    lexicon.hits([0], np.array([[0]]), 400)
+    lexicon[299].add(399)
+    lexicon.build_csr()
+    assert lexicon.hits([299], np.array([[399]]), 400).all()
+
+def test_copy_and_pickle_keep_the_pairs(lexicon_pairs):
+    lexicon = GoldLexicon(lexicon_pairs)
+    for other in (copy.copy(lexicon), lexicon.copy(), pickle.loads(pickle.dumps(lexicon))):
+        assert isinstance(other, GoldLexicon)
+        assert dict(other) == dict(lexicon)
+        np.testing.assert_array_equal(other.indices, lexicon.indices)
+        np.testing.assert_array_equal(other.indptr, lexicon.indptr)
+
+def test_as_gold_lexicon(lexicon_pairs):
+    lexicon = GoldLexicon(lexicon_pairs)
+    assert as_gold_lexicon(lexicon) is lexicon
+    assert as_gold_lexicon(None) is None
+    assert dict(as_gold_lexicon(lexicon_pairs)) == lexicon_pairs
+
+def test_load_lexicon(tmp_path):
+    dico = tmp_path/"dico.txt"
+    dico.write_text("a x\na y\nb z\nc x\nmulti word\tx\n", encoding="utf-8")
+    lexicon, vocab_size = load_lexicon(str(dico), ["a", "b", "multi word"], ["x", "y"], verbose=False)
+    # b's translation and c are not in the vocabularies
+    assert dict(lexicon) == {0: {0, 1}, 2: {0}}
+    assert vocab_size == 4
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from job_dag import Job, JobDAG, JobFailed
+
+def make_job(name, log, deps=(), cost=0, fail=False, **kwargs):
+    # Job that records when it starts and ends in log
+    async def run():
+        log.append(("start", name))
+        await asyncio.sleep(0)
+        if fail:
+            raise JobFailed(f"{name} failed")
+        log.append(("end", name))
+    return Job(name, run, deps=deps, cost=cost, **kwargs)
+
+def position(log, event, name):
+    return log.index((event, name))
+
+def test_dependencies_run_first():
+    log = []
+    dag = JobDAG()
+    dag.add(make_job("align", log, deps=["embed:a", "embed:eng"]))
+    dag.add(make_job("embed:a", log))
+    dag.add(make_job("embed:eng", log))
+    status = asyncio.run(dag.run())
+    assert status == {"align": "done", "embed:a": "done", "embed:eng": "done"}
+    assert position(log, "start", "align") > max(position(log, "end", "embed:a"), position(log, "end", "embed:eng"))
+
+def test_longest_path_starts_first():
+    log = []
+    dag = JobDAG()
+    dag.add(make_job("small", log, cost=1))
+    dag.add(make_job("large", log, cost=5))
+    dag.add(make_job("before_small", log, cost=10))
+    dag.add(make_job("after", log, deps=["before_small"], cost=1))
+    assert dag.priorities() == {"small": 1, "large": 5, "before_small": 11, "after": 1}
+    asyncio.run(dag.run())
+    starts = [name for event, name in log if event == "start"]
+    assert starts[:3] == ["before_small", "large", "small"]
+
+def test_failure_blocks_only_dependents(capsys):
+    log = []
+    dag = JobDAG()
+    dag.add(make_job("embed:a", log, fail=True))
+    dag.add(make_job("align:a", log, deps=["embed:a"]))
+    dag.add(make_job("eval:a", log, deps=["align:a"]))
+    dag.add(make_job("embed:b", log))
+    dag.add(make_job("align:b", log, deps=["embed:b"]))
+    status = asyncio.run(dag.run())
+    assert status == {"embed:a": "failed", "align:a": "blocked", "eval:a": "blocked", "embed:b": "done", "align:b": "done"}
+    assert ("start", "align:a") not in log
+    assert "Failed embed:a" in capsys.readouterr().out
+
+def test_jobs_are_shared_by_name():
+    log = []
+    dag = JobDAG()
+    first = dag.add(make_job("embed:eng", log))
+    assert dag.add(make_job("embed:eng", log, cost=3)) is first
+    asyncio.run(dag.run())
+    assert log.count(("start", "embed:eng")) == 1
+
+def test_cycle_and_unknown_dependency():
+    dag = JobDAG()
+    dag.add(make_job("a", [], deps=["b"]))
+    dag.add(make_job("b", [], deps=["a"]))
+    with pytest.raises(ValueError, match="cycle"):
+        dag.priorities()
+    dag = JobDAG()
+    dag.add(make_job("a", [], deps=["missing"]))
+    with pytest.raises(ValueError, match="unknown job missing"):
+        asyncio.run(dag.run())
+
+def test_complete_outputs_are_skipped(tmp_path):
+    log = []
+    output = tmp_path/"a.vec"
+    output.write_text("")
+    dag = JobDAG()
+    dag.add(make_job("embed:a", log, outputs=[output]))
+    dag.add(make_job("align:a", log, deps=["embed:a"], outputs=[tmp_path/"aligned.vec"]))
+    status = asyncio.run(dag.run())
+    assert status == {"embed:a": "skipped", "align:a": "done"}
+    # force reruns a complete job
+    dag = JobDAG()
+    dag.add(make_job("embed:a", log, outputs=[output], force=True))
+    assert asyncio.run(dag.run()) == {"embed:a": "done"}
+
+def test_state_file_resumes_by_signature(tmp_path):
+    state_file = tmp_path/"state.json"
+    log = []
+    dag = JobDAG(state_file)
+    dag.add(make_job("move", log, signature="v1"))
+    assert asyncio.run(dag.run()) == {"move": "done"}
+    dag = JobDAG(state_file)
+    dag.add(make_job("move", log, signature="v1"))
+    assert asyncio.run(dag.run()) == {"move": "skipped"}
+    dag = JobDAG(state_file)
+    dag.add(make_job("move", log, signature="v2"))
+    assert asyncio.run(dag.run()) == {"move": "done"}
+
+def test_failed_job_is_not_recorded(tmp_path):
+    state_file = tmp_path/"state.json"
+    dag = JobDAG(state_file)
+    dag.add(make_job("move", [], signature="v1", fail=True))
+    asyncio.run(dag.run())
+    dag = JobDAG(state_file)
+    dag.add(make_job("move", [], signature="v1"))
+    assert dag.plan() == {"move"}
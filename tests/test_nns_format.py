@@ -0,0 +1,47 @@
+import io
+import numpy as np
+from nns_format import nns_arrays, nns_binary_path, save_nns_binary, load_nns_binary, save_nns_tsv
+
+def sample_nns():
+    # compute_csls_maps output: source index -> (neighbours, scores, correct)
+    rng = np.random.default_rng(5)
+    return {i: (rng.choice(6, size=3, replace=False), rng.random(3).astype(np.float32), i % 3) for i in (4, 0, 2)}
+
+def reference_save_nns(filename, nns, words_src, words_tgt):
+    # The TSV that compute_nns.py wrote straight from the map
+    fout = io.open(filename, "w", encoding="utf-8")
+    for src_idx, (tgt_idx, scores, correct) in nns.items():
+        tgt_words = ",".join((words_tgt[int(idx)] for idx in tgt_idx))
+        fout.write("%s\t%s\t%s\t%d\n" % (words_src[int(src_idx)], tgt_words, ",".join(map(lambda s: str(s.round(4)), scores)), int(correct)))
+    fout.close()
+
+def test_binary_round_trip(tmp_path):
+    nns = sample_nns()
+    words_src = ["ä%d" % i for i in range(5)]
+    words_tgt = ["t %d" % i for i in range(6)]
+    arrays = nns_arrays(nns)
+    filename = str(tmp_path/"nns.nns.npz")
+    save_nns_binary(filename, arrays, words_src, words_tgt)
+    loaded = load_nns_binary(filename)
+    assert loaded["words_src"] == words_src and loaded["words_tgt"] == words_tgt
+    for name in ("src_idx", "tgt_idx", "scores", "correct"):
+        np.testing.assert_array_equal(loaded[name], arrays[name])
+    assert loaded["src_idx"].tolist() == [4, 0, 2]
+
+def test_tsv_matches_the_original_writer(tmp_path):
+    nns = sample_nns()
+    words_src = ["s%d" % i for i in range(5)]
+    words_tgt = ["t%d" % i for i in range(6)]
+    save_nns_tsv(tmp_path/"new.tsv", nns_arrays(nns), words_src, words_tgt)
+    reference_save_nns(tmp_path/"old.tsv", nns, words_src, words_tgt)
+    assert (tmp_path/"new.tsv").read_text(encoding="utf-8") == (tmp_path/"old.tsv").read_text(encoding="utf-8")
+
+def test_empty_vocabulary_round_trip(tmp_path):
+    filename = str(tmp_path/"empty.nns.npz")
+    save_nns_binary(filename, nns_arrays({}), [], [])
+    loaded = load_nns_binary(filename)
+    assert loaded["words_src"] == [] and loaded["src_idx"].size == 0
+
+def test_binary_path():
+    assert nns_binary_path("out/deu.tsv") == "out/deu.nns.npz"
+    assert nns_binary_path("out/deu.nns.npz") == "out/deu.nns.npz"
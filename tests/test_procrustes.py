@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from eval_utils import unit_norm
+from procrustes import identical_pairs, dictionary_pairs, procrustes, csls_mutual_nn, refine
+
+@pytest.fixture
+def rotated():
+    # Target embeddings and the same words rotated by a random orthogonal map
+    rng = np.random.default_rng(6)
+    x_tgt = unit_norm(rng.standard_normal((500, 16)))
+    q, _ = np.linalg.qr(rng.standard_normal((16, 16)))
+    return x_tgt.dot(q.T), x_tgt, q
+
+def test_procrustes_recovers_the_rotation(rotated):
+    x_src, x_tgt, q = rotated
+    pairs = np.arange(100)
+    w = procrustes(x_src, x_tgt, pairs, pairs, bsz=7)
+    np.testing.assert_allclose(w, q, atol=1e-10)
+    np.testing.assert_allclose(w.dot(w.T), np.eye(16), atol=1e-10)
+
+def test_csls_mutual_nn_of_identical_spaces(rotated):
+    _, x_tgt, _ = rotated
+    src, tgt = csls_mutual_nn(x_tgt, x_tgt, k=5, max_rank=300, tile_bytes=1 << 12)
+    assert src.tolist() == list(range(300)) and tgt.tolist() == list(range(300))
+
+def test_refine_from_a_small_seed(rotated, tmp_path):
+    x_src, x_tgt, q = rotated
+    with open(tmp_path/"log.txt", "w") as log:
+        w = refine(x_src, x_tgt, np.arange(20), np.arange(20), n_iter=3, k=5, max_rank=400, log_file=log)
+    np.testing.assert_allclose(w, q, atol=1e-8)
+    assert "Seed dictionary: 20 pairs" in (tmp_path/"log.txt").read_text()
+
+def test_refine_needs_a_seed(rotated):
+    x_src, x_tgt, _ = rotated
+    with pytest.raises(ValueError):
+        refine(x_src, x_tgt, np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+
+def test_seed_dictionaries(tmp_path):
+    words_src = ["paris", "haus", "maria", "7"]
+    words_tgt = ["house", "7", "paris", "maria"]
+    src, tgt = identical_pairs(words_src, words_tgt)
+    assert list(zip(src.tolist(), tgt.tolist())) == [(0, 2), (2, 3), (3, 1)]
+    # Only among the 3 most frequent words of each language
+    src, tgt = identical_pairs(words_src, words_tgt, max_rank=3)
+    assert list(zip(src.tolist(), tgt.tolist())) == [(0, 2)]
+    dico = tmp_path/"seed.txt"
+    dico.write_text("haus house\nparis paris\nhaus home\n", encoding="utf-8")
+    src, tgt = dictionary_pairs(str(dico), words_src, words_tgt)
+    assert list(zip(src.tolist(), tgt.tolist())) == [(0, 2), (1, 0)]
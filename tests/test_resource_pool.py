@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from resource_pool import ResourcePool, THREAD_ENV_VARS
+
+def test_threads_are_granted_from_what_is_free():
+    async def main():
+        pool = ResourcePool(num_cores=8)
+        first = await pool.acquire(min_threads=1, max_threads=6)
+        second = await pool.acquire(min_threads=1, max_threads=6)
+        assert (first.threads, second.threads) == (6, 2)
+        await pool.release(first)
+        await pool.release(second)
+        assert pool._free_cores == 8
+    asyncio.run(main())
+
+def test_requests_wait_until_they_fit():
+    async def main():
+        pool = ResourcePool(num_cores=2)
+        order = []
+        async def job(name, threads, hold):
+            async with pool.lease(min_threads=threads, max_threads=threads):
+                order.append(name)
+                await asyncio.sleep(hold)
+        await asyncio.gather(job("a", 2, 0.01), job("b", 1, 0), job("c", 1, 0))
+        return order
+    assert asyncio.run(main()) == ["a", "b", "c"]
+
+def test_higher_priority_is_served_first():
+    async def main():
+        pool = ResourcePool(num_cores=1)
+        holder = await pool.acquire()
+        order = []
+        async def job(name, priority):
+            async with pool.lease(priority=priority):
+                order.append(name)
+        tasks = [asyncio.ensure_future(job("low", 1)), asyncio.ensure_future(job("high", 10))]
+        await asyncio.sleep(0)
+        await pool.release(holder)
+        await asyncio.gather(*tasks)
+        return order
+    assert asyncio.run(main()) == ["high", "low"]
+
+def test_lower_priority_goes_ahead_when_the_higher_does_not_fit():
+    async def main():
+        pool = ResourcePool(num_cores=2)
+        holder = await pool.acquire()
+        order = []
+        async def job(name, threads, priority):
+            async with pool.lease(min_threads=threads, max_threads=threads, priority=priority):
+                order.append(name)
+        high = asyncio.ensure_future(job("high", 2, 10))
+        low = asyncio.ensure_future(job("low", 1, 1))
+        await asyncio.sleep(0.01)
+        assert order == ["low"]
+        await pool.release(holder)
+        await asyncio.gather(high, low)
+        return order
+    assert asyncio.run(main()) == ["low", "high"]
+
+def test_gpus_are_exclusive_without_memory_budget():
+    async def main():
+        pool = ResourcePool(num_cores=4, num_gpus=2)
+        leases = [await pool.acquire(gpu=True) for _ in range(2)]
+        assert sorted(lease.device_id for lease in leases) == [0, 1]
+        third = asyncio.ensure_future(pool.acquire(gpu=True))
+        await asyncio.sleep(0.01)
+        assert not third.done()
+        await pool.release(leases[1])
+        assert (await third).device_id == leases[1].device_id
+    asyncio.run(main())
+
+def test_gpu_memory_is_shared():
+    async def main():
+        pool = ResourcePool(num_cores=4, num_gpus=1, gpu_mem_mb=10000)
+        a = await pool.acquire(gpu=True, gpu_mem_mb=4000)
+        b = await pool.acquire(gpu=True, gpu_mem_mb=4000)
+        assert a.device_id == b.device_id == 0
+        c = asyncio.ensure_future(pool.acquire(gpu=True, gpu_mem_mb=4000))
+        await asyncio.sleep(0.01)
+        assert not c.done()
+        await pool.release(a)
+        assert (await c).gpu_mem_mb == 4000
+        with pytest.raises(ValueError):
+            await pool.acquire(gpu=True, gpu_mem_mb=20000)
+    asyncio.run(main())
+
+def test_gpu_request_without_gpus():
+    with pytest.raises(ValueError):
+        asyncio.run(ResourcePool(num_cores=1).acquire(gpu=True))
+
+def test_lease_env_caps_threads():
+    async def main():
+        async with ResourcePool(num_cores=4).lease(max_threads=3) as lease:
+            return lease.env()
+    env = asyncio.run(main())
+    assert all(env[var] == "3" for var in THREAD_ENV_VARS)
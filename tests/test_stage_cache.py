@@ -0,0 +1,79 @@
+import os
+import pytest
+from stage_cache import StageCache, run_cached, link_or_copy
+
+@pytest.fixture
+def inputs(tmp_path):
+    paths = [tmp_path/"src.vec", tmp_path/"dico.txt"]
+    for path in paths:
+        path.write_text(path.name)
+    return paths
+
+def counting_stage(outputs, calls, content="out"):
+    # A stage writing fresh output files and counting its runs
+    def run():
+        calls.append(1)
+        for dst in outputs.values():
+            with open(dst, "x") as f:
+                f.write(content)
+    return run
+
+def test_reuses_outputs_for_unchanged_inputs(tmp_path, inputs):
+    cache = StageCache(tmp_path/"cache")
+    calls = []
+    first = {"report": tmp_path/"exp1"/"report.txt"}
+    first["report"].parent.mkdir()
+    assert not run_cached(cache, "eval_align", inputs, {"k": 10}, first, counting_stage(first, calls))
+    second = {"report": tmp_path/"exp2"/"report.txt"}
+    assert run_cached(cache, "eval_align", inputs, {"k": 10}, second, counting_stage(second, calls))
+    assert len(calls) == 1
+    assert second["report"].read_text() == "out"
+
+def test_changed_input_or_params_change_the_key(tmp_path, inputs):
+    cache = StageCache(tmp_path/"cache")
+    key = cache.key("eval_align", inputs, {"k": 10})
+    assert cache.key("eval_align", inputs, {"k": 5}) != key
+    assert cache.key("compute_nns", inputs, {"k": 10}) != key
+    inputs[0].write_text("changed contents")
+    assert cache.key("eval_align", inputs, {"k": 10}) != key
+    # A fresh cache, which reads the remembered checksums, agrees
+    assert StageCache(tmp_path/"cache").key("eval_align", inputs, {"k": 10}) == cache.key("eval_align", inputs, {"k": 10})
+
+def test_touched_file_with_same_size_is_rehashed(tmp_path, inputs):
+    cache = StageCache(tmp_path/"cache")
+    key = cache.key("eval_align", inputs, {})
+    # Same size, new contents and mtime
+    inputs[0].write_text("SRC.VEC")
+    st = os.stat(inputs[0])
+    os.utime(inputs[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert cache.key("eval_align", inputs, {}) != key
+
+def test_force_and_missing_outputs_rerun(tmp_path, inputs):
+    calls = []
+    outputs = {"report": tmp_path/"report.txt"}
+    run_cached(StageCache(tmp_path/"cache"), "s", inputs, {}, outputs, counting_stage(outputs, calls))
+    assert not run_cached(StageCache(tmp_path/"cache", force=True), "s", inputs, {}, outputs, counting_stage(outputs, calls))
+    # An entry stored for other outputs is not used
+    other = {"report": tmp_path/"report.txt", "nns": tmp_path/"nns.tsv"}
+    assert not run_cached(StageCache(tmp_path/"cache"), "s", inputs, {}, other, counting_stage(other, calls))
+    assert len(calls) == 3
+
+def test_rerun_does_not_write_through_cache_links(tmp_path, inputs):
+    cache = StageCache(tmp_path/"cache")
+    calls = []
+    outputs = {"report": tmp_path/"report.txt"}
+    run_cached(cache, "s", inputs, {}, outputs, counting_stage(outputs, calls, "first"))
+    entry = cache.entry_dir("s", cache.key("s", inputs, {}))/"report"
+    # Without the cache the stage reruns on a fresh file, the cached one
+    # (possibly the same inode) keeps its contents
+    run_cached(None, "s", inputs, {}, outputs, counting_stage(outputs, calls, "second"))
+    assert outputs["report"].read_text() == "second"
+    assert entry.read_text() == "first"
+
+def test_link_or_copy_replaces_dst(tmp_path):
+    src, dst = tmp_path/"src", tmp_path/"sub"/"dst"
+    src.write_text("new")
+    dst.parent.mkdir()
+    dst.write_text("old")
+    link_or_copy(src, dst)
+    assert dst.read_text() == "new"
@@ -0,0 +1,38 @@
+import numpy as np
+from vocab import Vocabulary, as_vocabulary
+
+def test_ids_and_lookup():
+    vocab = Vocabulary(["a", "b", "c"])
+    assert vocab.id("b") == 1 and vocab.id("z") == -1 and vocab.id("z", None) is None
+    assert vocab.ids(["c", "z", "a"]).tolist() == [2, -1, 0]
+    assert vocab.ids(["c"]).dtype == np.int64
+    assert vocab.lookup(np.array([2, 0])) == ["c", "a"]
+    assert "a" in vocab and "z" not in vocab
+
+def test_repeated_word_keeps_its_first_id():
+    vocab = Vocabulary(["a", "b", "a"])
+    assert vocab.id("a") == 0
+    assert len(vocab) == 3
+
+def test_word2id_follows_modifications():
+    vocab = Vocabulary(["a", "b"])
+    assert vocab.id("c") == -1
+    vocab.append("c")
+    assert vocab.id("c") == 2
+    vocab[0] = "z"
+    assert vocab.id("a") == -1 and vocab.id("z") == 0
+    vocab += ["d"]
+    assert vocab.id("d") == 3
+    vocab.insert(0, "e")
+    assert vocab.id("z") == 1
+    del vocab[0]
+    assert vocab.id("e") == -1
+    vocab.sort()
+    assert vocab.lookup(range(len(vocab))) == sorted(vocab) and vocab.id("b") == sorted(vocab).index("b")
+    vocab.clear()
+    assert "b" not in vocab
+
+def test_as_vocabulary():
+    vocab = Vocabulary(["a"])
+    assert as_vocabulary(vocab) is vocab
+    assert isinstance(as_vocabulary(["a"]), Vocabulary)
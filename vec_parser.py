@@ -0,0 +1,133 @@
+import io
+import os
+import itertools
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import profiling
+
+# Below this size the process pool costs more than it saves
+MIN_PARALLEL_BYTES = 32 << 20
+CHUNKS_PER_WORKER = 4
+
+def read_vec_text(fin, n, d, dtype=np.float64):
+    x = np.zeros([n, d], dtype=dtype)
+    words = []
+    for i, line in enumerate(fin):
+        if i >= n:
+            break
+        tokens = line.rstrip().split(' ')
+        words.append(tokens[0])
+        v = np.array(tokens[1:], dtype=float)
+        x[i, :] = v
+    return words, x
+
+def chunk_bounds(fname, start, size, num_chunks):
+    bounds = [start]
+    with open(fname, 'rb') as f:
+        for c in range(1, num_chunks):
+            pos = start + (size - start) * c // num_chunks
+            if pos <= bounds[-1]:
+                continue
+            # Move to the first line that starts at or after pos
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def read_chunk(fname, start, end):
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+def count_chunk_lines(args):
+    fname, start, end = args
+    data = read_chunk(fname, start, end)
+    count = data.count(b'\n')
+    if data and not data.endswith(b'\n'):
+        count += 1
+    return count
+
+def parse_chunk(args):
+    fname, start, end, row_start, num_rows, shm_name, shape, dtype = args
+    data = read_chunk(fname, start, end).decode('utf-8', errors='ignore')
+    lines = data.split('\n')[:num_rows]
+    words = []
+    values = []
+    for line in lines:
+        word, _, vec = line.rstrip().partition(' ')
+        words.append(word)
+        values.append(vec)
+    # Parsed as float64 and rounded on assignment, as read_vec_text does,
+    # parsing straight to float32 rounds some values differently
+    v = np.fromstring(' '.join(values), dtype=np.float64, sep=' ')
+    if v.size != len(lines) * shape[1]:
+        raise ValueError("Malformed vectors in %s between bytes %d and %d" % (fname, start, end))
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        x = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        x[row_start:row_start + len(lines)] = v.reshape(len(lines), shape[1])
+        del x
+    finally:
+        shm.close()
+    return words
+
+def parse_vec_parallel(fname, maxload=200000, workers=None, dtype=np.float64):
+    with open(fname, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+        size = os.fstat(f.fileno()).st_size
+    n_total, d = map(int, header.decode('utf-8', errors='ignore').split())
+    n = min(n_total, maxload) if maxload > 0 else n_total
+    workers = workers or os.cpu_count()
+    chunks = chunk_bounds(fname, start, size, workers * CHUNKS_PER_WORKER)
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(n * d * dtype.itemsize, 1))
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            # Line counts give each chunk its first row. They are requested a
+            # few chunks ahead of the one being placed, so that chunks past
+            # row n are neither counted nor parsed, and every chunk is parsed
+            # as soon as its first row is known.
+            parses = []
+            row = 0
+            pending = collections.deque()
+            next_chunks = iter(chunks)
+            def count_next(num_chunks=1):
+                for s, e in itertools.islice(next_chunks, num_chunks):
+                    pending.append((s, e, pool.apply_async(count_chunk_lines, ((fname, s, e),))))
+            count_next(workers)
+            while pending and row < n:
+                s, e, count = pending.popleft()
+                count = count.get()
+                parses.append(pool.apply_async(parse_chunk, ((fname, s, e, row, min(count, n - row), shm.name, (n, d), dtype.str),)))
+                row += count
+                if row < n:
+                    count_next()
+            chunk_words = [words.get() for words in parses]
+        x = np.ndarray((n, d), dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    words = [w for ws in chunk_words for w in ws]
+    return words, x, n_total, d
+
+@profiling.timed()
+def read_vec_file(fname, maxload=200000, workers=None, dtype=np.float64):
+    if workers != 1 and os.path.getsize(fname) >= MIN_PARALLEL_BYTES:
+        words, x, n_total, d = parse_vec_parallel(fname, maxload, workers, dtype)
+    else:
+        fin = io.open(fname, 'r', encoding='utf-8', newline='\n', errors='ignore')
+        n_total, d = map(int, fin.readline().split())
+        n = min(n_total, maxload) if maxload > 0 else n_total
+        words, x = read_vec_text(fin, n, d, dtype)
+        fin.close()
+    profiling.count("rows_parsed", len(words))
+    profiling.count("bytes_allocated", x.nbytes)
+    return words, x, n_total, d
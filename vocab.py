@@ -0,0 +1,56 @@
+import numpy as np
+
+class Vocabulary(list):
+    # Words of one language interned to dense integer ids, the position of a
+    # word in the list. Built once per embedding file or translations file
+    # and shared by every join on its words, which are then done on id
+    # arrays. A repeated word keeps the id of its first occurrence.
+    def __init__(self, words=()):
+        super().__init__(words)
+        self._word2id = None
+
+    @property
+    def word2id(self):
+        if self._word2id is None:
+            word2id = {}
+            for i, w in enumerate(self):
+                if w not in word2id:
+                    word2id[w] = i
+            self._word2id = word2id
+        return self._word2id
+
+    def _modified(self):
+        self._word2id = None
+
+    def __contains__(self, word):
+        return word in self.word2id
+
+    def id(self, word, default=-1):
+        return self.word2id.get(word, default)
+
+    def ids(self, words):
+        # Ids of words as an int64 array, -1 for words not in the vocabulary
+        get = self.word2id.get
+        return np.fromiter((get(w, -1) for w in words), dtype=np.int64)
+
+    def lookup(self, ids):
+        return [self[i] for i in np.asarray(ids).tolist()]
+
+def _invalidating(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._modified()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+# The word -> id map is rebuilt on the next lookup after any change
+for _name in ["append", "extend", "insert", "remove", "pop", "clear", "sort", "reverse",
+              "__setitem__", "__delitem__", "__iadd__", "__imul__"]:
+    setattr(Vocabulary, _name, _invalidating(_name))
+
+def as_vocabulary(words):
+    if isinstance(words, Vocabulary):
+        return words
+    return Vocabulary(words)